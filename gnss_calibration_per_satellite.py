@@ -3,6 +3,11 @@
     A small module designed to see if a specific satellite may give negative
     total electron content measurments.
     Generates for a certain period a histogram as function of time.
+
+    By default the period is read once for all satellites, the statistics
+    per satellite are written to a summary table and the figures are made
+    in parallel; with --serial every satellite is queried and plotted
+    separately, as before.
 '''
 
 
@@ -11,27 +16,76 @@ import argparse
 import datetime as dt
 import logging
 import time
+from concurrent.futures import ProcessPoolExecutor
 
 import yaml
 
 import plot_ismr
 import plot_ismr_map
-from lib.tools import init_logger, read_yaml, read_confdate
+from lib.tools import init_logger, read_yaml, read_confdate, interpret_svid, get_sqlite_data, rows_to_columns
+from lib.calibration import group_by_svid, calibration_summary
 
-def main():
+SATELLITES = range(1, 137)
+
+
+def render_satellite(args):
     '''
-        Main section of the calibration script
+        Make the histogram plots of one satellite from its rows: (var, timestamp)
     '''
-    print('Put main script in here')
+    plotconfig, sat, plotdata = args
+    plotconfig = dict(plotconfig, satellites=sat, plotdata=plotdata)
+    plot_ismr.hist_plot(plotconfig, log=logging.getLogger())
 
-if __name__ == '__main__':
+    return sat
 
-    main()
+def calibrate_batch(plotconfig, ismrdb, satellites=SATELLITES, workers=4, log=logging):
+    '''
+        Read the period once for all satellites, write the per-satellite
+        statistics to a summary table and plot every satellite (in a pool
+        of workers processes)
+    '''
+    var = plotconfig['plot_var']
+    tabname = plotconfig['tabname'].format(plotconfig['location'])
+    varlist = [var, 'timestamp', 'SVID']
+
+    query_start = time.time()
+    rows = get_sqlite_data(varlist, ismrdb, svid=list(satellites), tstart=plotconfig['startdt'],
+                           tend=plotconfig['enddt'], table=tabname, log=log)
+    sortcols, groups = group_by_svid(rows_to_columns(rows, varlist))
+    log.info('Read {} rows of {} satellites in {:.1f} s'.format(len(rows), len(groups),
+                                                               time.time() - query_start))
+
+    summary = calibration_summary(sortcols, groups, var=var, log=log)
+    os.makedirs(plotconfig['outputdir'], exist_ok=True)
+    summaryfile = os.path.join(plotconfig['outputdir'], 'calibration_{}_{}_{}-{}.csv'.format(var,
+                               plotconfig['location'], plotconfig['startdt'].strftime('%Y%m%d'),
+                               plotconfig['enddt'].strftime('%Y%m%d')))
+    summary.to_csv(summaryfile, index=False, float_format='%.4f')
+    log.info('Wrote summary {}'.format(summaryfile))
+
+    # the figures: every worker gets the rows of one satellite
+    tasks = [(plotconfig, sat, list(zip(sortcols[var][rows], sortcols['timestamp'][rows])))
+             for sat, rows in groups.items()]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for sat in executor.map(render_satellite, tasks):
+            log.debug('Plotted satellite {}'.format(sat))
+    log.info('Plotted {} satellites in {:.1f} s'.format(len(tasks), time.time() - query_start))
+
+    return summary
+
+def main():
+    '''
+        Main section of the calibration script
+    '''
     logger = init_logger()
     logger.info('Plotting data')
 
     parser = argparse.ArgumentParser()
     parser.add_argument("infile", help="the configuration file on what to plot")
+    parser.add_argument("--serial", action='store_true',
+                        help="query and plot every satellite separately")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="number of processes that make the figures")
     args = parser.parse_args()
     logger.debug(args.infile)
 
@@ -44,6 +98,10 @@ if __name__ == '__main__':
     startdate = read_confdate(plotconfig['startdate'])
     enddate = read_confdate(plotconfig['enddate'])
     plot_var = plotconfig['plot_var']
+    if 'satellites' in plotconfig:
+        satellites = [int(sat) for sat in interpret_svid(plotconfig['satellites'])]
+    else:
+        satellites = SATELLITES
 
     # make one dict with the settings to convey to plotting routine
     plotconfig['startdt'] = read_confdate(plotconfig['startdate'])
@@ -54,9 +112,17 @@ if __name__ == '__main__':
     print('plot_var {}, {} - {}'.format(plot_var, startdate, enddate))
     tstart = time.time()
 
-    for sat in range(1,137):
+    if not args.serial:
+        calibrate_batch(plotconfig, ismrdb, satellites=satellites, workers=args.workers, log=logger)
+        return
+
+    for sat in satellites:
         plotconfig['satellites'] = sat
         plot_ismr.hist_plot(plotconfig, log=logger)
 
         tend = time.time()
         print('Satellite: {}, Time elapsed = {} s'.format(sat, tend-tstart))
+
+if __name__ == '__main__':
+
+    main()
@@ -90,11 +90,13 @@ if __name__ == '__main__':
         plot_ismr_map.prepare_map_data(plot_var, ismrdb, svid=plotconfig['satellites'],
                                        tstart=startdate, tend=enddate,
                                        loc=plotconfig['location'], out=plotconfig['outputdir'],
-                                       cmap='hot_r', log=logger)
+                                       cmap='hot_r', window=plotconfig.get('grid_window'), log=logger)
     elif plotconfig['plot_type'] == 'time':
         plot_ismr.time_plot(plot_var, ismrdb, svid=plotconfig['satellites'],
                             tstart=startdate, tend=enddate,
-                            loc=plotconfig['location'], out=plotconfig['outputdir'], log=logger)
+                            loc=plotconfig['location'], out=plotconfig['outputdir'],
+                            table=plotconfig['tabname'].format(plotconfig['location']),
+                            period=plotconfig.get('period'), log=logger)
     elif plotconfig['plot_type'] == 'hist2d':
         if 'satellites' in plotconfig:
             satellites = plotconfig['satellites']
@@ -0,0 +1,65 @@
+#! /usr/bin/env python
+'''
+    Batch job that computes for every satellite and every day the fraction of
+    negative TEC, the lower envelope of the TEC and an estimate of the bias,
+    for the normal and the calibrated (CAL) database, and stores them in a
+    table (see lib.calibration). Trend a satellite with
+    lib.calibration.get_satellite_bias, or with --show SVID.
+'''
+
+import os
+import argparse
+import time
+
+from lib.tools import init_logger, read_yaml, read_confdate
+from lib.calibration import run_bias_job, get_satellite_bias
+from lib.shards import list_shards
+
+# the databases to compare, by source name (formatted with the location)
+SOURCES = {
+    'normal': 'scint_reduced_{}.db',
+    'CAL': 'scint_reduced_{}_CAL.db',
+}
+
+
+def main():
+    '''
+        Run the bias job for the period in the configuration file
+    '''
+    logger = init_logger()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("infile", help="the configuration file with location and period")
+    parser.add_argument("--show", type=int, nargs='*', default=None,
+                        help="only print the stored biases of these SVID")
+    args = parser.parse_args()
+
+    # read where the databases are
+    config = read_yaml('local.yaml')
+    config.update(read_yaml(args.infile))
+    loc = config['location']
+    tabname = config['tabname'].format(loc)
+    sources = config.get('bias_sources', SOURCES)
+    biasdb = os.path.join(config['ismrdb_path'], config.get('biasdb_name', 'satbias_{}.db').format(loc))
+    biastable = 'satbias_{}'.format(loc)
+    tstart = read_confdate(config['startdate'])
+    tend = read_confdate(config['enddate'])
+
+    if args.show is not None:
+        print(get_satellite_bias(biasdb, biastable, svid=args.show or None,
+                                 tstart=tstart, tend=tend).to_string(index=False))
+        return
+
+    for source, dbname in sources.items():
+        ismrdb = os.path.join(config['ismrdb_path'], dbname.format(loc))
+        if not os.path.isfile(ismrdb) and not list_shards(ismrdb):
+            logger.warning('No database {} for {}, skipped'.format(ismrdb, source))
+            continue
+        job_start = time.time()
+        nrrows = run_bias_job(ismrdb, tabname, biasdb, biastable, tstart, tend,
+                              source=source, log=logger)
+        logger.info('{}: {} satellite-days in {:.1f} s'.format(source, nrrows, time.time() - job_start))
+
+if __name__ == '__main__':
+
+    main()
@@ -0,0 +1,219 @@
+#! /usr/bin/env python
+'''
+    Alerting on newly ingested rows: sliding-window statistics per satellite
+    and per constellation (each update is O(1)), and alerts when S4 or TEC
+    exceed a threshold, or change faster than a rate limit. Alerts go to a
+    JSON-lines log and to any other sinks (callables), together with the
+    latency from ingestion to alert.
+
+        monitor = AlertMonitor(station='SABA', logfile='alerts_SABA.jsonl')
+        monitor.process(dataframe, ingest_time=time.time())
+        monitor.latency_report()
+'''
+
+import json
+import time
+import logging
+from collections import deque
+
+import numpy as np
+
+from lib.constants import CONSTELLATIONS
+from lib.tools import svid_to_constellation
+
+# alert when a single value of a satellite exceeds this
+ALERT_THRESHOLDS = {'sig1_S4': 0.5, 'sig2_S4': 0.5, 'sig3_S4': 0.5}
+# alert when the mean over the window of a constellation exceeds this
+CONSTELLATION_THRESHOLDS = {'sig1_S4': 0.3}
+# alert when a variable changes faster than this (per minute) over the window
+RATE_LIMITS = {'sig1_TEC': 5.}
+# length of the sliding windows (s)
+WINDOW = 600.
+# no new alert of the same kind for the same satellite/constellation within this time (s)
+COOLDOWN = 600.
+
+
+class SlidingWindow():
+    '''
+        Values in the last length seconds, with running count, sum and sum of
+        squares; values are expected in time order (older ones are ignored)
+    '''
+    def __init__(self, length=WINDOW):
+        self.length = length
+        self.items = deque()
+        self.count = 0
+        self.sum = 0.
+        self.sumsq = 0.
+        self.late = 0
+
+    def push(self, timestamp, value):
+        if self.items and timestamp < self.items[-1][0]:
+            self.late += 1
+            return False
+        self.items.append((timestamp, value))
+        self.count += 1
+        self.sum += value
+        self.sumsq += value ** 2
+        while self.items[0][0] <= timestamp - self.length:
+            _oldtime, oldvalue = self.items.popleft()
+            self.count -= 1
+            self.sum -= oldvalue
+            self.sumsq -= oldvalue ** 2
+        return True
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else np.nan
+
+    @property
+    def std(self):
+        if self.count < 2:
+            return np.nan
+        return np.sqrt(max(self.sumsq / self.count - self.mean ** 2, 0.) * self.count / (self.count - 1))
+
+    @property
+    def rate(self):
+        '''
+            Change per minute between the first and the last value in the window
+        '''
+        if len(self.items) < 2 or self.items[-1][0] == self.items[0][0]:
+            return np.nan
+        (tfirst, vfirst), (tlast, vlast) = self.items[0], self.items[-1]
+        return (vlast - vfirst) / (tlast - tfirst) * 60.
+
+
+def jsonl_sink(logfile):
+    '''
+        A sink that appends every alert as a line of JSON to logfile
+    '''
+    def _write(alert):
+        with open(logfile, 'a') as alertlog:
+            alertlog.write(json.dumps(alert) + '\n')
+    return _write
+
+
+class AlertMonitor():
+    '''
+        Keep sliding windows of the monitored variables per satellite and per
+        constellation and raise alerts on the rows that are fed to process
+    '''
+    def __init__(self, station='SABA', thresholds=None, constellation_thresholds=None,
+                 rate_limits=None, window=WINDOW, cooldown=COOLDOWN, logfile=None,
+                 sinks=None, log=logging):
+        self.station = station
+        self.thresholds = ALERT_THRESHOLDS if thresholds is None else thresholds
+        self.constellation_thresholds = CONSTELLATION_THRESHOLDS if constellation_thresholds is None \
+                                        else constellation_thresholds
+        self.rate_limits = RATE_LIMITS if rate_limits is None else rate_limits
+        self.window = window
+        self.cooldown = cooldown
+        self.sinks = list(sinks or [])
+        if logfile is not None:
+            self.sinks.append(jsonl_sink(logfile))
+        self.log = log
+
+        self.windows = {}
+        self.last_alert = {}
+        self.latencies = []
+        self.alerts = []
+        self.late = 0
+
+    def _window(self, key):
+        if key not in self.windows:
+            self.windows[key] = SlidingWindow(self.window)
+        return self.windows[key]
+
+    def _variables(self):
+        return set(self.thresholds) | set(self.constellation_thresholds) | set(self.rate_limits)
+
+    def process(self, data, ingest_time=None):
+        '''
+            Update the windows with new rows (a dataframe or dict of columns
+            with timestamp, SVID and the monitored variables) and raise the
+            alerts; ingest_time (time.time() when the rows came in) is used
+            for the latency. Returns the new alerts.
+        '''
+        if ingest_time is None:
+            ingest_time = time.time()
+        timestamps = np.asarray(data['timestamp'], dtype=float)
+        svids = np.asarray(data['SVID']).astype(np.int64)
+        constellations = svid_to_constellation(svids)
+        order = np.argsort(timestamps, kind='mergesort')
+        variables = [var for var in self._variables() if var in data]
+        values = {var: np.asarray(data[var], dtype=float) for var in variables}
+
+        new_alerts = []
+        late = 0
+        for row in order:
+            tstamp, svid, constellation = timestamps[row], int(svids[row]), int(constellations[row])
+            for var in variables:
+                value = values[var][row]
+                if not np.isfinite(value):
+                    continue
+                satwindow = self._window(('svid', svid, var))
+                if not satwindow.push(tstamp, value):
+                    late += 1
+                    continue
+                if var in self.thresholds and value > self.thresholds[var]:
+                    new_alerts.append(self._alert('threshold', var, value, self.thresholds[var],
+                                                  tstamp, ingest_time, svid=svid))
+                if var in self.rate_limits and abs(satwindow.rate) > self.rate_limits[var]:
+                    new_alerts.append(self._alert('rate', var, satwindow.rate, self.rate_limits[var],
+                                                  tstamp, ingest_time, svid=svid))
+                if constellation >= 0 and var in self.constellation_thresholds:
+                    constwindow = self._window(('constellation', constellation, var))
+                    constwindow.push(tstamp, value)
+                    if constwindow.mean > self.constellation_thresholds[var]:
+                        new_alerts.append(self._alert('constellation', var, constwindow.mean,
+                                                      self.constellation_thresholds[var], tstamp,
+                                                      ingest_time, constellation=CONSTELLATIONS[constellation]))
+
+        if late:
+            self.log.warning('Skipped {} values older than the windows of {}'.format(late, self.station))
+            self.late += late
+        new_alerts = [alert for alert in new_alerts if alert is not None]
+        for alert in new_alerts:
+            self.log.warning('ALERT {station} {kind} {var}: {value:.3f} > {limit} ({source}) at {time}, '
+                             'latency {latency:.3f} s'.format(**alert))
+            for sink in self.sinks:
+                sink(alert)
+        self.alerts.extend(new_alerts)
+
+        return new_alerts
+
+    def _alert(self, kind, var, value, limit, tstamp, ingest_time, svid=None, constellation=None):
+        '''
+            Make an alert, None if the same alert was raised within the cooldown
+        '''
+        source = 'SVID {}'.format(svid) if svid is not None else constellation
+        key = (kind, var, source)
+        if key in self.last_alert and tstamp - self.last_alert[key] < self.cooldown:
+            return None
+        self.last_alert[key] = tstamp
+
+        detected = time.time()
+        latency = detected - ingest_time
+        self.latencies.append(latency)
+        return {
+            'station': self.station, 'kind': kind, 'var': var, 'value': float(value),
+            'limit': limit, 'source': source, 'SVID': svid, 'constellation': constellation,
+            'timestamp': float(tstamp), 'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(tstamp)),
+            'detected': detected, 'latency': latency, 'data_age': detected - tstamp,
+        }
+
+    def latency_report(self):
+        '''
+            Summary of the ingestion-to-alert latencies (s), with the number
+            of values that were skipped as late
+        '''
+        if self.late:
+            self.log.warning('{} values came in after newer ones and were skipped'.format(self.late))
+        if not self.latencies:
+            return {'alerts': 0, 'late': self.late}
+        latencies = np.array(self.latencies)
+        report = {'alerts': len(latencies), 'late': self.late, 'mean': np.mean(latencies),
+                  'p50': np.percentile(latencies, 50.), 'p95': np.percentile(latencies, 95.),
+                  'max': np.max(latencies)}
+        self.log.info('Alert latency over {alerts} alerts: mean {mean:.3f} s, median {p50:.3f} s, '
+                      '95% {p95:.3f} s, max {max:.3f} s'.format(**report))
+        return report
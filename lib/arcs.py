@@ -0,0 +1,230 @@
+#! /usr/bin/env python
+'''
+    Satellite passes (arcs): the continuous tracks of a satellite, split where
+    there is a gap in time or the lock time of the receiver is reset. Every
+    row of the data table gets the arc_id of its pass, and a summary of the
+    passes is kept in the table arcs_{table}, updated at ingestion:
+
+        arcs = get_arcs(db, table, tstart, tend, svid=5, min_elevation=40.)
+        dataset = ISMRDataset(db, table, restrictions={'arc_id': {'in': list(arcs['arc_id'])}})
+'''
+
+import logging
+import sqlite3
+import argparse
+
+import numpy as np
+
+from lib.tools import get_sqlite_data, rows_to_columns, read_confdate
+from lib.shards import database_files, connect_readonly
+
+# rows of a satellite more than this many seconds apart are in different passes
+ARC_GAP = 300.
+# the lock time that is used to see a loss of lock
+ARC_LOCKTIME = 'sig1_locktime'
+
+ARC_COLUMNS = ['arc_id', 'SVID', 'tstart', 'tend', 'max_elevation', 'nr_rows']
+
+
+def init_arc_table(cursor, table):
+    '''
+        Create the arcs table of table and its indexes, and the (indexed)
+        arc_id column of table
+    '''
+    cursor.execute('''CREATE TABLE IF NOT EXISTS arcs_{} (
+        arc_id INTEGER PRIMARY KEY, SVID INTEGER, tstart REAL, tend REAL,
+        max_elevation REAL, nr_rows INTEGER
+    )'''.format(table))
+    cursor.execute('CREATE INDEX IF NOT EXISTS "idx_arcs_{0}_tstart" ON arcs_{0} ("tstart")'.format(table))
+    cursor.execute('CREATE INDEX IF NOT EXISTS "idx_arcs_{0}_tend" ON arcs_{0} ("tend")'.format(table))
+    cursor.execute('CREATE INDEX IF NOT EXISTS "idx_arcs_{0}_SVID" ON arcs_{0} ("SVID", "tstart")'.format(table))
+
+    cursor.execute('PRAGMA table_info({})'.format(table))
+    if 'arc_id' not in [col[1] for col in cursor.fetchall()]:
+        cursor.execute('ALTER TABLE {} ADD COLUMN arc_id INTEGER'.format(table))
+    cursor.execute('CREATE INDEX IF NOT EXISTS "idx_arc_id" ON {} ("arc_id")'.format(table))
+
+    return cursor
+
+def segment_arcs(columns, max_gap=ARC_GAP):
+    '''
+        Split the rows in columns (timestamp, SVID, elevation and optionally
+        the lock time) into passes. Returns the pass number of every row (in
+        the order of columns) and a dict of arrays with the passes (SVID,
+        tstart, tend, max_elevation, nr_rows), ordered by SVID and time.
+    '''
+    order = np.lexsort((columns['timestamp'], columns['SVID']))
+    timestamps = columns['timestamp'][order]
+    svids = columns['SVID'][order].astype(np.int64)
+
+    newarc = np.ones(len(order), dtype=bool)
+    newarc[1:] = (svids[1:] != svids[:-1]) | (timestamps[1:] - timestamps[:-1] > max_gap)
+    if ARC_LOCKTIME in columns:
+        # the lock time drops when the receiver has lost the satellite in between
+        locktime = columns[ARC_LOCKTIME][order]
+        with np.errstate(invalid='ignore'):
+            newarc[1:] |= locktime[1:] < locktime[:-1]
+    start = np.flatnonzero(newarc)
+
+    arc_of_row = np.empty(len(order), dtype=np.int64)
+    arc_of_row[order] = np.cumsum(newarc) - 1
+    if len(start):
+        elevation = np.where(np.isnan(columns['elevation'][order]), -np.inf, columns['elevation'][order])
+        max_elevation = np.maximum.reduceat(elevation, start)
+        max_elevation[np.isinf(max_elevation)] = np.nan
+    else:
+        max_elevation = np.zeros(0)
+    arcs = {
+        'SVID': svids[start],
+        'tstart': timestamps[start],
+        'tend': timestamps[np.append(start[1:], len(order)) - 1],
+        'max_elevation': max_elevation,
+        'nr_rows': np.diff(np.append(start, len(order))),
+    }
+
+    return arc_of_row, arcs
+
+def _neighbours(cursor, table, svid, wstart, wend, max_gap):
+    '''
+        The earliest start and latest end of the stored passes of svid that
+        are within max_gap of the window
+    '''
+    cursor.execute('SELECT MIN(tstart), MAX(tend) FROM arcs_{} '
+                   'WHERE SVID = ? AND tend >= ? AND tstart <= ?'.format(table),
+                   (svid, wstart - max_gap, wend + max_gap))
+    return cursor.fetchone()
+
+def update_arcs(db, table, tstart, tend, max_gap=ARC_GAP, log=logging):
+    '''
+        (Re)segment the passes around tstart - tend (timestamps): for every
+        satellite with rows in it, the window is extended over its stored
+        passes next to those rows (the new rows may join them), those passes
+        are replaced and the arc_id of the rows is set. A pass that starts at
+        the same time as before keeps its arc_id.
+    '''
+    conn = sqlite3.connect(db)
+    c = conn.cursor()
+    init_arc_table(c, table)
+    c.execute('PRAGMA table_info({})'.format(table))
+    varlist = ['rowid', 'timestamp', 'SVID', 'elevation']
+    if ARC_LOCKTIME in [col[1] for col in c.fetchall()]:
+        varlist.append(ARC_LOCKTIME)
+    conn.commit()
+
+    # the window of every satellite with new rows, up to its neighbouring passes
+    new = rows_to_columns(get_sqlite_data(['SVID', 'timestamp'], db, svid=None, tstart=float(tstart),
+                                          tend=float(tend), table=table, log=log), ['SVID', 'timestamp'])
+    windows = {}
+    for svid in np.unique(new['SVID']).astype(np.int64):
+        times = new['timestamp'][new['SVID'] == svid]
+        wstart, wend = float(times.min()), float(times.max())
+        first, last = _neighbours(c, table, int(svid), wstart, wend, max_gap)
+        if first is not None:
+            wstart, wend = min(wstart, first), max(wend, last)
+        windows[int(svid)] = (wstart, wend)
+    if not windows:
+        conn.close()
+        return 0
+
+    rows = get_sqlite_data(varlist, db, svid=sorted(windows), tstart=min(win[0] for win in windows.values()),
+                           tend=max(win[1] for win in windows.values()), table=table, log=log)
+    columns = rows_to_columns(rows, varlist)
+    inside = np.zeros(len(columns['timestamp']), dtype=bool)
+    for svid, (wstart, wend) in windows.items():
+        inside |= (columns['SVID'] == svid) & (columns['timestamp'] >= wstart) & (columns['timestamp'] <= wend)
+    columns = {var: coldata[inside] for var, coldata in columns.items()}
+    arc_of_row, arcs = segment_arcs(columns, max_gap=max_gap)
+
+    # the passes that are replaced, their arc_id is reused for the same start
+    previous = {}
+    for svid, (wstart, wend) in windows.items():
+        c.execute('SELECT arc_id, SVID, tstart FROM arcs_{} '
+                  'WHERE SVID = ? AND tend >= ? AND tstart <= ?'.format(table), (svid, wstart, wend))
+        previous.update({(sv, start): arc_id for arc_id, sv, start in c.fetchall()})
+    c.execute('SELECT MAX(arc_id) FROM arcs_{}'.format(table))
+    next_id = (c.fetchone()[0] or 0) + 1
+    c.executemany('DELETE FROM arcs_{} WHERE SVID = ? AND tend >= ? AND tstart <= ?'.format(table),
+                  [(svid, wstart, wend) for svid, (wstart, wend) in windows.items()])
+
+    arc_ids = np.empty(len(arcs['SVID']), dtype=np.int64)
+    for idx, (svid, start) in enumerate(zip(arcs['SVID'], arcs['tstart'])):
+        arc_id = previous.pop((int(svid), float(start)), None)
+        if arc_id is None:
+            arc_id, next_id = next_id, next_id + 1
+        arc_ids[idx] = arc_id
+
+    c.executemany('INSERT INTO arcs_{} VALUES (?, ?, ?, ?, ?, ?)'.format(table),
+                  [(int(arc_ids[idx]), int(arcs['SVID'][idx]), float(arcs['tstart'][idx]),
+                    float(arcs['tend'][idx]),
+                    None if np.isnan(arcs['max_elevation'][idx]) else float(arcs['max_elevation'][idx]),
+                    int(arcs['nr_rows'][idx])) for idx in range(len(arc_ids))])
+    row_arc_ids = arc_ids[arc_of_row]
+    c.executemany('UPDATE {} SET arc_id = ? WHERE rowid = ?'.format(table),
+                  zip(row_arc_ids.tolist(), columns['rowid'].astype(np.int64).tolist()))
+    conn.commit()
+    conn.close()
+    log.debug('{} passes of {} satellites, {} rows around {} - {}'.format(len(arc_ids), len(windows),
+                                                                         len(arc_of_row), tstart, tend))
+
+    return len(arc_ids)
+
+def get_arcs(db, table, tstart=None, tend=None, svid=None, min_elevation=None, min_rows=None):
+    '''
+        The passes (as a dict of arrays) that overlap tstart - tend (datetimes
+        or timestamps), optionally with a minimal maximum elevation or number
+        of rows; from the shards of db if it is sharded
+    '''
+    sql_crit, sql_params = [], []
+    if tstart is not None:
+        if hasattr(tstart, 'timestamp'):
+            tstart, tend = tstart.timestamp(), tend.timestamp()
+        sql_crit.append('tend >= ? AND tstart <= ?')
+        sql_params.extend([tstart, tend])
+    if svid is not None:
+        svids = [int(sv) for sv in np.atleast_1d(svid)]
+        sql_crit.append('SVID IN ({})'.format(','.join('?' * len(svids))))
+        sql_params.extend(svids)
+    if min_elevation is not None:
+        sql_crit.append('max_elevation >= ?')
+        sql_params.append(min_elevation)
+    if min_rows is not None:
+        sql_crit.append('nr_rows >= ?')
+        sql_params.append(min_rows)
+
+    sql_stat = 'SELECT {} FROM arcs_{}'.format(','.join(ARC_COLUMNS), table)
+    if sql_crit:
+        sql_stat += ' WHERE ' + ' AND '.join(sql_crit)
+    sql_stat += ' ORDER BY tstart'
+
+    rows = []
+    for dbfile in database_files(db, tstart, tend):
+        conn = connect_readonly(dbfile)
+        c = conn.cursor()
+        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", ('arcs_{}'.format(table),))
+        if c.fetchone() is not None:
+            c.execute(sql_stat, sql_params)
+            rows.extend(c.fetchall())
+        conn.close()
+    # one list in time order over the shards
+    rows.sort(key=lambda row: row[ARC_COLUMNS.index('tstart')])
+
+    arcs = {col: np.array([row[idx] for row in rows]) for idx, col in enumerate(ARC_COLUMNS)}
+    return arcs
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("db", help="the database in which to (re)build the passes")
+    parser.add_argument("loc", help="the station, e.g. SABA")
+    parser.add_argument("startdate", nargs=6, type=int, help="start, e.g. 2020 10 30 0 0 0")
+    parser.add_argument("enddate", nargs=6, type=int, help="end")
+    parser.add_argument("--table", default='sep_data_{}', help="the data table")
+    parser.add_argument("--gap", type=float, default=ARC_GAP, help="split passes more than this (s) apart")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    nrarcs = update_arcs(args.db, args.table.format(args.loc),
+                         read_confdate(args.startdate).timestamp(),
+                         read_confdate(args.enddate).timestamp(), max_gap=args.gap)
+    logging.info('{} passes in this period'.format(nrarcs))
@@ -0,0 +1,196 @@
+#! /usr/bin/env python
+'''
+    Per-satellite statistics for the calibration of the TEC: how often, and how
+    far, the TEC of a satellite is negative, and the bias that would be needed
+    to bring it back to zero. All satellites are handled from one set of
+    columns, grouped by SVID.
+
+    The daily statistics (per UTC day and satellite) of the normal and the
+    calibrated (CAL) databases are kept in a bias table, so the biases can be
+    followed in time without making plots.
+'''
+
+import logging
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from lib.tools import get_sqlite_data, rows_to_columns
+
+# the bias is the shift that brings this (low) percentile of the TEC to zero
+BIAS_PERCENTILE = 1.
+
+SUMMARY_COLUMNS = ['SVID', 'count', 'negative', 'negative_fraction', 'mean', 'median',
+                   'std', 'min', 'p{:g}'.format(BIAS_PERCENTILE), 'bias']
+
+# the columns of the daily bias table (with 'source': normal or CAL)
+BIAS_COLUMNS = ['source', 'day', 'SVID', 'count', 'negative', 'negative_fraction',
+                'min', 'plow', 'median', 'bias']
+
+
+def group_by_svid(columns):
+    '''
+        Sort the columns by SVID (and time within a satellite) and give the sorted
+        columns with a dict of SVID: slice into them
+    '''
+    order = np.lexsort((columns['timestamp'], columns['SVID']))
+    sortcols = {var: coldata[order] for var, coldata in columns.items()}
+    svids, first = np.unique(sortcols['SVID'], return_index=True)
+    last = np.append(first[1:], len(order))
+
+    return sortcols, {int(svid): slice(start, stop) for svid, start, stop in zip(svids, first, last)}
+
+def satellite_statistics(values):
+    '''
+        Negative-TEC statistics and bias estimate of the values of one satellite
+        (NaN is skipped); the bias is 0 if the low percentile is not negative
+    '''
+    values = values[np.isfinite(values)]
+    stats = dict.fromkeys(SUMMARY_COLUMNS[1:], np.nan)
+    stats['count'] = len(values)
+    stats['negative'] = 0
+    if len(values) == 0:
+        return stats
+
+    low, median = np.percentile(values, [BIAS_PERCENTILE, 50.])
+    stats['negative'] = int(np.sum(values < 0.))
+    stats['negative_fraction'] = stats['negative'] / len(values)
+    stats['mean'] = np.mean(values)
+    stats['median'] = median
+    stats['std'] = np.std(values)
+    stats['min'] = np.min(values)
+    stats['p{:g}'.format(BIAS_PERCENTILE)] = low
+    stats['bias'] = max(0., -low)
+
+    return stats
+
+def calibration_summary(sortcols, groups, var='sig1_TEC', svids=None, log=logging):
+    '''
+        The statistics of var for every satellite in the grouped columns (see
+        group_by_svid), or only for svids, as a dataframe with a row per SVID
+    '''
+    records = []
+    for svid, rows in groups.items():
+        if svids is not None and svid not in svids:
+            continue
+        stats = satellite_statistics(sortcols[var][rows])
+        stats['SVID'] = svid
+        records.append(stats)
+    log.debug('Calibration statistics of {} satellites'.format(len(records)))
+
+    return pd.DataFrame.from_records(records, columns=SUMMARY_COLUMNS)
+
+def daily_statistics(columns, var='sig1_TEC'):
+    '''
+        Vectorized statistics of var per (UTC) day and SVID: a dict of arrays
+        with day, SVID, count, negative, negative_fraction, min (the lower
+        envelope), plow (the BIAS_PERCENTILE percentile), median and bias
+    '''
+    values = columns[var]
+    valid = np.isfinite(values)
+    values = values[valid]
+    days = (np.floor(columns['timestamp'][valid] / 86400.) * 86400.).astype(np.int64)
+    svids = columns['SVID'][valid].astype(np.int64)
+
+    # sorted by day, satellite and value: minimum and percentiles are at known positions
+    order = np.lexsort((values, svids, days))
+    values, days, svids = values[order], days[order], svids[order]
+    newgroup = np.ones(len(values), dtype=bool)
+    newgroup[1:] = (days[1:] != days[:-1]) | (svids[1:] != svids[:-1])
+    start = np.flatnonzero(newgroup)
+    counts = np.diff(np.append(start, len(values)))
+
+    def _percentile(pct):
+        rank = start + (counts - 1) * pct / 100.
+        below = np.floor(rank).astype(np.int64)
+        above = np.minimum(below + 1, start + counts - 1)
+        return values[below] + (rank - below) * (values[above] - values[below])
+
+    negative = np.add.reduceat((values < 0.).astype(np.int64), start) if len(values) else np.array([], dtype=np.int64)
+    plow = _percentile(BIAS_PERCENTILE)
+    return {
+        'day': days[start],
+        'SVID': svids[start],
+        'count': counts,
+        'negative': negative,
+        'negative_fraction': negative / np.maximum(counts, 1),
+        'min': values[start],
+        'plow': plow,
+        'median': _percentile(50.),
+        'bias': np.maximum(0., -plow),
+    }
+
+def init_bias_table(cursor, tabname='satbias_SABA'):
+    '''
+        Create the table with daily per-satellite statistics
+    '''
+    cursor.execute('''CREATE TABLE IF NOT EXISTS {} (
+        source TEXT, day INTEGER, SVID INTEGER, count INTEGER, negative INTEGER,
+        negative_fraction REAL, min REAL, plow REAL, median REAL, bias REAL,
+        PRIMARY KEY (source, day, SVID)
+    )'''.format(tabname))
+
+    return cursor
+
+def run_bias_job(ismrdb, table, biasdb, biastable, tstart, tend, source='normal',
+                 var='sig1_TEC', chunkdays=7, log=logging):
+    '''
+        Compute the daily statistics of var for all satellites in ismrdb for the
+        (UTC) days of tstart - tend, in chunks of chunkdays days, and store them
+        in biastable of biasdb under source (existing days are replaced).
+        Returns the number of (day, satellite) rows written.
+    '''
+    if hasattr(tstart, 'timestamp'):
+        tstart, tend = tstart.timestamp(), tend.timestamp()
+    first = np.floor(tstart / 86400.) * 86400.
+
+    conn = sqlite3.connect(biasdb)
+    c = conn.cursor()
+    init_bias_table(c, biastable)
+    varlist = [var, 'SVID', 'timestamp']
+    nrrows = 0
+    for chunkstart in np.arange(first, tend, chunkdays * 86400.):
+        chunkend = min(chunkstart + chunkdays * 86400., np.floor(tend / 86400.) * 86400. + 86400.)
+        rows = get_sqlite_data(varlist, ismrdb, svid=None, tstart=float(chunkstart),
+                               tend=float(chunkend) - 1.e-3, table=table, log=log)
+        stats = daily_statistics(rows_to_columns(rows, varlist), var=var)
+        records = [(source,) + tuple(stats[col][idx].item() for col in BIAS_COLUMNS[1:])
+                   for idx in range(len(stats['day']))]
+        c.executemany('INSERT OR REPLACE INTO {} VALUES ({})'.format(biastable, ','.join('?' * len(BIAS_COLUMNS))),
+                      records)
+        conn.commit()
+        nrrows += len(records)
+        log.debug('Bias job {}: {} rows for {} days from {}'.format(source, len(records), chunkdays, chunkstart))
+    conn.close()
+
+    return nrrows
+
+def get_satellite_bias(biasdb, biastable, svid=None, source=None, tstart=None, tend=None):
+    '''
+        Read the daily statistics back (e.g. to follow the bias of a satellite
+        in time), as a dataframe sorted by source, SVID and day
+    '''
+    sql_stat = 'SELECT {} FROM {}'.format(','.join(BIAS_COLUMNS), biastable)
+    sql_crit, sql_params = [], []
+    if svid is not None:
+        svids = [int(sv) for sv in np.atleast_1d(svid)]
+        sql_crit.append('SVID IN ({})'.format(','.join('?' * len(svids))))
+        sql_params.extend(svids)
+    if source is not None:
+        sql_crit.append('source = ?')
+        sql_params.append(source)
+    if tstart is not None:
+        if hasattr(tstart, 'timestamp'):
+            tstart, tend = tstart.timestamp(), tend.timestamp()
+        sql_crit.append('day BETWEEN ? AND ?')
+        sql_params.extend([np.floor(tstart / 86400.) * 86400., tend])
+    if sql_crit:
+        sql_stat += ' WHERE ' + ' AND '.join(sql_crit)
+    sql_stat += ' ORDER BY source, SVID, day'
+
+    conn = sqlite3.connect(biasdb)
+    bias = pd.read_sql_query(sql_stat, conn, params=sql_params)
+    conn.close()
+
+    return bias
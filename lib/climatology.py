@@ -0,0 +1,228 @@
+#! /usr/bin/env python
+'''
+    Climatological baselines: the mean and standard deviation of a variable per
+    SVID (or constellation), season and hour of the day, kept as sums so that
+    new days can be added without reading the old ones again. The baseline is
+    saved as a versioned .npz file; anomalies of any period are computed
+    against it without scanning the climatology period.
+
+        clim = Climatology.load_or_create(path, 'sig1_TEC', group='svid')
+        update_climatology(clim, db, table, clim_start, clim_end)
+        clim.save(path)
+        columns = get_anomalies(clim, db, table, tstart, tend)
+'''
+
+import os
+import logging
+
+import numpy as np
+
+from lib.constants import CONSTELLATIONS
+from lib.tools import svid_to_constellation, get_sqlite_data, rows_to_columns
+from lib.streaming import iter_sqlite_data
+from lib.rolling import rolling_columns, outlier_mask
+
+# the version of the file format: files of another version are not read
+# (version 2: hours of the day in UTC, not in the local time of the host)
+CLIM_VERSION = 2
+# meteorological seasons: DJF, MAM, JJA, SON
+SEASONS = ['DJF', 'MAM', 'JJA', 'SON']
+# the number of groups: every possible SVID, or every constellation
+NR_GROUPS = {'svid': 256, 'constellation': len(CONSTELLATIONS)}
+
+
+def season_of(timestamps):
+    '''
+        Season index (see SEASONS) of timestamps, by the (UTC) month
+    '''
+    months = np.asarray(timestamps, dtype=float).astype('datetime64[s]').astype('datetime64[M]')
+    return (months.astype(np.int64) % 12 + 1) % 12 // 3
+
+def hour_of_day(timestamps):
+    '''
+        Hour of the day (UTC) of timestamps: the same on every host
+    '''
+    return (np.floor(np.asarray(timestamps, dtype=float)) % 86400 // 3600).astype(np.int64)
+
+
+class Climatology():
+    '''
+        Count, sum and sum of squares of var per (group, season, hour of day),
+        and the (UTC) days that have been added
+    '''
+    def __init__(self, var, group='svid'):
+        if group not in NR_GROUPS:
+            raise ValueError('Unknown grouping {}, use svid or constellation'.format(group))
+        self.var = var
+        self.group = group
+        self.revision = 0
+        self.days = set()
+        shape = (NR_GROUPS[group], len(SEASONS), 24)
+        self.count = np.zeros(shape, dtype=np.int64)
+        self.sum = np.zeros(shape)
+        self.sumsq = np.zeros(shape)
+
+    def _cells(self, columns):
+        '''
+            The flat (group, season, hour) cell of every row, -1 where unknown
+        '''
+        svid = columns['SVID']
+        if self.group == 'svid':
+            grp = svid.astype(np.int64)
+            grp[(grp < 0) | (grp >= NR_GROUPS['svid'])] = -1
+        else:
+            grp = svid_to_constellation(svid)
+        cells = np.ravel_multi_index((np.maximum(grp, 0), season_of(columns['timestamp']),
+                                      hour_of_day(columns['timestamp'])), self.count.shape)
+        cells[grp < 0] = -1
+        return cells
+
+    def update(self, batch):
+        '''
+            Add the rows of a batch (dict of columns with var, SVID and timestamp)
+        '''
+        values = batch[self.var]
+        cells = self._cells(batch)
+        valid = np.isfinite(values) & (cells >= 0)
+        size = self.count.size
+        self.count += np.bincount(cells[valid], minlength=size).reshape(self.count.shape)
+        self.sum += np.bincount(cells[valid], weights=values[valid], minlength=size).reshape(self.count.shape)
+        self.sumsq += np.bincount(cells[valid], weights=values[valid] ** 2,
+                                  minlength=size).reshape(self.count.shape)
+
+    def merge(self, other):
+        if (other.var, other.group) != (self.var, self.group):
+            raise ValueError('Cannot merge a climatology of {} per {} with {} per {}'.format(
+                             other.var, other.group, self.var, self.group))
+        overlap = self.days & other.days
+        if overlap:
+            raise ValueError('Both climatologies contain {} day(s), e.g. {}'.format(len(overlap), min(overlap)))
+        self.count += other.count
+        self.sum += other.sum
+        self.sumsq += other.sumsq
+        self.days |= other.days
+        self.revision += 1
+
+    @property
+    def mean(self):
+        '''
+            The baseline: mean per (group, season, hour), NaN without data
+        '''
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.sum / self.count
+
+    @property
+    def std(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            variance = (self.sumsq - self.count * self.mean ** 2) / (self.count - 1)
+        return np.sqrt(np.maximum(variance, 0.))
+
+    def anomaly(self, columns, standardise=False):
+        '''
+            Difference of var in columns from the baseline (divided by the
+            standard deviation if standardise), NaN where there is no baseline
+        '''
+        cells = self._cells(columns)
+        known = cells >= 0
+        baseline = np.full(len(cells), np.nan)
+        baseline[known] = self.mean.ravel()[cells[known]]
+        anomaly = columns[self.var] - baseline
+        if standardise:
+            spread = np.full(len(cells), np.nan)
+            spread[known] = self.std.ravel()[cells[known]]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                anomaly = anomaly / spread
+        return anomaly
+
+    def save(self, path):
+        '''
+            Save as .npz (with the format version and the revision)
+        '''
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        np.savez_compressed(path, version=CLIM_VERSION, revision=self.revision,
+                            var=self.var, group=self.group,
+                            days=np.array(sorted(self.days), dtype=np.int64),
+                            count=self.count, sum=self.sum, sumsq=self.sumsq)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            if int(data['version']) != CLIM_VERSION:
+                raise ValueError('Climatology {} has version {}, expected {}'.format(
+                                 path, int(data['version']), CLIM_VERSION))
+            clim = cls(str(data['var']), group=str(data['group']))
+            clim.revision = int(data['revision'])
+            clim.days = set(int(day) for day in data['days'])
+            clim.count = data['count']
+            clim.sum = data['sum']
+            clim.sumsq = data['sumsq']
+        return clim
+
+    @classmethod
+    def load_or_create(cls, path, var, group='svid', log=logging):
+        '''
+            Load the climatology in path if it is there, of the right version
+            and for var and group; otherwise start a new one
+        '''
+        if os.path.isfile(path):
+            try:
+                clim = cls.load(path)
+                if (clim.var, clim.group) == (var, group):
+                    log.debug('Climatology {} revision {} with {} days'.format(path, clim.revision,
+                                                                              len(clim.days)))
+                    return clim
+                log.warning('Climatology {} is of {} per {}, start a new one'.format(path, clim.var, clim.group))
+            except ValueError as verr:
+                log.warning('{}, start a new one'.format(verr))
+        return cls(var, group=group)
+
+
+def update_climatology(clim, db, table, tstart, tend, despike=None, nsigma=3., log=logging):
+    '''
+        Add the (UTC) days that lie completely in tstart - tend (datetimes or
+        timestamps) and are not in the climatology yet; all satellites are used.
+        Days without rows (not ingested yet) are left for a later update.
+        With despike (s), values more than nsigma robust standard deviations
+        from the rolling median over despike s of their pass are left out
+        (passes are split at the edges of the batches that are read).
+        Returns the number of days added.
+    '''
+    if hasattr(tstart, 'timestamp'):
+        tstart, tend = tstart.timestamp(), tend.timestamp()
+    days = np.arange(np.ceil(tstart / 86400.), np.floor(tend / 86400.)) * 86400.
+    new_days = [int(day) for day in days if int(day) not in clim.days]
+    if not new_days:
+        log.debug('Climatology of {} is up to date'.format(clim.var))
+        return 0
+
+    added = Climatology(clim.var, group=clim.group)
+    seen = set()
+    varlist = [clim.var, 'SVID', 'timestamp']
+    for batch in iter_sqlite_data(varlist, db, svid=None, tstart=float(new_days[0]),
+                                  tend=new_days[-1] + 86400. - 1.e-3, table=table, log=log):
+        rowdays = (np.floor(batch['timestamp'] / 86400.) * 86400.).astype(np.int64)
+        keep = np.isin(rowdays, new_days)
+        if despike is not None:
+            stats = rolling_columns(batch, clim.var, despike, stats=['median', 'mad'], log=log)
+            keep &= ~outlier_mask(batch[clim.var], stats['median'], stats['mad'], nsigma=nsigma)
+        added.update({var: coldata[keep] for var, coldata in batch.items()})
+        seen.update(int(day) for day in np.unique(rowdays[keep]))
+    added.days = seen
+    clim.merge(added)
+    log.info('Added {} of {} days to the climatology of {}'.format(len(seen), len(new_days), clim.var))
+
+    return len(seen)
+
+def get_anomalies(clim, db, table, tstart, tend, svid=None, standardise=False, log=logging):
+    '''
+        Read var of the climatology for tstart - tend and give the columns
+        (var, SVID, timestamp) with the anomaly added
+    '''
+    varlist = [clim.var, 'SVID', 'timestamp']
+    rows = get_sqlite_data(varlist, db, svid=svid, tstart=tstart, tend=tend, table=table,
+                           order_by=['timestamp', 'SVID'], log=log)
+    columns = rows_to_columns(rows, varlist)
+    columns['anomaly'] = clim.anomaly(columns, standardise=standardise)
+
+    return columns
@@ -35,7 +35,11 @@ NAMES = ['azimuth', 'elevation',
 REDUCED_NAMES = ['azimuth', 'elevation', 'sig1_TEC',
                  'sig1_S4', 'sig1_S4_corr',
                  'sig2_S4', 'sig2_S4_corr',
-                 'sig3_S4', 'sig3_S4_corr',]
+                 'sig3_S4', 'sig3_S4_corr',
+                 'sig1_phi60', 'sig2_phi60', 'sig3_phi60',
+                 'sig1_locktime',
+                 'sig1_TEC_m45', 'sig1_TEC_m30', 'sig1_TEC_m15',
+                 'sig1_dTEC_m60_m45', 'sig1_dTEC_m45_m30', 'sig1_dTEC_m30_m15', 'sig1_dTEC_m15_0',]
 
 # locations of the septentrio GNSS receivers on Saba and St Eustatius:
 TOPO = {
@@ -43,5 +47,16 @@ TOPO = {
         'SEUT': (17.47140, -62.97570),
         }
 
+# range of satellite ID's (SVID) per constellation: (first, last + 1)
+SATRANGE = {
+        'gps': (1, 38),
+        'glonass': (38, 62),
+        'galileo': (71, 103),
+        'sbas': (120, 141),
+        'compass': (141, 173),
+        'qzss': (180, 188),
+        }
+CONSTELLATIONS = ['gps', 'glonass', 'galileo', 'sbas', 'compass', 'qzss']
+
 # radius of the Earth
 R_earth = 6378.100   # km
@@ -0,0 +1,251 @@
+#! /usr/bin/env python
+'''
+    Time lag between the series of two stations (SABA and SEUT are about
+    30 km apart): irregularities that drift over both give the same S4/TEC
+    signature, shifted by the drift time. The series per satellite are put
+    on a common grid, cut in overlapping windows and cross-correlated with
+    FFTs, for all satellites and windows at once. The lag of the peak and
+    its correlation are stored per (satellite, window) in the table
+    crosslag, see get_crosslag. For a period run
+
+        python -m lib.crosslag 2020 10 30 0 0 0 2020 11 6 0 0 0 --var sig1_TEC
+'''
+
+import os
+import logging
+import sqlite3
+import argparse
+
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+from lib.constants import TOPO, R_earth
+from lib.tools import read_yaml, read_confdate
+from lib.multistation import get_multistation_data
+
+# the grid of the series (s)
+CADENCE = 60.
+# length of a window and the step between windows (samples)
+LAG_WINDOW = 60
+LAG_HOP = 10
+# the largest lag (samples) that is looked for
+MAX_LAG = 10
+# the minimal fraction of a window that both stations must have
+MIN_VALID = 0.8
+
+CROSSLAG_COLUMNS = ['var', 'station1', 'station2', 'SVID', 'tstart', 'lag', 'correlation',
+                    'nr_samples', 'apparent_velocity']
+
+
+def station_distance(station1, station2):
+    '''
+        Great-circle distance between two stations (km)
+    '''
+    lat1, lon1 = np.radians(TOPO[station1])
+    lat2, lon2 = np.radians(TOPO[station2])
+    angle = 2. * np.arcsin(np.sqrt(np.sin((lat2 - lat1) / 2.) ** 2 +
+                                   np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2.) ** 2))
+    return R_earth * angle
+
+def align_series(timestamps, svids, values, tstart, nslots, cadence=CADENCE):
+    '''
+        Put the values on a grid of nslots of cadence s from tstart, one row
+        per satellite: returns (svids, array of shape (satellites, nslots))
+        with NaN where there is no value
+    '''
+    slots = np.round((timestamps - tstart) / cadence).astype(np.int64)
+    inside = (slots >= 0) & (slots < nslots)
+    satellites, satrow = np.unique(svids[inside].astype(np.int64), return_inverse=True)
+    series = np.full((len(satellites), nslots), np.nan)
+    series[satrow, slots[inside]] = values[inside]
+    return satellites, series
+
+def windowed_lags(series1, series2, window=LAG_WINDOW, hop=LAG_HOP, max_lag=MAX_LAG,
+                  min_valid=MIN_VALID):
+    '''
+        Cross-correlate two arrays (satellites, slots) in windows of window
+        slots every hop slots. Returns lag (in slots, with a parabolic
+        refinement of the peak, positive when series2 follows series1),
+        correlation at the peak and number of valid samples, each of shape
+        (satellites, windows); NaN for windows with too few valid samples.
+    '''
+    seg1 = sliding_window_view(series1, window, axis=-1)[:, ::hop, :]
+    seg2 = sliding_window_view(series2, window, axis=-1)[:, ::hop, :]
+    valid = np.isfinite(seg1) & np.isfinite(seg2)
+    nvalid = valid.sum(axis=-1)
+
+    def _normalise(seg):
+        seg = np.where(valid, seg, 0.)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = seg.sum(axis=-1, keepdims=True) / nvalid[..., np.newaxis]
+            seg = np.where(valid, seg - mean, 0.)
+            std = np.sqrt((seg ** 2).sum(axis=-1, keepdims=True) / nvalid[..., np.newaxis])
+            return seg / std
+
+    norm1, norm2 = _normalise(seg1), _normalise(seg2)
+    # zero padding to 2 * window: no wrap-around of the lags
+    nfft = 2 * window
+    xcorr = np.fft.irfft(np.conj(np.fft.rfft(norm1, nfft, axis=-1)) * np.fft.rfft(norm2, nfft, axis=-1),
+                         nfft, axis=-1)
+    # lags -max_lag ... max_lag
+    xcorr = np.concatenate([xcorr[..., -max_lag:], xcorr[..., :max_lag + 1]], axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        xcorr = xcorr / nvalid[..., np.newaxis]
+
+    usable = (nvalid >= min_valid * window) & np.all(np.isfinite(xcorr), axis=-1)
+    peak = np.argmax(np.where(np.isfinite(xcorr), xcorr, -np.inf), axis=-1)
+    correlation = np.take_along_axis(xcorr, peak[..., np.newaxis], axis=-1)[..., 0]
+
+    # parabola through the peak and its neighbours, where it has both
+    inner = np.clip(peak, 1, 2 * max_lag - 1)
+    left = np.take_along_axis(xcorr, (inner - 1)[..., np.newaxis], axis=-1)[..., 0]
+    centre = np.take_along_axis(xcorr, inner[..., np.newaxis], axis=-1)[..., 0]
+    right = np.take_along_axis(xcorr, (inner + 1)[..., np.newaxis], axis=-1)[..., 0]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        shift = 0.5 * (left - right) / (left - 2. * centre + right)
+    refine = (peak == inner) & np.isfinite(shift) & (np.abs(shift) < 1.)
+    lag = peak - max_lag + np.where(refine, shift, 0.)
+
+    lag[~usable] = np.nan
+    correlation[~usable] = np.nan
+    return lag, correlation, nvalid
+
+def crosslag(columns1, columns2, var, tstart, tend, cadence=CADENCE, window=LAG_WINDOW,
+             hop=LAG_HOP, max_lag=MAX_LAG):
+    '''
+        The lags of var between two stations (dicts of columns with
+        timestamp, SVID and var) for the satellites they have in common.
+        Returns a dict of arrays: SVID, tstart (of the window), lag (s),
+        correlation, nr_samples.
+    '''
+    nslots = int(np.floor((tend - tstart) / cadence)) + 1
+    sats1, series1 = align_series(columns1['timestamp'], columns1['SVID'], columns1[var], tstart, nslots, cadence)
+    sats2, series2 = align_series(columns2['timestamp'], columns2['SVID'], columns2[var], tstart, nslots, cadence)
+    common, idx1, idx2 = np.intersect1d(sats1, sats2, return_indices=True)
+    result = {key: np.zeros(0) for key in ['SVID', 'tstart', 'lag', 'correlation', 'nr_samples']}
+    if len(common) == 0 or nslots < window:
+        return result
+
+    lag, correlation, nvalid = windowed_lags(series1[idx1], series2[idx2], window=window, hop=hop,
+                                             max_lag=max_lag)
+    nwindows = lag.shape[1]
+    keep = np.isfinite(lag)
+    result['SVID'] = np.repeat(common, nwindows).reshape(lag.shape)[keep]
+    result['tstart'] = np.tile(tstart + cadence * hop * np.arange(nwindows), len(common)).reshape(lag.shape)[keep]
+    result['lag'] = lag[keep] * cadence
+    result['correlation'] = correlation[keep]
+    result['nr_samples'] = nvalid[keep]
+    return result
+
+def init_crosslag_table(cursor):
+    '''
+        Create the table of the lags and its index on time
+    '''
+    cursor.execute('''CREATE TABLE IF NOT EXISTS crosslag (
+        var TEXT, station1 TEXT, station2 TEXT, SVID INTEGER, tstart REAL,
+        lag REAL, correlation REAL, nr_samples INTEGER, apparent_velocity REAL,
+        PRIMARY KEY (var, station1, station2, SVID, tstart)
+    )''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS "idx_crosslag_tstart" ON crosslag ("tstart")')
+
+    return cursor
+
+def run_crosslag(ismrdb_path, ismrdb_name, lagdb, tstart, tend, var='sig1_S4', stations=('SABA', 'SEUT'),
+                 tabname='sep_data_{}', chunkdays=1, log=logging):
+    '''
+        Compute the lags of var between two stations for tstart - tend
+        (datetimes or timestamps) in chunks of chunkdays days, and store them
+        in lagdb (existing windows are replaced). A chunk is read with the
+        overlap that its last windows need and keeps the windows that start
+        in it. Returns the number of windows stored.
+    '''
+    if hasattr(tstart, 'timestamp'):
+        tstart, tend = tstart.timestamp(), tend.timestamp()
+    station1, station2 = stations
+    distance = station_distance(station1, station2) * 1.e3
+
+    conn = sqlite3.connect(lagdb)
+    c = conn.cursor()
+    init_crosslag_table(c)
+    varlist = ['timestamp', 'SVID', var]
+    # the windows that start at the end of a chunk reach this far into the next one
+    overlap = (LAG_WINDOW - LAG_HOP) * CADENCE
+    nrwindows = 0
+    for chunkstart in np.arange(tstart, tend, chunkdays * 86400.):
+        chunkend = min(chunkstart + chunkdays * 86400., tend)
+        readend = min(chunkend + overlap, tend)
+        merged = get_multistation_data(varlist, ismrdb_path, ismrdb_name, stations=list(stations),
+                                       tabname=tabname, tstart=float(chunkstart), tend=float(readend),
+                                       log=log)
+        columns = [{col: merged[col][merged['station'] == station] for col in varlist}
+                   for station in stations]
+        lags = crosslag(columns[0], columns[1], var, chunkstart, readend)
+        # the windows that start in the next chunk are done there
+        own = lags['tstart'] < chunkend
+        lags = {key: values[own] for key, values in lags.items()}
+        with np.errstate(divide='ignore'):
+            velocity = np.where(lags['lag'] != 0., distance / lags['lag'], np.nan)
+        records = [(var, station1, station2, int(lags['SVID'][idx]), float(lags['tstart'][idx]),
+                    float(lags['lag'][idx]), float(lags['correlation'][idx]), int(lags['nr_samples'][idx]),
+                    None if np.isnan(velocity[idx]) else float(velocity[idx]))
+                   for idx in range(len(lags['SVID']))]
+        c.executemany('INSERT OR REPLACE INTO crosslag VALUES ({})'.format(','.join('?' * len(CROSSLAG_COLUMNS))),
+                      records)
+        conn.commit()
+        nrwindows += len(records)
+        log.debug('Lags of {}: {} windows from {}'.format(var, len(records), chunkstart))
+    conn.close()
+
+    return nrwindows
+
+def get_crosslag(lagdb, var='sig1_S4', svid=None, tstart=None, tend=None, min_correlation=None):
+    '''
+        Read the stored lags back for plotting, as a dataframe sorted by
+        SVID and time
+    '''
+    sql_stat = 'SELECT {} FROM crosslag'.format(','.join(CROSSLAG_COLUMNS))
+    sql_crit, sql_params = ['var = ?'], [var]
+    if svid is not None:
+        svids = [int(sv) for sv in np.atleast_1d(svid)]
+        sql_crit.append('SVID IN ({})'.format(','.join('?' * len(svids))))
+        sql_params.extend(svids)
+    if tstart is not None:
+        if hasattr(tstart, 'timestamp'):
+            tstart, tend = tstart.timestamp(), tend.timestamp()
+        sql_crit.append('tstart BETWEEN ? AND ?')
+        sql_params.extend([tstart, tend])
+    if min_correlation is not None:
+        sql_crit.append('correlation >= ?')
+        sql_params.append(min_correlation)
+    sql_stat += ' WHERE ' + ' AND '.join(sql_crit) + ' ORDER BY SVID, tstart'
+
+    conn = sqlite3.connect(lagdb)
+    c = conn.cursor()
+    init_crosslag_table(c)
+    lags = pd.read_sql_query(sql_stat, conn, params=sql_params)
+    conn.close()
+
+    return lags
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("startdate", nargs=6, type=int, help="start, e.g. 2020 10 30 0 0 0")
+    parser.add_argument("enddate", nargs=6, type=int, help="end")
+    parser.add_argument("--var", default='sig1_S4', help="the variable to correlate")
+    parser.add_argument("--stations", nargs=2, default=['SABA', 'SEUT'], help="the two stations")
+    parser.add_argument("--out", default=None, help="the database of the lags (default crosslag.db with the data)")
+    parser.add_argument("--chunkdays", type=int, default=1, help="number of days per query")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    # read where the databases are
+    config = read_yaml('local.yaml')
+    lagdb = args.out or os.path.join(config['ismrdb_path'], 'crosslag.db')
+    nrwindows = run_crosslag(config['ismrdb_path'], config['ismrdb_name'], lagdb,
+                             read_confdate(args.startdate), read_confdate(args.enddate), var=args.var,
+                             stations=args.stations, tabname=config.get('tabname', 'sep_data_{}'),
+                             chunkdays=args.chunkdays)
+    logging.info('Stored the lags of {} windows in {}'.format(nrwindows, lagdb))
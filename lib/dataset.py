@@ -0,0 +1,213 @@
+#! /usr/bin/env python
+'''
+    Lazy access to the ISMR data of one query: the columns are read from the
+    database when they are first needed, and kept for the next time.
+    Sub-selections in time and SVID are views on the same columns.
+'''
+
+import logging
+import datetime as dt
+
+import numpy as np
+
+from lib.tools import get_sqlite_data, rows_to_columns
+from lib.restrictions import compile_restrictions, table_columns
+from lib.sketch import ExactQuantiles
+from lib.svcube import SatelliteCube, CUBE_CADENCE
+from lib.rolling import rolling_columns, ROLLING_STATS
+
+# every query is sorted like this, so that columns read separately line up
+ORDER_BY = ['timestamp', 'SVID']
+
+
+class ISMRDataset():
+    '''
+        The data of one database table for a set of satellites, a period
+        and (optionally) restrictions as in the plot configuration
+    '''
+    def __init__(self, db, table, svid=None, tstart=None, tend=None,
+                 restrictions=None, log=logging):
+        '''
+            Initialise, nothing is read yet
+        '''
+        self.db = db
+        self.table = table
+        self.svid = svid
+        self.tstart = tstart
+        self.tend = tend
+        self.restrictions = restrictions
+        self.log = log
+
+        # the full columns, shared between a dataset and its selections
+        self._columns = {}
+        self._derived = {}
+        # which rows of the full columns this dataset holds: a slice (view) or index array
+        self._index = slice(None)
+        # the sorted values per column of the rows of this dataset (not shared with selections)
+        self._quantiles = {}
+
+    def __len__(self):
+        return len(self.timestamp)
+
+    def __getitem__(self, var):
+        '''
+            Get column var, read it from the database if necessary
+        '''
+        if var not in self._columns:
+            self.load([var])
+        return self._columns[var][self._index]
+
+    def load(self, varlist):
+        '''
+            Read the columns in varlist that have not been read yet, in one query
+        '''
+        missing = [var for var in ORDER_BY if var not in self._columns]
+        missing += [var for var in varlist if var not in self._columns and var not in missing]
+        if not missing:
+            return
+
+        columns = table_columns(self.db, self.table) if self.restrictions else None
+        restrict_crit, restrict_params = compile_restrictions(self.restrictions, columns=columns, tstart=self.tstart,
+                                                              tend=self.tend, log=self.log)
+        rows = get_sqlite_data(missing, self.db, svid=self.svid, tstart=self.tstart, tend=self.tend,
+                               restrict_crit=restrict_crit, restrict_params=restrict_params,
+                               table=self.table, order_by=ORDER_BY, log=self.log)
+        columns = rows_to_columns(rows, missing)
+        if 'timestamp' in self._columns and len(rows) != len(self._columns['timestamp']):
+            raise RuntimeError('Database {} changed while reading {}'.format(self.db, missing))
+
+        self.log.debug('Read {} rows of {} from {}'.format(len(rows), missing, self.db))
+        self._columns.update(columns)
+
+    @property
+    def timestamp(self):
+        return self['timestamp']
+
+    @property
+    def timedata(self):
+        '''
+            The times as datetime objects
+        '''
+        return self._full_timedata()[self._index]
+
+    @property
+    def timeofday(self):
+        '''
+            The time of the day in hours
+        '''
+        if 'timeofday' not in self._derived:
+            self._derived['timeofday'] = np.array([t.hour + t.minute / 60. + t.second / 3600.
+                                                   for t in self._full_timedata()])
+        return self._derived['timeofday'][self._index]
+
+    def _full(self, var):
+        '''
+            The full column, without the selection of this dataset
+        '''
+        if var not in self._columns:
+            self.load([var])
+        return self._columns[var]
+
+    def _full_timedata(self):
+        if 'time' not in self._derived:
+            self._derived['time'] = np.array([dt.datetime.fromtimestamp(t)
+                                              for t in self._full('timestamp')])
+        return self._derived['time']
+
+    def _row_index(self):
+        '''
+            The rows of this dataset as an index array into the full columns
+        '''
+        return np.arange(len(self._full('timestamp')))[self._index]
+
+    def quantiles(self, var):
+        '''
+            The exact quantiles of var (lib.sketch.ExactQuantiles), sorted on
+            first use
+        '''
+        if var not in self._quantiles:
+            self._quantiles[var] = ExactQuantiles.from_values(self[var])
+        return self._quantiles[var]
+
+    def percentile(self, var, pct):
+        '''
+            Percentile(s) pct (0 - 100) of var, NaN is skipped: exact, and
+            repeated lookups do not sort the column again
+        '''
+        return self.quantiles(var).percentile(pct)
+
+    def valid(self, varlist):
+        '''
+            Mask of the rows where none of the variables in varlist is NaN
+        '''
+        mask = np.ones(len(self), dtype=bool)
+        self.load(varlist)
+        for var in varlist:
+            mask &= ~np.isnan(self[var])
+        return mask
+
+    def rolling(self, var, window, stats=ROLLING_STATS):
+        '''
+            Rolling stats (lib.rolling) of var per satellite pass, over a
+            centred window of window s; computed on the full columns on
+            first use, so that the windows are not cut by a selection
+        '''
+        missing = [stat for stat in stats if ('rolling', var, window, stat) not in self._derived]
+        if missing:
+            columns = {name: self._full(name) for name in ['timestamp', 'SVID', var]}
+            if 'arc_id' in self._columns:
+                columns['arc_id'] = self._columns['arc_id']
+            for stat, values in rolling_columns(columns, var, window, stats=missing, log=self.log).items():
+                self._derived[('rolling', var, window, stat)] = values
+        return {stat: self._derived[('rolling', var, window, stat)][self._index] for stat in stats}
+
+    def cube(self, varlist, cadence=CUBE_CADENCE):
+        '''
+            The rows of this dataset as a time x SVID cube (lib.svcube) of
+            varlist, with slots of cadence s
+        '''
+        self.load(varlist)
+        columns = {var: self[var] for var in ['timestamp', 'SVID'] + list(varlist)}
+        tstart = self.tstart.timestamp() if isinstance(self.tstart, dt.datetime) else self.tstart
+        if tstart is not None:
+            tstart = np.floor(tstart / cadence) * cadence
+        return SatelliteCube.from_columns(columns, varlist, cadence=cadence, tstart=tstart, log=self.log)
+
+    def select(self, tstart=None, tend=None, svid=None, mask=None):
+        '''
+            Sub-selection by a boolean mask on the rows of this dataset, and/or
+            in time (datetimes or timestamps) and SVID. The new dataset shares
+            the columns with this one: only an index is kept, and a selection
+            in time only is a slice (so the columns are views, not copies).
+        '''
+        index = self._index
+        if mask is not None:
+            index = self._row_index()[np.asarray(mask, dtype=bool)]
+
+        if isinstance(tstart, dt.datetime):
+            tstart = tstart.timestamp()
+        if isinstance(tend, dt.datetime):
+            tend = tend.timestamp()
+        if tstart is not None or tend is not None:
+            # the rows are sorted in time, so this is a contiguous part of the current rows
+            timestamps = self._full('timestamp')[index]
+            first = np.searchsorted(timestamps, tstart, side='left') if tstart is not None else 0
+            last = np.searchsorted(timestamps, tend, side='right') if tend is not None else len(timestamps)
+            if isinstance(index, slice):
+                start, _stop, step = index.indices(len(self._full('timestamp')))
+                index = slice(start + first * step, start + last * step, step)
+            else:
+                index = index[first:last]
+
+        if svid is not None:
+            if isinstance(index, slice):
+                index = np.arange(len(self._full('timestamp')))[index]
+            index = index[np.isin(self._full('SVID')[index], np.atleast_1d(svid))]
+
+        subset = ISMRDataset(self.db, self.table, svid=self.svid, tstart=self.tstart,
+                             tend=self.tend, restrictions=self.restrictions, log=self.log)
+        subset._columns = self._columns
+        subset._derived = self._derived
+        subset._index = index
+
+        return subset
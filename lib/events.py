@@ -0,0 +1,225 @@
+#! /usr/bin/env python
+'''
+    Scintillation events: periods in which a satellite exceeds a threshold in
+    S4 or sigma-phi (phi60) on any of the signals. Exceedances of a satellite
+    that are less than a gap apart are merged into one event. The events are
+    kept in an indexed 'events' table, updated at ingestion:
+
+        get_events(db, tstart, tend, min_S4=0.3)
+'''
+
+import logging
+import sqlite3
+import argparse
+
+import numpy as np
+
+from lib.constants import TOPO
+from lib.tools import get_sqlite_data, rows_to_columns, read_confdate
+from lib.pierce import pierce_points, IPP_HEIGHT
+from lib.shards import database_files, connect_readonly
+
+# a row is part of an event when any of these exceeds its threshold
+EVENT_THRESHOLDS = {
+    'sig1_S4': 0.3, 'sig2_S4': 0.3, 'sig3_S4': 0.3,
+    'sig1_phi60': 0.5, 'sig2_phi60': 0.5, 'sig3_phi60': 0.5,
+}
+# exceedances at most this many seconds apart belong to the same event
+MAX_GAP = 180.
+
+EVENT_COLUMNS = ['station', 'SVID', 'tstart', 'tend', 'tpeak', 'peak_S4', 'peak_phi60',
+                 'nr_samples', 'azimuth', 'elevation', 'ipp_lat', 'ipp_lon']
+
+
+def init_event_table(cursor):
+    '''
+        Create the events table and its indexes
+    '''
+    cursor.execute('''CREATE TABLE IF NOT EXISTS events (
+        station TEXT, SVID INTEGER, tstart REAL, tend REAL, tpeak REAL,
+        peak_S4 REAL, peak_phi60 REAL, nr_samples INTEGER,
+        azimuth REAL, elevation REAL, ipp_lat REAL, ipp_lon REAL,
+        PRIMARY KEY (station, SVID, tstart)
+    )''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS "idx_events_tstart" ON events ("tstart")')
+    cursor.execute('CREATE INDEX IF NOT EXISTS "idx_events_tend" ON events ("tend")')
+    cursor.execute('CREATE INDEX IF NOT EXISTS "idx_events_peak_S4" ON events ("peak_S4")')
+    cursor.execute('CREATE INDEX IF NOT EXISTS "idx_events_ipp" ON events ("ipp_lat", "ipp_lon")')
+
+    return cursor
+
+def detect_events(columns, station='SABA', thresholds=None, max_gap=MAX_GAP):
+    '''
+        Find the events in columns (timestamp, SVID, azimuth, elevation and the
+        threshold variables). Returns a dict of arrays with EVENT_COLUMNS.
+    '''
+    if thresholds is None:
+        thresholds = EVENT_THRESHOLDS
+    order = np.lexsort((columns['timestamp'], columns['SVID']))
+    timestamps = columns['timestamp'][order]
+    svids = columns['SVID'][order].astype(np.int64)
+
+    # how far over its threshold every row is: > 1 is an exceedance
+    ratio = np.zeros(len(order))
+    for var, threshold in thresholds.items():
+        with np.errstate(invalid='ignore'):
+            ratio = np.fmax(ratio, columns[var][order] / threshold)
+    exceed = np.flatnonzero(ratio > 1.)
+
+    # run lengths: a new event where the satellite changes or the gap is too long
+    newevent = np.ones(len(exceed), dtype=bool)
+    newevent[1:] = (svids[exceed[1:]] != svids[exceed[:-1]]) | \
+                   (timestamps[exceed[1:]] - timestamps[exceed[:-1]] > max_gap)
+    start = np.flatnonzero(newevent)
+    last = np.append(start[1:], len(exceed)) - 1
+
+    def _peak(var_suffix):
+        peakvals = np.full(len(exceed), np.nan)
+        for var in thresholds:
+            if var.endswith(var_suffix):
+                peakvals = np.fmax(peakvals, columns[var][order][exceed])
+        return np.fmax.reduceat(peakvals, start) if len(start) else peakvals[:0]
+
+    # the peak is the row that is furthest over its threshold
+    if len(start):
+        group = np.repeat(np.arange(len(start)), np.diff(np.append(start, len(exceed))))
+        peakorder = np.lexsort((-ratio[exceed], group))
+        peakrow = exceed[peakorder[start]]
+    else:
+        peakrow = exceed[:0]
+
+    events = {
+        'station': np.full(len(start), station, dtype=object),
+        'SVID': svids[exceed[start]],
+        'tstart': timestamps[exceed[start]],
+        'tend': timestamps[exceed[last]],
+        'tpeak': timestamps[peakrow],
+        'peak_S4': _peak('_S4'),
+        'peak_phi60': _peak('_phi60'),
+        'nr_samples': last - start + 1,
+        'azimuth': columns['azimuth'][order][peakrow],
+        'elevation': columns['elevation'][order][peakrow],
+    }
+    events['ipp_lat'], events['ipp_lon'], _obliquity = pierce_points(events['azimuth'], events['elevation'],
+                                                                     point=TOPO[station], height=IPP_HEIGHT)
+
+    return events
+
+def _overlapping(cursor, station, wstart, wend, max_gap):
+    '''
+        The earliest start and latest end of the stored events that are
+        within max_gap of the window
+    '''
+    cursor.execute('SELECT MIN(tstart), MAX(tend) FROM events WHERE station = ? AND tend >= ? AND tstart <= ?',
+                   (station, wstart - max_gap, wend + max_gap))
+    return cursor.fetchone()
+
+def update_events(db, table, station, tstart, tend, thresholds=None, max_gap=MAX_GAP, log=logging):
+    '''
+        (Re)detect the events around tstart - tend (timestamps): the window is
+        extended over the stored events it touches (they may be merged with
+        new data), the events in it are deleted and detected again
+    '''
+    if thresholds is None:
+        thresholds = EVENT_THRESHOLDS
+    conn = sqlite3.connect(db)
+    c = conn.cursor()
+    init_event_table(c)
+
+    wstart, wend = tstart - max_gap, tend + max_gap
+    while True:
+        first, last = _overlapping(c, station, wstart, wend, max_gap)
+        if first is None or (first >= wstart and last <= wend):
+            break
+        wstart, wend = min(wstart, first), max(wend, last)
+
+    varlist = ['timestamp', 'SVID', 'azimuth', 'elevation'] + list(thresholds.keys())
+    rows = get_sqlite_data(varlist, db, svid=None, tstart=float(wstart), tend=float(wend),
+                           table=table, log=log)
+    events = detect_events(rows_to_columns(rows, varlist), station=station,
+                           thresholds=thresholds, max_gap=max_gap)
+
+    c.execute('DELETE FROM events WHERE station = ? AND tend >= ? AND tstart <= ?', (station, wstart, wend))
+    records = [tuple(events[col][idx].item() if hasattr(events[col][idx], 'item') else events[col][idx]
+                     for col in EVENT_COLUMNS) for idx in range(len(events['SVID']))]
+    c.executemany('INSERT OR REPLACE INTO events VALUES ({})'.format(','.join('?' * len(EVENT_COLUMNS))),
+                  records)
+    conn.commit()
+    conn.close()
+    log.debug('{} events of {} in {} - {}'.format(len(records), station, wstart, wend))
+
+    return len(records)
+
+def get_events(db, tstart=None, tend=None, station=None, svid=None, min_S4=None, min_phi60=None):
+    '''
+        The events (as a dict of arrays) that overlap tstart - tend (datetimes
+        or timestamps), optionally with a minimal peak S4 or phi60; from the
+        shards of db if it is sharded
+    '''
+    sql_crit, sql_params = [], []
+    if tstart is not None:
+        if hasattr(tstart, 'timestamp'):
+            tstart, tend = tstart.timestamp(), tend.timestamp()
+        sql_crit.append('tend >= ? AND tstart <= ?')
+        sql_params.extend([tstart, tend])
+    if station is not None:
+        sql_crit.append('station = ?')
+        sql_params.append(station)
+    if svid is not None:
+        svids = [int(sv) for sv in np.atleast_1d(svid)]
+        sql_crit.append('SVID IN ({})'.format(','.join('?' * len(svids))))
+        sql_params.extend(svids)
+    if min_S4 is not None:
+        sql_crit.append('peak_S4 >= ?')
+        sql_params.append(min_S4)
+    if min_phi60 is not None:
+        sql_crit.append('peak_phi60 >= ?')
+        sql_params.append(min_phi60)
+
+    sql_stat = 'SELECT {} FROM events'.format(','.join(EVENT_COLUMNS))
+    if sql_crit:
+        sql_stat += ' WHERE ' + ' AND '.join(sql_crit)
+    sql_stat += ' ORDER BY tstart'
+
+    rows = []
+    for dbfile in database_files(db, tstart, tend):
+        conn = connect_readonly(dbfile)
+        c = conn.cursor()
+        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='events'")
+        if c.fetchone() is not None:
+            c.execute(sql_stat, sql_params)
+            rows.extend(c.fetchall())
+        conn.close()
+    # one list in time order over the shards
+    rows.sort(key=lambda row: row[EVENT_COLUMNS.index('tstart')])
+
+    events = {col: np.array([row[idx] for row in rows]) for idx, col in enumerate(EVENT_COLUMNS)}
+    return events
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("db", help="the database in which to (re)build the event catalog")
+    parser.add_argument("station", help="the station, e.g. SABA")
+    parser.add_argument("startdate", nargs=6, type=int, help="start, e.g. 2020 10 30 0 0 0")
+    parser.add_argument("enddate", nargs=6, type=int, help="end")
+    parser.add_argument("--table", default='sep_data_{}', help="the data table")
+    parser.add_argument("--s4", type=float, default=None, help="threshold for S4")
+    parser.add_argument("--phi60", type=float, default=None, help="threshold for phi60")
+    parser.add_argument("--gap", type=float, default=MAX_GAP, help="merge events less than this (s) apart")
+    args = parser.parse_args()
+
+    thresholds = dict(EVENT_THRESHOLDS)
+    for var in thresholds:
+        if args.s4 is not None and var.endswith('_S4'):
+            thresholds[var] = args.s4
+        if args.phi60 is not None and var.endswith('_phi60'):
+            thresholds[var] = args.phi60
+
+    logging.basicConfig(level=logging.INFO)
+    nrevents = update_events(args.db, args.table.format(args.station), args.station,
+                             read_confdate(args.startdate).timestamp(),
+                             read_confdate(args.enddate).timestamp(),
+                             thresholds=thresholds, max_gap=args.gap)
+    logging.info('{} events in the catalog for this period'.format(nrevents))
@@ -0,0 +1,110 @@
+#! /usr/bin/env python
+'''
+    Gridding of pierce points: the values of the samples are binned on a
+    regular lat/lon grid around a station, per time window, with the count,
+    mean and maximum per cell. The result is drawn as one pcolormesh layer
+    instead of a scatter of every sample:
+
+        grid = LatLonGrid(TOPO['SABA'], step=0.5)
+        stats = grid_statistics(grid, lats, lons, values, timestamps, window=3600.)
+        mesh = draw_grid(ax, grid, stats['mean'][0])
+'''
+
+import numpy as np
+
+# size of the cells (degrees)
+GRID_STEP = 0.5
+# half the width and height of the grid around the station (degrees lon, lat)
+GRID_HALF_WIDTH = (25., 20.)
+# what can be drawn per cell
+GRID_STATS = ['mean', 'max', 'count']
+
+
+class LatLonGrid():
+    '''
+        A regular grid of cells of step degrees around center (lat, lon)
+    '''
+    def __init__(self, center, step=GRID_STEP, half_width=GRID_HALF_WIDTH):
+        self.center = center
+        self.step = step
+        lat0, lon0 = center
+        nlon = int(np.ceil(2. * half_width[0] / step))
+        nlat = int(np.ceil(2. * half_width[1] / step))
+        self.lon_edges = lon0 - half_width[0] + step * np.arange(nlon + 1)
+        self.lat_edges = lat0 - half_width[1] + step * np.arange(nlat + 1)
+        self.shape = (nlat, nlon)
+
+    @property
+    def extent(self):
+        return (self.lon_edges[0], self.lon_edges[-1], self.lat_edges[0], self.lat_edges[-1])
+
+    def cell_index(self, lats, lons):
+        '''
+            The flat index of the cell of every point, -1 outside the grid
+        '''
+        lats = np.asarray(lats, dtype=float)
+        lons = np.asarray(lons, dtype=float)
+        with np.errstate(invalid='ignore'):
+            row = np.floor((lats - self.lat_edges[0]) / self.step)
+            col = np.floor((lons - self.lon_edges[0]) / self.step)
+            inside = (row >= 0) & (row < self.shape[0]) & (col >= 0) & (col < self.shape[1])
+        index = np.full(lats.shape, -1, dtype=np.int64)
+        index[inside] = row[inside].astype(np.int64) * self.shape[1] + col[inside].astype(np.int64)
+        return index
+
+
+def grid_statistics(grid, lats, lons, values, timestamps=None, window=None):
+    '''
+        Count, mean and maximum of values per cell of grid and per time
+        window (s, from the first timestamp); without a window all samples
+        are in one. Returns a dict with 'count', 'mean' and 'max' of shape
+        (windows, lat, lon) and 'tstart', the start of every window.
+        Samples outside the grid or with NaN are left out.
+    '''
+    values = np.asarray(values, dtype=float)
+    cells = grid.cell_index(lats, lons)
+    keep = (cells >= 0) & np.isfinite(values)
+    ncells = grid.shape[0] * grid.shape[1]
+
+    windows = np.zeros(len(values), dtype=np.int64)
+    if timestamps is None or not np.any(keep):
+        tstart = np.array([np.nan])
+    else:
+        timestamps = np.asarray(timestamps, dtype=float)
+        first = np.min(timestamps[keep])
+        tstart = np.array([first])
+        if window is not None:
+            windows[keep] = ((timestamps[keep] - first) // window).astype(np.int64)
+            tstart = first + window * np.arange(np.max(windows[keep]) + 1)
+    nwindows = len(tstart)
+
+    index = windows[keep] * ncells + cells[keep]
+    values = values[keep]
+    size = nwindows * ncells
+    count = np.bincount(index, minlength=size)
+    total = np.bincount(index, weights=values, minlength=size)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / count
+
+    # maximum: sort on the cell, the maximum of every run of equal cells
+    maximum = np.full(size, np.nan)
+    if len(index):
+        order = np.argsort(index, kind='mergesort')
+        sorted_index = index[order]
+        start = np.flatnonzero(np.r_[True, sorted_index[1:] != sorted_index[:-1]])
+        maximum[sorted_index[start]] = np.maximum.reduceat(values[order], start)
+
+    shape = (nwindows,) + grid.shape
+    return {'count': count.reshape(shape), 'mean': mean.reshape(shape),
+            'max': maximum.reshape(shape), 'tstart': tstart}
+
+def draw_grid(ax, grid, field, vmin=None, vmax=None, cmap='jet', mask_zero=False, **kwargs):
+    '''
+        Draw a field of grid (lat, lon) as one pcolormesh on ax, the empty
+        cells (NaN, or 0 with mask_zero, for counts) are left transparent
+    '''
+    field = np.ma.masked_invalid(np.asarray(field, dtype=float))
+    if mask_zero:
+        field = np.ma.masked_equal(field, 0.)
+    return ax.pcolormesh(grid.lon_edges, grid.lat_edges, field, vmin=vmin, vmax=vmax,
+                         cmap=cmap, **kwargs)
@@ -0,0 +1,208 @@
+#! /usr/bin/env python
+'''
+    Histogram cubes: counts of a variable in fixed value bins, per (local) day,
+    hour of the day and SVID, stored sparsely next to the data and added to at
+    ingestion. A 2D histogram against time (per day) or hour of the day is then
+    a sum over the stored counts instead of a pass over all the rows:
+
+        counts, xedges, yedges = get_cube_counts('sig1_TEC', db, table, tstart, tend, xaxis='day')
+        hist2D_counts_plot(counts, xedges, yedges, 'timestamp', 'sig1_TEC')
+'''
+
+import os
+import logging
+import sqlite3
+import argparse
+
+import numpy as np
+
+from lib.tools import second_of_day, read_confdate
+from lib.shards import list_shards, shards_for_range
+
+# the fixed bins per variable: [first edge, last edge, number of bins]. Values
+# outside the edges are counted in the first/last bin
+CUBE_BINS = {
+    'sig1_TEC': [-50., 250., 150],
+    'sig1_S4': [0., 2., 100],
+    'sig2_S4': [0., 2., 100],
+    'sig3_S4': [0., 2., 100],
+}
+
+
+def cube_table(table):
+    '''
+        Name of the histogram cube of table
+    '''
+    return 'histcube_{}'.format(table)
+
+def cube_edges(var):
+    '''
+        The bin edges of the cube of var
+    '''
+    first, last, nrbins = CUBE_BINS[var]
+    return np.linspace(first, last, nrbins + 1)
+
+def init_cube_table(cursor, table):
+    '''
+        Create the histogram cube table (day is the timestamp of local midnight)
+    '''
+    cursor.execute('''CREATE TABLE IF NOT EXISTS {} (
+        var TEXT, day INTEGER, hour INTEGER, SVID INTEGER, bin INTEGER, count INTEGER,
+        PRIMARY KEY (var, day, hour, SVID, bin)
+    )'''.format(cube_table(table)))
+
+    return cursor
+
+def compute_cube(columns, var):
+    '''
+        Count the rows in columns (needs timestamp, SVID and var) per day, hour,
+        SVID and bin: a list of (var, day, hour, SVID, bin, count) records
+    '''
+    values = columns[var]
+    valid = np.isfinite(values)
+    timestamps = columns['timestamp'][valid]
+    sod = second_of_day(timestamps)
+    days = np.round(timestamps - sod).astype(np.int64)
+    hours = (sod // 3600).astype(np.int64)
+    svids = columns['SVID'][valid].astype(np.int64)
+    bins = np.clip(np.searchsorted(cube_edges(var), values[valid], side='right') - 1,
+                   0, CUBE_BINS[var][2] - 1)
+
+    keys, counts = np.unique(np.stack([days, hours, svids, bins]), axis=1, return_counts=True)
+
+    return [(var, int(day), int(hour), int(svid), int(vbin), int(count))
+            for (day, hour, svid, vbin), count in zip(keys.T, counts)]
+
+def update_cube(db, table, columns, log=logging):
+    '''
+        Add the counts of the new rows in columns to the cube: run at ingestion,
+        only for rows that were not in the database yet
+    '''
+    conn = sqlite3.connect(db)
+    c = conn.cursor()
+    init_cube_table(c, table)
+    for var in CUBE_BINS:
+        if var not in columns:
+            continue
+        records = compute_cube(columns, var)
+        c.executemany('''INSERT INTO {} VALUES (?,?,?,?,?,?)
+                         ON CONFLICT (var, day, hour, SVID, bin)
+                         DO UPDATE SET count = count + excluded.count'''.format(cube_table(table)),
+                      records)
+        log.debug('Added {} cube cells of {} to {}'.format(len(records), var, cube_table(table)))
+    conn.commit()
+    conn.close()
+
+def get_cube_counts(var, db, table, tstart, tend, svid=None, xaxis='day', log=logging):
+    '''
+        2D histogram of var from the cube for the days of tstart - tend
+        (datetimes or timestamps), against the day (xaxis='day') or the hour of
+        the day (xaxis='hour'). Gives counts (x, value bins), xedges and yedges;
+        None if there is no cube.
+    '''
+    if xaxis not in ('day', 'hour'):
+        raise ValueError('Unknown x axis {} for a histogram cube, use day or hour'.format(xaxis))
+    if hasattr(tstart, 'timestamp'):
+        tstart, tend = tstart.timestamp(), tend.timestamp()
+    firstday = int(round(tstart - second_of_day([tstart])[0]))
+    lastday = int(round(tend - second_of_day([tend])[0]))
+
+    if not os.path.isfile(db) and list_shards(db):
+        dbs = shards_for_range(db, tstart, tend)
+    else:
+        dbs = [db]
+
+    sql_stat = 'SELECT {}, bin, SUM(count) FROM {} WHERE var = ? AND day BETWEEN ? AND ?'.format(
+                   xaxis, cube_table(table))
+    sql_params = [var, firstday, lastday]
+    if svid is not None:
+        svids = [int(sv) for sv in np.atleast_1d(svid)]
+        sql_stat += ' AND SVID IN ({})'.format(','.join('?' * len(svids)))
+        sql_params.extend(svids)
+    sql_stat += ' GROUP BY {}, bin'.format(xaxis)
+
+    records = []
+    for dbfile in dbs:
+        conn = sqlite3.connect(dbfile)
+        c = conn.cursor()
+        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (cube_table(table),))
+        if c.fetchone() is None:
+            conn.close()
+            return None
+        c.execute(sql_stat, sql_params)
+        records.extend(c.fetchall())
+        conn.close()
+    log.debug('Read {} cube cells of {}'.format(len(records), var))
+
+    yedges = cube_edges(var)
+    if xaxis == 'day':
+        # the days are local midnights, which need not be 86400 s apart
+        xedges = np.array(sorted(set([firstday, lastday] + [rec[0] for rec in records])), dtype=float)
+        xedges = np.append(xedges, xedges[-1] + 86400.)
+    else:
+        xedges = np.arange(25, dtype=float)
+
+    counts = np.zeros((len(xedges) - 1, len(yedges) - 1), dtype=np.int64)
+    if records:
+        records = np.array(records, dtype=np.int64)
+        xidx = np.searchsorted(xedges, records[:, 0], side='right') - 1
+        np.add.at(counts, (xidx, records[:, 1]), records[:, 2])
+
+    return counts, xedges, yedges
+
+def build_cube(db, table, tstart=None, tend=None, log=logging):
+    '''
+        Fill the cube from the rows already in the database (for databases
+        that were made before the cubes existed); the cube is rebuilt for the
+        days of tstart - tend, or completely
+    '''
+    # imported here: lib.streaming is only needed to (re)build a cube
+    from lib.streaming import iter_sqlite_data
+
+    if hasattr(tstart, 'timestamp'):
+        tstart, tend = tstart.timestamp(), tend.timestamp()
+
+    if not os.path.isfile(db) and list_shards(db):
+        # every shard has its own cube
+        if tstart is None:
+            shardfiles = [shardfile for _month, shardfile in list_shards(db)]
+        else:
+            shardfiles = shards_for_range(db, tstart, tend)
+        for shardfile in shardfiles:
+            build_cube(shardfile, table, tstart=tstart, tend=tend, log=log)
+        return
+
+    conn = sqlite3.connect(db)
+    c = conn.cursor()
+    init_cube_table(c, table)
+    if tstart is None:
+        c.execute('DELETE FROM {}'.format(cube_table(table)))
+    else:
+        # whole days only: extend the period to local midnights
+        tstart = tstart - second_of_day([tstart])[0]
+        tend = tend - second_of_day([tend])[0] + 86400. - 1.e-3
+        c.execute('DELETE FROM {} WHERE day BETWEEN ? AND ?'.format(cube_table(table)),
+                  (int(round(tstart)), int(round(tend))))
+    conn.commit()
+    conn.close()
+
+    varlist = list(CUBE_BINS.keys()) + ['SVID', 'timestamp']
+    for batch in iter_sqlite_data(varlist, db, tstart=tstart, tend=tend, table=table, log=log):
+        update_cube(db, table, batch, log=log)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("db", help="the database in which to build the histogram cube")
+    parser.add_argument("table", help="the table, e.g. sep_data_SABA")
+    parser.add_argument("--startdate", nargs=6, type=int, default=None,
+                        help="start of the period to (re)build, e.g. 2020 10 30 0 0 0")
+    parser.add_argument("--enddate", nargs=6, type=int, default=None,
+                        help="end of the period to (re)build")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    tstart = read_confdate(args.startdate) if args.startdate else None
+    tend = read_confdate(args.enddate) if args.enddate else None
+    build_cube(args.db, args.table, tstart=tstart, tend=tend)
@@ -0,0 +1,214 @@
+#! /usr/bin/env python
+'''
+    Multipath masks: the sky view of a station has obstacles and reflectors
+    that raise S4 and phi60 in the same directions every day (the GPS
+    geometry repeats every sidereal day, so the same parts of the sky are
+    crossed again). The baseline of S4 and phi60 is binned in azimuth and
+    elevation over quiet days; the bins where it is high form the mask,
+    which is cached as an array (.npz) per station.
+
+    A mask replaces a restriction like elevation > 25 in the plot
+    configuration or query:
+
+        'restrictions': {'multipath': 'SABA'}
+
+    which is compiled into a lookup of the bin of every row in SQL (see
+    lib.restrictions), or applied to arrays with MultipathMask.lookup.
+'''
+
+import os
+import logging
+import argparse
+
+import numpy as np
+
+from lib.tools import get_sqlite_data, rows_to_columns, read_confdate
+from lib.skyplot import sky_bin_index
+
+MASK_VERSION = 1
+# size of the bins (degrees)
+AZ_STEP = 5.
+EL_STEP = 2.
+# a bin is masked when this percentile of the quiet-day values exceeds the threshold
+MASK_THRESHOLDS = {'sig1_S4': 0.2, 'sig1_phi60': 0.2}
+MASK_PERCENTILE = 90.
+# the minimal number of values in a bin to decide on it (otherwise not masked)
+MASK_MIN_COUNT = 20
+# a day is quiet when the 95th percentile of S4 at high elevation is below this
+QUIET_S4 = 0.15
+QUIET_ELEVATION = 45.
+# where the masks of the stations are kept
+MASK_PATH = './masks/multipath_{}.npz'
+
+# the masks that were loaded, by path: (modification time, mask)
+_MASKS = {}
+
+
+class MultipathMask():
+    '''
+        Baseline and mask of a station on a grid of azimuth x elevation bins
+    '''
+    def __init__(self, station, az_step=AZ_STEP, el_step=EL_STEP):
+        self.station = station
+        self.az_step = az_step
+        self.el_step = el_step
+        self.shape = (int(np.ceil(90. / el_step)), int(np.ceil(360. / az_step)))
+        self.count = np.zeros(self.shape, dtype=np.int64)
+        self.baseline = {}
+        self.mask = np.zeros(self.shape, dtype=bool)
+        self.days = set()
+
+    def bin_index(self, azimuth, elevation):
+        '''
+            The flat index of the bin of every azimuth, elevation (degrees),
+            -1 where either is NaN
+        '''
+        return sky_bin_index(azimuth, elevation, az_step=self.az_step, el_step=self.el_step)
+
+    def build(self, columns, thresholds=None, percentile=MASK_PERCENTILE, min_count=MASK_MIN_COUNT):
+        '''
+            Make the baseline and the mask from the quiet-day columns
+            (azimuth, elevation and the variables of thresholds)
+        '''
+        if thresholds is None:
+            thresholds = MASK_THRESHOLDS
+        nbins = self.shape[0] * self.shape[1]
+        bins = self.bin_index(columns['azimuth'], columns['elevation'])
+        self.count = np.bincount(bins[bins >= 0], minlength=nbins).reshape(self.shape)
+
+        self.mask = np.zeros(self.shape, dtype=bool)
+        for var, threshold in thresholds.items():
+            values = np.asarray(columns[var], dtype=float)
+            keep = (bins >= 0) & np.isfinite(values)
+            # the percentile per bin: sort on bin and value, pick the rank in every bin
+            order = np.lexsort((values[keep], bins[keep]))
+            sorted_bins, sorted_values = bins[keep][order], values[keep][order]
+            first = np.searchsorted(sorted_bins, np.arange(nbins), side='left')
+            count = np.searchsorted(sorted_bins, np.arange(nbins), side='right') - first
+            baseline = np.full(nbins, np.nan)
+            filled = count > 0
+            rank = first[filled] + ((count[filled] - 1) * percentile / 100.).astype(np.int64)
+            baseline[filled] = sorted_values[rank]
+            self.baseline[var] = baseline.reshape(self.shape)
+            with np.errstate(invalid='ignore'):
+                self.mask |= ((count >= min_count) & (baseline > threshold)).reshape(self.shape)
+
+        return self.mask
+
+    def lookup(self, azimuth, elevation):
+        '''
+            True where azimuth, elevation (arrays, degrees) is masked, or unknown
+        '''
+        index = self.bin_index(azimuth, elevation)
+        masked = np.ones(index.shape, dtype=bool)
+        masked[index >= 0] = self.mask.ravel()[index[index >= 0]]
+        return masked
+
+    def sql_criterion(self):
+        '''
+            The SQL criterion for the rows that are not masked: the bin of
+            azimuth and elevation is computed as in lib.skyplot.sky_bin_index
+        '''
+        el_bin = 'MIN(MAX(CAST(elevation / {!r} AS INTEGER), 0), {})'.format(self.el_step, self.shape[0] - 1)
+        az_bin = 'MIN(MAX(CAST(azimuth / {!r} AS INTEGER), 0), {})'.format(self.az_step, self.shape[1] - 1)
+        masked = ','.join(str(idx) for idx in np.flatnonzero(self.mask))
+        if not masked:
+            return 'azimuth IS NOT NULL AND elevation IS NOT NULL'
+        return '({} * {} + {}) NOT IN ({})'.format(el_bin, self.shape[1], az_bin, masked)
+
+    def save(self, path):
+        '''
+            Save as .npz (with the format version)
+        '''
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        baselines = {'baseline_{}'.format(var): values for var, values in self.baseline.items()}
+        np.savez_compressed(path, version=MASK_VERSION, station=self.station,
+                            az_step=self.az_step, el_step=self.el_step,
+                            days=np.array(sorted(self.days), dtype=np.int64),
+                            count=self.count, mask=self.mask, **baselines)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            if int(data['version']) != MASK_VERSION:
+                raise ValueError('Multipath mask {} has version {}, expected {}'.format(
+                                 path, int(data['version']), MASK_VERSION))
+            mpmask = cls(str(data['station']), az_step=float(data['az_step']),
+                         el_step=float(data['el_step']))
+            mpmask.days = set(int(day) for day in data['days'])
+            mpmask.count = data['count']
+            mpmask.mask = data['mask']
+            mpmask.baseline = {key[len('baseline_'):]: data[key] for key in data.files
+                               if key.startswith('baseline_')}
+        return mpmask
+
+
+def load_mask(spec):
+    '''
+        The mask of a station (name, from MASK_PATH) or in a .npz file; kept
+        in memory until the file changes
+    '''
+    path = spec if spec.endswith('.npz') else MASK_PATH.format(spec)
+    if not os.path.isfile(path):
+        raise ValueError('No multipath mask {}, make it with python -m lib.multipath'.format(path))
+    mtime = os.path.getmtime(path)
+    if path not in _MASKS or _MASKS[path][0] != mtime:
+        _MASKS[path] = (mtime, MultipathMask.load(path))
+    return _MASKS[path][1]
+
+def quiet_days(columns, max_s4=QUIET_S4, min_elevation=QUIET_ELEVATION):
+    '''
+        The (UTC) days, as timestamps of midnight, on which the 95th percentile
+        of sig1_S4 above min_elevation is below max_s4
+    '''
+    days = np.floor(columns['timestamp'] / 86400.) * 86400.
+    high = (columns['elevation'] > min_elevation) & np.isfinite(columns['sig1_S4'])
+    order = np.lexsort((columns['sig1_S4'][high], days[high]))
+    sorted_days, sorted_s4 = days[high][order], columns['sig1_S4'][high][order]
+    unique_days, first, count = np.unique(sorted_days, return_index=True, return_counts=True)
+    p95 = sorted_s4[first + ((count - 1) * 0.95).astype(np.int64)]
+    return unique_days[p95 < max_s4]
+
+def build_multipath_mask(db, table, station, tstart, tend, days=None, thresholds=None, log=logging):
+    '''
+        Build the mask of station from the quiet days in tstart - tend
+        (datetimes or timestamps), or from the given days (timestamps of
+        UTC midnight)
+    '''
+    if thresholds is None:
+        thresholds = MASK_THRESHOLDS
+    varlist = ['timestamp', 'azimuth', 'elevation'] + sorted(set(thresholds) | {'sig1_S4'})
+    rows = get_sqlite_data(varlist, db, svid=None, tstart=tstart, tend=tend, table=table, log=log)
+    columns = rows_to_columns(rows, varlist)
+
+    if days is None:
+        days = quiet_days(columns)
+    selected = np.isin(np.floor(columns['timestamp'] / 86400.) * 86400., days)
+    log.info('Multipath mask of {} from {} quiet days, {} rows'.format(station, len(days), np.sum(selected)))
+
+    mpmask = MultipathMask(station)
+    mpmask.build({var: values[selected] for var, values in columns.items()}, thresholds=thresholds)
+    mpmask.days = set(int(day) for day in days)
+    log.info('Masked {} of {} bins'.format(np.sum(mpmask.mask), mpmask.mask.size))
+
+    return mpmask
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("db", help="the database with the reduced data")
+    parser.add_argument("loc", help="the station, e.g. SABA")
+    parser.add_argument("startdate", nargs=6, type=int, help="start, e.g. 2020 10 30 0 0 0")
+    parser.add_argument("enddate", nargs=6, type=int, help="end")
+    parser.add_argument("--table", default='sep_data_{}', help="the data table")
+    parser.add_argument("--out", default=None, help="the mask file (default {})".format(MASK_PATH))
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    mpmask = build_multipath_mask(args.db, args.table.format(args.loc), args.loc,
+                                  read_confdate(args.startdate), read_confdate(args.enddate))
+    outfile = args.out or MASK_PATH.format(args.loc)
+    mpmask.save(outfile)
+    logging.info('Saved {}'.format(outfile))
@@ -0,0 +1,99 @@
+#! /usr/bin/env python
+'''
+    Query several stations (SABA, SEUT) at once and merge the results,
+    optionally joined on (timestamp, SVID) for cross-station comparison
+'''
+
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from lib.constants import TOPO
+from lib.tools import get_sqlite_data, rows_to_columns
+
+
+def _read_station(args):
+    '''
+        Read the columns of one station
+    '''
+    varlist, station, db, table, svid, tstart, tend, restrict_crit, restrict_params, log = args
+    rows = get_sqlite_data(varlist, db, svid=svid, tstart=tstart, tend=tend,
+                           restrict_crit=restrict_crit, table=table,
+                           restrict_params=restrict_params, log=log)
+    return rows_to_columns(rows, varlist)
+
+def get_multistation_data(varlist, ismrdb_path, ismrdb_name, stations=None,
+                          tabname='sep_data_{}', svid=None, tstart=None, tend=None,
+                          restrict_crit=None, restrict_params=None, workers=2, log=logging):
+    '''
+        Read varlist for a list of stations concurrently, the database and table
+        names are formatted with the station (as in local.yaml).
+        Returns a dict of column arrays for all stations together, with an extra
+        column 'station' that holds the station code of each row.
+        If 'timestamp' is in varlist, the rows are in time order.
+    '''
+    if stations is None:
+        stations = list(TOPO.keys())
+
+    tasks = [(list(varlist), station, os.path.join(ismrdb_path, ismrdb_name.format(station)),
+              tabname.format(station), svid, tstart, tend, restrict_crit, restrict_params, log)
+             for station in stations]
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(tasks)))) as executor:
+        results = list(executor.map(_read_station, tasks))
+
+    merged = {var: np.concatenate([result[var] for result in results]) for var in varlist}
+    merged['station'] = np.concatenate([np.full(len(result[varlist[0]]), station)
+                                        for station, result in zip(stations, results)])
+    for station, result in zip(stations, results):
+        log.debug('Station {}: {} rows'.format(station, len(result[varlist[0]])))
+
+    if 'timestamp' in varlist:
+        order = np.argsort(merged['timestamp'], kind='stable')
+        merged = {var: coldata[order] for var, coldata in merged.items()}
+
+    return merged
+
+def join_stations(merged, stations=None, cadence=60., log=logging):
+    '''
+        Time-aligned join of the merged data of (at least) two stations on
+        (timestamp, SVID), so both columns should be in the merged data.
+        Timestamps are rounded to the cadence (in s), only the (time, satellite)
+        combinations that are seen by all stations are kept.
+        Returns a dict with 'timestamp' and 'SVID', and '<var>_<station>' for
+        every other column.
+    '''
+    if stations is None:
+        stations = list(np.unique(merged['station']))
+
+    slots = np.round(merged['timestamp'] / cadence).astype(np.int64)
+    keys = slots * 1000 + merged['SVID'].astype(np.int64)
+
+    # find the keys that every station has, and where they are for each station
+    station_idx = {}
+    common = None
+    for station in stations:
+        rows = np.flatnonzero(merged['station'] == station)
+        if common is None:
+            common = keys[rows]
+            station_idx[station] = rows
+            continue
+        common, idx_common, idx_station = np.intersect1d(common, keys[rows],
+                                                         return_indices=True)
+        for prev in station_idx:
+            station_idx[prev] = station_idx[prev][idx_common]
+        station_idx[station] = rows[idx_station]
+    log.debug('Joined {} on {} common (timestamp, SVID)'.format(stations, len(common)))
+
+    joined = {
+        'timestamp': (common // 1000) * cadence,
+        'SVID': common % 1000,
+    }
+    for var in merged:
+        if var in ('timestamp', 'SVID', 'station'):
+            continue
+        for station in stations:
+            joined['{}_{}'.format(var, station)] = merged[var][station_idx[station]]
+
+    return joined
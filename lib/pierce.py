@@ -0,0 +1,223 @@
+#! /usr/bin/env python
+'''
+    Ionospheric pierce points in the thin-shell model: where the line of
+    sight from a station to a satellite crosses a spherical shell at height h
+    above the Earth, and the obliquity (slant) factor there. All computations
+    are vectorized; at ingestion the pierce point of every row is stored in
+    the columns of PIERCE_NAMES (see read_ismr.write_to_reduced_sqlite).
+
+    The shell height of the stored pierce points is recorded per data table
+    (pierce_height), so that they are only used for that height.
+
+    The obliquity is also the mapping function from slant to vertical TEC:
+    the vertical TEC of the columns in VTEC_NAMES is stored as well, and for
+    another shell height it can be projected in the query itself, e.g.
+    get_sqlite_data(['sig1_vTEC_450', ...]) for a shell at 450 km.
+'''
+
+import re
+import math
+import logging
+import sqlite3
+import argparse
+
+import numpy as np
+
+from lib.constants import TOPO, R_earth
+
+# default height of the ionospheric shell (km)
+IPP_HEIGHT = 350.
+# the columns that hold the pierce point of every row
+PIERCE_NAMES = ['ipp_lat', 'ipp_lon', 'ipp_obliquity']
+# the table with the shell height of those columns per data table (IPP_HEIGHT if not in it)
+PIERCE_HEIGHT_TABLE = 'pierce_height'
+# the vertical TEC columns, with the slant TEC they are computed from
+VTEC_NAMES = {'sig1_vTEC': 'sig1_TEC'}
+# all columns that are derived at ingestion
+DERIVED_NAMES = PIERCE_NAMES + list(VTEC_NAMES)
+# a vertical TEC for another shell height (km) in a query: sig1_vTEC_450
+VTEC_PROJECTION = re.compile(r'^(sig\d_vTEC)_(\d+(?:\.\d+)?)$')
+# the SQL functions that the projection uses, for SQLite builds without math functions
+SQL_MATH_FUNCTIONS = {'cos': math.cos, 'radians': math.radians, 'sqrt': math.sqrt}
+
+
+def pierce_points(azimuth, elevation, point=TOPO['SABA'], height=IPP_HEIGHT):
+    '''
+        Latitude, longitude (degrees, -180 - 180) and obliquity factor of the
+        pierce points for azimuth and elevation (degrees) seen from point
+        (lat, lon in degrees), with the shell at height km
+    '''
+    azimuth = np.radians(np.asarray(azimuth, dtype=float))
+    elevation = np.radians(np.asarray(elevation, dtype=float))
+    lat0, lon0 = np.radians(point[0]), np.radians(point[1])
+
+    # Earth-centred angle between the station and the pierce point
+    ratio = _shell_ratio(height) * np.cos(elevation)
+    psi = np.pi / 2. - elevation - np.arcsin(ratio)
+
+    lat = np.arcsin(np.sin(lat0) * np.cos(psi) + np.cos(lat0) * np.sin(psi) * np.cos(azimuth))
+    dlon = np.arctan2(np.sin(azimuth) * np.sin(psi) * np.cos(lat0),
+                      np.cos(psi) - np.sin(lat0) * np.sin(lat))
+    lon = (np.degrees(lon0 + dlon) + 180.) % 360. - 180.
+    obliquity = 1. / np.sqrt(1. - ratio ** 2)   # see mapping_function
+
+    return np.degrees(lat), lon, obliquity
+
+def _shell_ratio(height):
+    return R_earth / (R_earth + height)
+
+def mapping_function(elevation, height=IPP_HEIGHT):
+    '''
+        Thin-shell mapping function (obliquity factor) from vertical to slant
+        TEC for elevation (degrees)
+    '''
+    ratio = _shell_ratio(height) * np.cos(np.radians(np.asarray(elevation, dtype=float)))
+    return 1. / np.sqrt(1. - ratio ** 2)
+
+def vertical_tec(tec, elevation, height=IPP_HEIGHT):
+    '''
+        Vertical TEC from slant TEC and elevation (degrees)
+    '''
+    return np.asarray(tec, dtype=float) / mapping_function(elevation, height=height)
+
+def vtec_column(var):
+    '''
+        The SQL expression for a column of a query: the projection of the
+        vertical TEC for a shell height given in the name (sig1_vTEC_450),
+        var itself for anything else. Needs the SQLite math functions, see
+        register_math_functions.
+    '''
+    match = VTEC_PROJECTION.match(var)
+    if match is None or match.group(1) not in VTEC_NAMES:
+        return var
+    ratio = _shell_ratio(float(match.group(2)))
+    cosine = '({!r} * cos(radians(elevation)))'.format(ratio)
+    return '{} * sqrt(1. - {} * {})'.format(VTEC_NAMES[match.group(1)], cosine, cosine)
+
+def _sql_function(function):
+    '''
+        function as an SQL function: NULL in, or outside its domain, gives NULL
+    '''
+    def sql_function(value):
+        try:
+            return None if value is None else function(value)
+        except ValueError:
+            return None
+    return sql_function
+
+def register_math_functions(conn):
+    '''
+        Add the SQL_MATH_FUNCTIONS to connection conn where SQLite was built
+        without them (before 3.35, or without SQLITE_ENABLE_MATH_FUNCTIONS)
+    '''
+    for name, function in SQL_MATH_FUNCTIONS.items():
+        try:
+            conn.execute('SELECT {}(1.)'.format(name))
+        except sqlite3.OperationalError:
+            conn.create_function(name, 1, _sql_function(function), deterministic=True)
+
+    return conn
+
+def add_pierce_points(df, loc='SABA', height=IPP_HEIGHT):
+    '''
+        Add the PIERCE_NAMES columns to a dataframe with azimuth and elevation,
+        and the VTEC_NAMES columns for the slant TEC columns in it
+    '''
+    df['ipp_lat'], df['ipp_lon'], df['ipp_obliquity'] = pierce_points(df['azimuth'].values,
+                                                                      df['elevation'].values,
+                                                                      point=TOPO[loc], height=height)
+    for vtec, tec in VTEC_NAMES.items():
+        if tec in df:
+            df[vtec] = df[tec].astype(float).values / df['ipp_obliquity'].values
+    return df
+
+def pierce_height(cursor, table):
+    '''
+        The shell height (km) of the stored pierce points of table
+    '''
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (PIERCE_HEIGHT_TABLE,))
+    if cursor.fetchone() is None:
+        return IPP_HEIGHT
+    cursor.execute('SELECT height FROM {} WHERE tab = ?'.format(PIERCE_HEIGHT_TABLE), (table,))
+    row = cursor.fetchone()
+    return IPP_HEIGHT if row is None else row[0]
+
+def set_pierce_height(cursor, table, height):
+    '''
+        Record the shell height (km) of the stored pierce points of table
+    '''
+    cursor.execute('CREATE TABLE IF NOT EXISTS {} (tab TEXT PRIMARY KEY, height REAL)'.format(PIERCE_HEIGHT_TABLE))
+    cursor.execute('INSERT OR REPLACE INTO {} VALUES (?, ?)'.format(PIERCE_HEIGHT_TABLE), (table, float(height)))
+
+    return cursor
+
+def stored_pierce_height(db, table):
+    '''
+        The shell height (km) of the stored pierce points of table in db (or
+        in its monthly shards), None if the shards differ or there is no data
+    '''
+    # imported here: lib.shards depends on lib.tools, which uses this module
+    from lib.shards import database_files, connect_readonly
+
+    heights = set()
+    for dbfile in database_files(db):
+        conn = connect_readonly(dbfile)
+        heights.add(pierce_height(conn.cursor(), table))
+        conn.close()
+    return heights.pop() if len(heights) == 1 else None
+
+def update_pierce_points(db, table, loc='SABA', height=IPP_HEIGHT, only_missing=True, log=logging):
+    '''
+        (Re)compute the stored pierce points and vertical TEC of the rows in
+        table: for databases from before they were stored, or (all rows) for
+        another shell height, which is recorded
+    '''
+    conn = sqlite3.connect(db)
+    c = conn.cursor()
+    stored = pierce_height(c, table)
+    if only_missing and height != stored:
+        conn.close()
+        raise ValueError('The pierce points in {} are for a shell at {} km, recompute all rows for {} km'.format(
+                         table, stored, height))
+    sql_stat = 'SELECT weeknumber, timeofweek, SVID, azimuth, elevation, {} FROM {}'.format(
+        ', '.join(VTEC_NAMES.values()), table)
+    if only_missing:
+        sql_stat += ' WHERE ipp_lat IS NULL OR {}'.format(' OR '.join(
+            '({} IS NULL AND {} IS NOT NULL)'.format(vtec, tec) for vtec, tec in VTEC_NAMES.items()))
+    c.execute(sql_stat)
+    rows = c.fetchall()
+    if rows:
+        keys = np.array([row[:3] for row in rows])
+        values = np.array([row[3:] for row in rows], dtype=float)
+        lat, lon, obliquity = pierce_points(values[:, 0], values[:, 1], point=TOPO[loc], height=height)
+        vtec = values[:, 2:] / obliquity[:, np.newaxis]
+        columns = PIERCE_NAMES + list(VTEC_NAMES)
+        c.executemany('''UPDATE {} SET {}
+                         WHERE weeknumber = ? AND timeofweek = ? AND SVID = ?'''.format(table,
+                      ', '.join('{} = ?'.format(col) for col in columns)),
+                      [(float(lat[idx]), float(lon[idx]), float(obliquity[idx])) +
+                       tuple(None if np.isnan(val) else float(val) for val in vtec[idx]) +
+                       tuple(int(k) for k in keys[idx]) for idx in range(len(rows))])
+    set_pierce_height(c, table, height)
+    conn.commit()
+    conn.close()
+    log.info('Updated the pierce points and vertical TEC of {} rows in {}'.format(len(rows), table))
+
+    return len(rows)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("db", help="the database with the reduced data")
+    parser.add_argument("loc", help="the station, e.g. SABA")
+    parser.add_argument("--table", default='sep_data_{}', help="the data table")
+    parser.add_argument("--height", type=float, default=IPP_HEIGHT, help="height of the shell (km)")
+    parser.add_argument("--all", action='store_true', help="recompute all rows, not only the missing ones")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    from lib.shards import database_files
+    for dbfile in database_files(args.db):
+        update_pierce_points(dbfile, args.table.format(args.loc), loc=args.loc, height=args.height,
+                             only_missing=not args.all)
@@ -0,0 +1,205 @@
+#! /usr/bin/env python
+'''
+    Quality flags: cycle slips, outliers and loss of lock in the TEC are
+    detected per satellite pass and stored as a bitmask in the column qflag
+    of the data table at ingestion (NULL: not checked). Queries leave the
+    flagged rows out with a restriction (see lib.restrictions):
+
+        'restrictions': {'qflag': 'any'}                     no flag at all
+        'restrictions': {'qflag': ['tec_slip', 'tec_outlier']}
+
+    For the archive run
+
+        python -m lib.quality scint_reduced_SABA.db SABA 2018 1 1 0 0 0 2021 1 1 0 0 0
+'''
+
+import os
+import logging
+import sqlite3
+import argparse
+
+import numpy as np
+
+from lib.tools import get_sqlite_data, rows_to_columns, read_confdate
+from lib.arcs import ARC_LOCKTIME
+from lib.rolling import arc_groups, rolling_stats, outlier_mask
+from lib.shards import list_shards, shards_for_range
+
+QFLAG_COLUMN = 'qflag'
+# the bits of the flag
+QFLAG_BITS = {
+    'locktime': 1,          # lock time reset in the last minute
+    'tec_slip': 2,          # jump in the TEC that the phase (dTEC) does not show
+    'tec_outlier': 4,       # sig1_TEC far from the median of its pass
+    'dtec_outlier': 8,      # one of the dTEC values far from the median of its pass
+}
+# the phase-based TEC changes over the minute before a row
+DTEC_NAMES = ['sig1_dTEC_m60_m45', 'sig1_dTEC_m45_m30', 'sig1_dTEC_m30_m15', 'sig1_dTEC_m15_0']
+# the window (s) of the median and MAD that values are compared with
+QUALITY_WINDOW = 900.
+# a value is an outlier when it is this many robust standard deviations from the median ...
+QUALITY_NSIGMA = 5.
+# ... and at least this far (TECU)
+TEC_MIN_DEVIATION = 3.
+SLIP_MIN_JUMP = 2.
+DTEC_MIN_DEVIATION = 1.
+# rows with a shorter lock time (s) have lost lock since the previous row
+LOCKTIME_MIN = 60.
+# no TEC jump between rows more than this many seconds apart
+SLIP_MAX_STEP = 90.
+
+
+def init_qflag_column(cursor, table):
+    '''
+        Add the (indexed) qflag column to table when it does not have it
+    '''
+    cursor.execute('PRAGMA table_info({})'.format(table))
+    if QFLAG_COLUMN not in [col[1] for col in cursor.fetchall()]:
+        cursor.execute('ALTER TABLE {} ADD COLUMN {} INTEGER'.format(table, QFLAG_COLUMN))
+    cursor.execute('CREATE INDEX IF NOT EXISTS "idx_{0}" ON {1} ("{0}")'.format(QFLAG_COLUMN, table))
+
+    return cursor
+
+def flag_bits(names):
+    '''
+        The bitmask of flag name(s), 'any' for all of them
+    '''
+    if isinstance(names, str):
+        names = list(QFLAG_BITS) if names == 'any' else [names]
+    unknown = [name for name in names if name not in QFLAG_BITS]
+    if unknown:
+        raise ValueError('Unknown quality flag(s) {}, use {} or any'.format(unknown, list(QFLAG_BITS)))
+    return int(np.bitwise_or.reduce([QFLAG_BITS[name] for name in names]))
+
+def _deviates(values, groups, timestamps, window, nsigma, min_deviation):
+    '''
+        True where values are more than nsigma robust standard deviations
+        and min_deviation from the rolling median of their pass
+    '''
+    stats = rolling_stats(groups, timestamps, values, window, stats=['median', 'mad'])
+    with np.errstate(invalid='ignore'):
+        return outlier_mask(values, stats['median'], stats['mad'], nsigma=nsigma) & \
+            (np.abs(values - stats['median']) > min_deviation)
+
+def compute_qflags(columns, window=QUALITY_WINDOW, nsigma=QUALITY_NSIGMA):
+    '''
+        The quality flags (see QFLAG_BITS) of every row of columns
+        (timestamp, SVID, sig1_TEC and optionally arc_id, the lock time and
+        the DTEC_NAMES), in the order of the rows
+    '''
+    nrows = len(columns['timestamp'])
+    qflag = np.zeros(nrows, dtype=np.int64)
+    if nrows == 0:
+        return qflag
+    groups = arc_groups(columns)
+    timestamps = columns['timestamp']
+
+    # previous row of the same satellite, and of the same pass
+    order = np.lexsort((timestamps, columns['SVID']))
+    previous = np.full(nrows, -1, dtype=np.int64)
+    same_sat = columns['SVID'][order][1:] == columns['SVID'][order][:-1]
+    previous[order[1:][same_sat]] = order[:-1][same_sat]
+    has_previous = previous >= 0
+
+    if ARC_LOCKTIME in columns:
+        locktime = columns[ARC_LOCKTIME]
+        with np.errstate(invalid='ignore'):
+            reset = locktime < LOCKTIME_MIN
+            reset[has_previous] |= locktime[has_previous] < locktime[previous[has_previous]]
+        qflag[reset] |= QFLAG_BITS['locktime']
+
+    # the jump in TEC since the previous row of the pass, less what the phase saw
+    tec = columns['sig1_TEC']
+    step = np.zeros(nrows, dtype=bool)
+    step[has_previous] = (groups[has_previous] == groups[previous[has_previous]]) & \
+        (timestamps[has_previous] - timestamps[previous[has_previous]] <= SLIP_MAX_STEP)
+    jump = np.full(nrows, np.nan)
+    jump[step] = tec[step] - tec[previous[step]]
+    if all(name in columns for name in DTEC_NAMES):
+        phase = np.sum([columns[name] for name in DTEC_NAMES], axis=0)
+        jump = np.where(np.isfinite(phase), jump - phase, jump)
+    slip = _deviates(jump, groups, timestamps, window, nsigma, SLIP_MIN_JUMP)
+
+    outlier = _deviates(tec, groups, timestamps, window, nsigma, TEC_MIN_DEVIATION)
+    qflag[outlier] |= QFLAG_BITS['tec_outlier']
+    # the jumps into and out of an outlier are not slips
+    slip &= ~outlier
+    slip[step] &= ~outlier[previous[step]]
+    qflag[slip] |= QFLAG_BITS['tec_slip']
+
+    for name in DTEC_NAMES:
+        if name in columns:
+            qflag[_deviates(columns[name], groups, timestamps, window, nsigma, DTEC_MIN_DEVIATION)] |= \
+                QFLAG_BITS['dtec_outlier']
+
+    return qflag
+
+def update_quality(db, table, tstart, tend, window=QUALITY_WINDOW, log=logging):
+    '''
+        (Re)compute the quality flags of the rows in tstart - tend
+        (timestamps) of db, and of the rows around it whose window reaches
+        into it
+    '''
+    conn = sqlite3.connect(db)
+    c = conn.cursor()
+    init_qflag_column(c, table)
+    c.execute('PRAGMA table_info({})'.format(table))
+    existing = [col[1] for col in c.fetchall()]
+    conn.commit()
+
+    varlist = ['rowid', 'timestamp', 'SVID', 'sig1_TEC']
+    varlist += [var for var in ['arc_id', ARC_LOCKTIME] + DTEC_NAMES if var in existing]
+    rows = get_sqlite_data(varlist, db, svid=None, tstart=float(tstart - window - SLIP_MAX_STEP),
+                           tend=float(tend + window), table=table, log=log)
+    columns = rows_to_columns(rows, varlist)
+    if 'arc_id' in columns and not np.all(np.isfinite(columns['arc_id'])):
+        # not all passes are known yet: segment them here
+        del columns['arc_id']
+    qflag = compute_qflags(columns, window=window)
+
+    update = (columns['timestamp'] >= tstart - window / 2.) & (columns['timestamp'] <= tend + window / 2.)
+    c.executemany('UPDATE {} SET {} = ? WHERE rowid = ?'.format(table, QFLAG_COLUMN),
+                  zip(qflag[update].tolist(), columns['rowid'][update].astype(np.int64).tolist()))
+    conn.commit()
+    conn.close()
+    log.debug('Quality flags of {} rows in {} - {}, {} flagged'.format(np.sum(update), tstart, tend,
+                                                                       np.sum(qflag[update] > 0)))
+
+    return int(np.sum(update))
+
+def run_quality(db, table, tstart, tend, chunkdays=7, log=logging):
+    '''
+        Compute the quality flags for tstart - tend (datetimes or timestamps)
+        in chunks of chunkdays days, over the monthly shards if db is sharded
+    '''
+    if hasattr(tstart, 'timestamp'):
+        tstart, tend = tstart.timestamp(), tend.timestamp()
+    dbs = [db]
+    if not os.path.isfile(db) and list_shards(db):
+        dbs = shards_for_range(db, tstart, tend)
+
+    nrrows = 0
+    for dbfile in dbs:
+        for chunkstart in np.arange(tstart, tend, chunkdays * 86400.):
+            chunkend = min(chunkstart + chunkdays * 86400., tend)
+            nrrows += update_quality(dbfile, table, chunkstart, chunkend, log=log)
+        log.info('Quality flags of {} done'.format(dbfile))
+
+    return nrrows
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("db", help="the database with the reduced data")
+    parser.add_argument("loc", help="the station, e.g. SABA")
+    parser.add_argument("startdate", nargs=6, type=int, help="start, e.g. 2020 10 30 0 0 0")
+    parser.add_argument("enddate", nargs=6, type=int, help="end")
+    parser.add_argument("--table", default='sep_data_{}', help="the data table")
+    parser.add_argument("--chunkdays", type=int, default=7, help="number of days per query")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    nrrows = run_quality(args.db, args.table.format(args.loc), read_confdate(args.startdate),
+                         read_confdate(args.enddate), chunkdays=args.chunkdays)
+    logging.info('Quality flags of {} rows'.format(nrrows))
@@ -0,0 +1,247 @@
+#! /usr/bin/env python
+'''
+    Compile the 'restrictions' block of a plot configuration into parameterized
+    SQL criteria (for lib.tools.get_sqlite_data) or into a mask on column arrays.
+
+    A restriction is given per variable:
+        'elevation': {'min': 25.}                   elevation > 25
+        'sig1_S4': {'min': 0.1, 'max': 1.5}         0.1 < sig1_S4 < 1.5
+        'SVID': {'in': [3, 4, 5]}                   SVID IN (3, 4, 5)
+        'SVID': {'not_in': [120, 121]}
+        'SVID': 'galileo'                           constellation name(s)
+        'constellation': ['gps', 'galileo']         the same, as separate key
+        'arc_id': [12, 13]                          whole satellite passes (see lib.arcs)
+        'multipath': 'SABA'                         not in the multipath mask of the
+                                                    station (or a .npz, see lib.multipath)
+        'qflag': 'any'                              without quality flags (see lib.quality)
+        'qflag': ['tec_slip', 'tec_outlier']        without these flags
+        'kp': {'min': 4.9}                          while a space-weather index (any file
+                                                    in ./spaceweather/) is in range
+                                                    (see lib.spaceweather)
+'''
+
+import logging
+import sqlite3
+import argparse
+
+import numpy as np
+
+from lib.constants import HEADER_NAMES, REDUCED_NAMES, SATRANGE
+from lib.pierce import DERIVED_NAMES
+from lib.roti import ROTI_NAMES
+from lib.multipath import load_mask
+from lib.quality import QFLAG_COLUMN, flag_bits
+from lib.shards import database_files, connect_readonly
+from lib.spaceweather import is_index, condition_mask, condition_periods, periods_criterion
+
+# the columns of the reduced table that can be restricted when the columns of
+# the table are not known: anything else is refused, since the names end up in
+# the SQL statement
+RESTRICTABLE = HEADER_NAMES + REDUCED_NAMES + DERIVED_NAMES + ROTI_NAMES + ['timestamp', 'arc_id', QFLAG_COLUMN]
+
+# the columns that are worth an index for selective queries
+INDEX_NAMES = ['elevation', 'sig1_S4']
+
+
+def _is_set(value):
+    '''
+        A limit from a YAML file may be None or 'None'
+    '''
+    return value is not None and value != 'None'
+
+def _constellation_ranges(names):
+    '''
+        Give the SVID ranges (first, last + 1) for constellation name(s)
+    '''
+    if isinstance(names, str):
+        names = [names]
+    try:
+        return [SATRANGE[name.lower()] for name in names]
+    except KeyError as kerr:
+        raise ValueError('Unknown constellation {}, choose from {}'.format(kerr, list(SATRANGE.keys())))
+
+def table_columns(db, table):
+    '''
+        The columns of table in db (those that all shards have if db is
+        sharded), None if there is no such table
+    '''
+    columns = None
+    for dbfile in database_files(db):
+        conn = connect_readonly(dbfile)
+        c = conn.cursor()
+        c.execute('PRAGMA table_info({})'.format(table))
+        own = [col[1] for col in c.fetchall()]
+        conn.close()
+        if own:
+            columns = own if columns is None else [col for col in columns if col in own]
+    return columns or None
+
+def _is_names(spec):
+    '''
+        A (non-empty list of) name(s), such as constellations or flags
+    '''
+    return isinstance(spec, str) or (isinstance(spec, (list, tuple)) and len(spec) > 0 and
+                                     all(isinstance(s, str) for s in spec))
+
+def _normalise(restrictions, columns=None):
+    '''
+        Turn the restrictions into a list of (variable, operator, value);
+        the variables must be in columns (those of the table), or in
+        RESTRICTABLE when they are not given
+    '''
+    known = RESTRICTABLE if columns is None else columns
+    terms = []
+    for rvar, spec in restrictions.items():
+        if rvar == 'constellation':
+            terms.append(('SVID', 'constellation', _constellation_ranges(spec)))
+            continue
+        if rvar == 'multipath':
+            if _is_set(spec):
+                terms.append(('azimuth', 'multipath', load_mask(spec)))
+            continue
+        if rvar == QFLAG_COLUMN and _is_names(spec):
+            terms.append((QFLAG_COLUMN, 'flags', flag_bits(spec)))
+            continue
+        if rvar not in known and is_index(rvar):
+            terms.append(('timestamp', 'index', {rvar: spec}))
+            continue
+        if rvar not in known:
+            raise ValueError('Cannot restrict on {}: not a column of the {}'.format(
+                             rvar, 'reduced data' if columns is None else 'table'))
+
+        if rvar == 'SVID' and _is_names(spec):
+            terms.append(('SVID', 'constellation', _constellation_ranges(spec)))
+        elif isinstance(spec, dict):
+            if 'min' in spec and _is_set(spec['min']):
+                terms.append((rvar, '>', float(spec['min'])))
+            if 'max' in spec and _is_set(spec['max']):
+                terms.append((rvar, '<', float(spec['max'])))
+            if 'in' in spec and _is_set(spec['in']):
+                terms.append((rvar, 'in', list(spec['in'])))
+            if 'not_in' in spec and _is_set(spec['not_in']):
+                terms.append((rvar, 'not_in', list(spec['not_in'])))
+        elif isinstance(spec, (list, tuple)):
+            terms.append((rvar, 'in', list(spec)))
+        else:
+            terms.append((rvar, 'in', [spec]))
+
+    return terms
+
+def compile_restrictions(restrictions, columns=None, tstart=None, tend=None, log=logging):
+    '''
+        Compile the restrictions into a list of SQL criteria and their parameters,
+        to be used as get_sqlite_data(..., restrict_crit=crit, restrict_params=params);
+        columns are those of the table (see table_columns), tstart - tend
+        (datetimes or timestamps) the period of the query, if known
+    '''
+    crit, params = [], []
+    if not restrictions:
+        return crit, params
+    if hasattr(tstart, 'timestamp'):
+        tstart = tstart.timestamp()
+    if hasattr(tend, 'timestamp'):
+        tend = tend.timestamp()
+
+    for rvar, operator, value in _normalise(restrictions, columns=columns):
+        if operator in ('>', '<'):
+            crit.append('{} {} ?'.format(rvar, operator))
+            params.append(value)
+        elif operator in ('in', 'constellation', 'not_in') and not value:
+            # nothing is in an empty list
+            if operator != 'not_in':
+                crit.append('0')
+        elif operator in ('in', 'not_in'):
+            crit.append('{} {} ({})'.format(rvar, 'IN' if operator == 'in' else 'NOT IN',
+                                            ','.join('?' * len(value))))
+            params.extend(value)
+        elif operator == 'constellation':
+            # ranges instead of long IN lists, so an index on SVID can be used
+            crit.append('({})'.format(' OR '.join('{} BETWEEN ? AND ?'.format(rvar) for _ in value)))
+            for first, last in value:
+                params.extend([first, last - 1])
+        elif operator == 'multipath':
+            crit.append(value.sql_criterion())
+        elif operator == 'flags':
+            # not checked (NULL) counts as not flagged
+            crit.append('(COALESCE({}, 0) & ?) = 0'.format(rvar))
+            params.append(value)
+        elif operator == 'index':
+            # the periods of the query in which the index is in range
+            crit.append(periods_criterion(condition_periods(value, tstart=tstart, tend=tend), column=rvar))
+
+    log.debug('Compiled restrictions {} into {} with {}'.format(restrictions, crit, params))
+    return crit, params
+
+def restriction_mask(restrictions, columns):
+    '''
+        Apply the restrictions to a dict of column arrays: give the mask of the
+        rows that satisfy all restrictions (NaN never does)
+    '''
+    nrows = len(next(iter(columns.values())))
+    mask = np.ones(nrows, dtype=bool)
+    if not restrictions:
+        return mask
+
+    for rvar, operator, value in _normalise(restrictions):
+        coldata = columns[rvar]
+        if operator == '>':
+            mask &= coldata > value
+        elif operator == '<':
+            mask &= coldata < value
+        elif operator == 'in':
+            mask &= np.isin(coldata, value)
+        elif operator == 'not_in':
+            mask &= ~np.isin(coldata, value)
+        elif operator == 'constellation':
+            in_range = np.zeros(nrows, dtype=bool)
+            for first, last in value:
+                in_range |= (coldata >= first) & (coldata < last)
+            mask &= in_range
+        elif operator == 'multipath':
+            mask &= ~value.lookup(columns['azimuth'], columns['elevation'])
+        elif operator == 'flags':
+            mask &= (np.nan_to_num(coldata).astype(np.int64) & value) == 0
+        elif operator == 'index':
+            mask &= condition_mask(value, coldata)
+
+    return mask
+
+def create_column_indexes(db, table, columns=None, log=logging):
+    '''
+        Create indexes on columns such as elevation and S4, so that selective
+        restrictions do not need a full scan; in every shard if db is sharded
+    '''
+    if columns is None:
+        columns = INDEX_NAMES
+
+    dbfiles = database_files(db)
+    if not dbfiles:
+        raise ValueError('No database or shards {}'.format(db))
+    for dbfile in dbfiles:
+        existing = table_columns(dbfile, table) or []
+        for column in columns:
+            if column not in existing:
+                raise ValueError('Cannot index {}: not a column of {} in {}'.format(column, table, dbfile))
+
+        conn = sqlite3.connect(dbfile)
+        c = conn.cursor()
+        for column in columns:
+            log.debug('Create index on {} in {} of {}'.format(column, table, dbfile))
+            c.execute('CREATE INDEX IF NOT EXISTS "idx_{}" ON {} ("{}")'.format(column, table, column))
+
+        # let the query planner know how selective the indexes are
+        c.execute('ANALYZE {}'.format(table))
+        conn.commit()
+        conn.close()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("db", help="the database in which to create the indexes")
+    parser.add_argument("table", help="the table, e.g. sep_data_SABA")
+    parser.add_argument("columns", nargs='*', default=None,
+                        help="the columns to index (default: {})".format(INDEX_NAMES))
+    args = parser.parse_args()
+
+    create_column_indexes(args.db, args.table, columns=args.columns or None)
@@ -0,0 +1,187 @@
+#! /usr/bin/env python
+'''
+    Rolling statistics per satellite pass: moving mean, standard deviation,
+    median and median absolute deviation (MAD) over a centred window in
+    time, for all passes at once. Windows do not cross the start or end of a
+    pass (lib.arcs), and NaN values are skipped. Works on the long-form
+    columns of a query and on a time x SVID cube (lib.svcube):
+
+        stats = rolling_columns(columns, 'sig1_TEC', 600., stats=['median', 'mad'])
+        detrended = columns['sig1_TEC'] - stats['median']
+        spikes = outlier_mask(columns['sig1_TEC'], stats['median'], stats['mad'])
+
+    Mean and standard deviation come from cumulative sums (linear in the
+    number of rows); median and MAD from a sorted window that slides along
+    every pass, one bisect insert and remove per value (n log w).
+'''
+
+import logging
+from bisect import bisect_left, insort
+
+import numpy as np
+
+from lib.arcs import segment_arcs, ARC_GAP
+
+ROLLING_STATS = ['mean', 'std', 'median', 'mad']
+# the MAD of normally distributed values times this is their standard deviation
+MAD_SCALE = 1.4826
+
+
+def _deviation_kth(window, median, split, k):
+    '''
+        The k-th smallest (from 0) absolute deviation from median of the
+        sorted list window, of which the first split values are below the
+        median: the deviations below and above it are two sorted sequences,
+        the k-th of both together is found by bisection
+    '''
+    nbelow, nabove = split, len(window) - split
+    below = lambda j: median - window[split - 1 - j]
+    above = lambda j: window[split + j] - median
+    # the number of the k + 1 smallest that are below the median
+    low, high = max(0, k + 1 - nabove), min(k + 1, nbelow)
+    while low < high:
+        taken = (low + high) // 2
+        if k - taken >= 0 and taken < nbelow and above(k - taken) > below(taken):
+            low = taken + 1
+        else:
+            high = taken
+    candidates = []
+    if low > 0:
+        candidates.append(below(low - 1))
+    if k + 1 - low > 0:
+        candidates.append(above(k - low))
+    return max(candidates)
+
+def _sliding_median_mad(sorted_values, first, last, rows, mad=True):
+    '''
+        Median and MAD of sorted_values[first:last] for each of rows, whose
+        windows must move forward only (rows in the order of their keys)
+    '''
+    median = np.full(len(rows), np.nan)
+    deviation = np.full(len(rows), np.nan)
+    window = []
+    start = end = 0
+    for idx, row in enumerate(rows):
+        if first[row] >= end:
+            # no overlap with the previous window (next pass, or a gap)
+            window = []
+            start = end = first[row]
+        while start < first[row]:
+            del window[bisect_left(window, sorted_values[start])]
+            start += 1
+        while end < last[row]:
+            insort(window, sorted_values[end])
+            end += 1
+        count = len(window)
+        median[idx] = 0.5 * (window[(count - 1) // 2] + window[count // 2])
+        if mad:
+            split = bisect_left(window, median[idx])
+            deviation[idx] = 0.5 * (_deviation_kth(window, median[idx], split, (count - 1) // 2) +
+                                    _deviation_kth(window, median[idx], split, count // 2))
+    return median, deviation
+
+def rolling_stats(groups, times, values, window, stats=ROLLING_STATS, min_count=1, log=logging):
+    '''
+        The stats (see ROLLING_STATS) of values over [t - window / 2, t +
+        window / 2] (s) around every row, within its group (pass). times are
+        taken in whole seconds. Returns a dict of arrays in the order of the
+        rows, NaN where fewer than min_count values are in the window.
+    '''
+    unknown = [stat for stat in stats if stat not in ROLLING_STATS]
+    if unknown:
+        raise ValueError('Unknown statistic(s) {}, use {}'.format(unknown, ROLLING_STATS))
+    nrows = len(values)
+    result = {stat: np.full(nrows, np.nan) for stat in stats}
+    values = np.asarray(values, dtype=float)
+    valid = np.isfinite(values)
+    if not np.any(valid):
+        return result
+
+    # a key that sorts on group, then time (s since the first)
+    seconds = np.round(np.asarray(times, dtype=float)).astype(np.int64)
+    keys = (np.asarray(groups, dtype=np.int64) << 32) + (seconds - seconds.min())
+    order = np.argsort(keys[valid], kind='mergesort')
+    validkeys = keys[valid][order]
+    sorted_values = values[valid][order]
+
+    half = int(window // 2)
+    first = np.searchsorted(validkeys, keys - half, side='left')
+    last = np.searchsorted(validkeys, keys + half, side='right')
+    count = last - first
+    enough = count >= max(min_count, 1)
+
+    if 'mean' in stats or 'std' in stats:
+        # relative to the overall mean, to keep the sums of squares small
+        offset = sorted_values.mean()
+        cumsum = np.concatenate([[0.], np.cumsum(sorted_values - offset)])
+        cumsumsq = np.concatenate([[0.], np.cumsum((sorted_values - offset) ** 2)])
+        total = cumsum[last[enough]] - cumsum[first[enough]]
+        mean = total / count[enough]
+        if 'mean' in stats:
+            result['mean'][enough] = mean + offset
+        if 'std' in stats:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                variance = (cumsumsq[last[enough]] - cumsumsq[first[enough]] - total * mean) / (count[enough] - 1)
+            result['std'][enough] = np.sqrt(np.maximum(variance, 0.))
+
+    if 'median' in stats or 'mad' in stats:
+        # the windows of the rows in key order only move forward
+        rows = np.flatnonzero(enough)
+        rows = rows[np.argsort(keys[rows], kind='mergesort')]
+        median, mad = _sliding_median_mad(sorted_values.tolist(), first, last, rows, mad='mad' in stats)
+        if 'median' in stats:
+            result['median'][rows] = median
+        if 'mad' in stats:
+            result['mad'][rows] = mad
+        log.debug('Rolling median of {} rows, windows of up to {} values'.format(
+                  len(rows), int(count[rows].max()) if len(rows) else 0))
+
+    return result
+
+def arc_groups(columns, max_gap=ARC_GAP):
+    '''
+        The pass of every row of columns (timestamp, SVID and optionally
+        arc_id or the lock time): arc_id when the rows have it, otherwise
+        the passes are segmented here
+    '''
+    if 'arc_id' in columns and np.all(np.isfinite(columns['arc_id'])):
+        return columns['arc_id'].astype(np.int64)
+    arccolumns = dict(columns)
+    if 'elevation' not in arccolumns:
+        arccolumns['elevation'] = np.full(len(columns['timestamp']), np.nan)
+    groups, _arcs = segment_arcs(arccolumns, max_gap=max_gap)
+    return groups
+
+def rolling_columns(columns, var, window, stats=ROLLING_STATS, min_count=1, max_gap=ARC_GAP, log=logging):
+    '''
+        Rolling stats of var in long-form columns (timestamp, SVID, var and
+        optionally arc_id or the lock time), per pass (see arc_groups)
+    '''
+    return rolling_stats(arc_groups(columns, max_gap=max_gap), columns['timestamp'], columns[var], window,
+                         stats=stats, min_count=min_count, log=log)
+
+def rolling_cube(cube, var, window, stats=ROLLING_STATS, min_count=1, max_gap=ARC_GAP, log=logging):
+    '''
+        Rolling stats of var in a cube (lib.svcube.SatelliteCube), per pass
+        of every satellite: a dict of float32 arrays of the shape of the
+        cube, NaN where var is NaN
+    '''
+    filled = np.isfinite(cube[var])
+    rows, cols = np.nonzero(filled)
+    columns = {'timestamp': cube.times[rows], 'SVID': cube.svids[cols],
+               var: cube[var][rows, cols].astype(np.float64)}
+    stats_of_cells = rolling_columns(columns, var, window, stats=stats, min_count=min_count,
+                                     max_gap=max_gap, log=log)
+    result = {}
+    for stat, values in stats_of_cells.items():
+        result[stat] = np.full(cube.shape, np.nan, dtype=np.float32)
+        result[stat][rows, cols] = values
+    return result
+
+def outlier_mask(values, median, mad, nsigma=3.):
+    '''
+        True where values are more than nsigma robust standard deviations
+        (MAD_SCALE * MAD) from the rolling median
+    '''
+    with np.errstate(invalid='ignore'):
+        return np.abs(values - median) > nsigma * MAD_SCALE * mad
@@ -0,0 +1,351 @@
+#! /usr/bin/env python
+'''
+    Rollup tables with per-hour (and per-minute) statistics of TEC and S4,
+    per satellite (SVID) and per constellation, kept up to date at ingestion.
+    get_statistics answers coarse-resolution requests from the rollups when it
+    can, and from the raw rows otherwise. The hours that were rolled up are
+    recorded, hours without rollups (older data) are read raw. For an
+    archive from before the rollups run
+
+        python -m lib.rollups scint_reduced_SABA.db SABA 2018 1 1 0 0 0 2021 1 1 0 0 0
+'''
+
+import os
+import logging
+import sqlite3
+import argparse
+
+import numpy as np
+
+from lib.tools import get_sqlite_data, rows_to_columns, svid_to_constellation, read_confdate
+from lib.shards import list_shards, database_files, connect_readonly, month_bounds
+from lib.spaceweather import condition_mask, condition_periods, periods_criterion
+
+# the variables that are rolled up
+ROLLUP_VARS = ['sig1_TEC', 'sig1_S4', 'sig2_S4', 'sig3_S4']
+ROLLUP_PERCENTILES = [10, 50, 90]
+
+# (period in s, grouping) of the rollup tables that are maintained
+ROLLUP_LEVELS = [(3600, 'svid'), (3600, 'constellation'), (60, 'constellation')]
+# the rollups are (re)computed, and recorded as covered, per bucket of the longest period
+ROLLUP_SPAN = max(period for period, _group in ROLLUP_LEVELS)
+
+ROLLUP_COLUMNS = ['bucket', 'grp', 'count', 'sum', 'sumsq', 'min', 'max'] + \
+                 ['p{}'.format(pct) for pct in ROLLUP_PERCENTILES]
+
+
+def rollup_table(table, period, group):
+    '''
+        Name of the rollup table of table for a period (s) and grouping
+    '''
+    return 'rollup_{}_{}_{}'.format(table, period, group)
+
+def coverage_table(table):
+    '''
+        Name of the table with the buckets of ROLLUP_SPAN that were rolled up
+    '''
+    return 'rollup_{}_covered'.format(table)
+
+def init_rollup_tables(cursor, table, log=logging):
+    '''
+        Create the rollup tables for a data table, and the table of the
+        buckets they cover
+    '''
+    cursor.execute('CREATE TABLE IF NOT EXISTS {} (bucket INTEGER PRIMARY KEY)'.format(coverage_table(table)))
+    for period, group in ROLLUP_LEVELS:
+        cursor.execute('''CREATE TABLE IF NOT EXISTS {} (
+            bucket INTEGER, grp INTEGER, var TEXT,
+            count INTEGER, sum REAL, sumsq REAL, min REAL, max REAL,
+            {},
+            PRIMARY KEY (bucket, grp, var)
+        )'''.format(rollup_table(table, period, group),
+                    ', '.join('p{} REAL'.format(pct) for pct in ROLLUP_PERCENTILES)))
+
+    return cursor
+
+def _group_of(columns, group):
+    '''
+        The group number of every row: the SVID or the constellation index
+    '''
+    if group == 'svid':
+        return columns['SVID'].astype(np.int64)
+    elif group == 'constellation':
+        return svid_to_constellation(columns['SVID'])
+    raise ValueError('Unknown grouping {}, use svid or constellation'.format(group))
+
+def compute_rollup(columns, var, period, group):
+    '''
+        Vectorized group-by of the rows in columns (needs timestamp, SVID and var)
+        into buckets of period seconds and groups. Returns a dict of arrays with
+        bucket (start time), grp, count, sum, sumsq, min, max and percentiles.
+    '''
+    values = columns[var]
+    valid = np.isfinite(values)
+    values = values[valid]
+    buckets = (np.floor(columns['timestamp'][valid] / period) * period).astype(np.int64)
+    groups = _group_of(columns, group)[valid]
+
+    # sort by (bucket, group) and within a group by value: then the minimum,
+    # maximum and percentiles are simply at known positions
+    order = np.lexsort((values, groups, buckets))
+    values, buckets, groups = values[order], buckets[order], groups[order]
+    newgroup = np.ones(len(values), dtype=bool)
+    newgroup[1:] = (buckets[1:] != buckets[:-1]) | (groups[1:] != groups[:-1])
+    start = np.flatnonzero(newgroup)
+    counts = np.diff(np.append(start, len(values)))
+
+    rollup = {
+        'bucket': buckets[start],
+        'grp': groups[start],
+        'count': counts,
+        'sum': np.add.reduceat(values, start) if len(values) else np.array([]),
+        'sumsq': np.add.reduceat(values ** 2, start) if len(values) else np.array([]),
+        'min': values[start],
+        'max': values[start + counts - 1],
+    }
+    for pct in ROLLUP_PERCENTILES:
+        # linear interpolation between the closest ranks, like np.percentile
+        rank = start + (counts - 1) * pct / 100.
+        below = np.floor(rank).astype(np.int64)
+        above = np.minimum(below + 1, start + counts - 1)
+        rollup['p{}'.format(pct)] = values[below] + (rank - below) * (values[above] - values[below])
+
+    return rollup
+
+def update_rollups(db, table, tstart, tend, log=logging):
+    '''
+        (Re)compute the rollups for all buckets touched by the period tstart - tend
+        (timestamps) from the rows in the database: run after ingestion
+    '''
+    first = np.floor(tstart / ROLLUP_SPAN) * ROLLUP_SPAN
+    last = np.floor(tend / ROLLUP_SPAN) * ROLLUP_SPAN + ROLLUP_SPAN - 1.e-3
+
+    varlist = ROLLUP_VARS + ['SVID', 'timestamp']
+    rows = get_sqlite_data(varlist, db, svid=None, tstart=float(first), tend=float(last),
+                           table=table, log=log)
+    columns = rows_to_columns(rows, varlist)
+
+    conn = sqlite3.connect(db)
+    c = conn.cursor()
+    init_rollup_tables(c, table, log=log)
+    for period, group in ROLLUP_LEVELS:
+        for var in ROLLUP_VARS:
+            rollup = compute_rollup(columns, var, period, group)
+            records = [(int(rollup['bucket'][idx]), int(rollup['grp'][idx]), var) +
+                       tuple(float(rollup[col][idx]) for col in ROLLUP_COLUMNS[2:])
+                       for idx in range(len(rollup['bucket']))]
+            c.executemany('INSERT OR REPLACE INTO {} VALUES ({})'.format(
+                              rollup_table(table, period, group), ','.join('?' * (len(ROLLUP_COLUMNS) + 1))),
+                          records)
+    c.executemany('INSERT OR REPLACE INTO {} VALUES (?)'.format(coverage_table(table)),
+                  [(int(bucket),) for bucket in np.arange(first, last, ROLLUP_SPAN)])
+    conn.commit()
+    conn.close()
+    log.debug('Updated rollups of {} for {} - {} ({} rows)'.format(table, first, last, len(rows)))
+
+def run_rollups(db, table, tstart, tend, chunkdays=7, log=logging):
+    '''
+        Compute the rollups for tstart - tend (datetimes or timestamps) in
+        chunks of chunkdays days, in every monthly shard for its own month
+        if db is sharded: for data from before the rollups
+    '''
+    if hasattr(tstart, 'timestamp'):
+        tstart, tend = tstart.timestamp(), tend.timestamp()
+    if os.path.isfile(db) or not list_shards(db):
+        ranges = [(db, tstart, tend)]
+    else:
+        ranges = []
+        for month, shardfile in list_shards(db):
+            month_start, month_end = month_bounds(month)
+            if month_start <= tend and month_end > tstart:
+                ranges.append((shardfile, max(tstart, month_start), min(tend, month_end - 1.e-3)))
+
+    for dbfile, range_start, range_end in ranges:
+        for chunkstart in np.arange(range_start, range_end, chunkdays * 86400.):
+            update_rollups(dbfile, table, chunkstart, min(chunkstart + chunkdays * 86400., range_end), log=log)
+        log.info('Rollups of {} done'.format(dbfile))
+
+def _read_rollup(db, table, var, period, group, tstart, tend, log=logging):
+    '''
+        Read the stored rollup rows of var (also from monthly shards) and the
+        buckets of ROLLUP_SPAN in tstart - tend that the rollups cover
+    '''
+    name = rollup_table(table, period, group)
+    records, covered = [], []
+    for dbfile in database_files(db, tstart, tend):
+        conn = connect_readonly(dbfile)
+        c = conn.cursor()
+        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (coverage_table(table),))
+        if c.fetchone() is None:
+            conn.close()
+            continue
+        c.execute('SELECT bucket FROM {} WHERE bucket BETWEEN ? AND ?'.format(coverage_table(table)),
+                  (np.floor(tstart / ROLLUP_SPAN) * ROLLUP_SPAN, tend))
+        covered.extend(row[0] for row in c.fetchall())
+        c.execute('SELECT {} FROM {} WHERE var = ? AND bucket BETWEEN ? AND ? ORDER BY bucket'.format(
+                      ','.join(ROLLUP_COLUMNS), name), (var, tstart, tend))
+        records.extend(c.fetchall())
+        conn.close()
+    log.debug('Read {} rollup rows from {}, {} buckets covered'.format(len(records), name, len(covered)))
+
+    return rows_to_columns(records, ROLLUP_COLUMNS), np.unique(np.array(covered, dtype=float))
+
+def _combine(rollup, period):
+    '''
+        Combine rollup rows into coarser buckets of period seconds: counts, sums,
+        minima and maxima are exact, the percentiles become count-weighted means
+        of the finer percentiles (an approximation)
+    '''
+    buckets = (np.floor(rollup['bucket'] / period) * period).astype(np.int64)
+    groups = rollup['grp'].astype(np.int64)
+    keys, inverse = np.unique(np.stack([buckets, groups]), axis=1, return_inverse=True)
+    inverse = inverse.ravel()
+    nr = keys.shape[1]
+
+    combined = {'bucket': keys[0], 'grp': keys[1]}
+    combined['count'] = np.bincount(inverse, weights=rollup['count'], minlength=nr)
+    for col in ('sum', 'sumsq'):
+        combined[col] = np.bincount(inverse, weights=rollup[col], minlength=nr)
+    combined['min'] = np.full(nr, np.inf)
+    np.minimum.at(combined['min'], inverse, rollup['min'])
+    combined['max'] = np.full(nr, -np.inf)
+    np.maximum.at(combined['max'], inverse, rollup['max'])
+    for pct in ROLLUP_PERCENTILES:
+        col = 'p{}'.format(pct)
+        combined[col] = np.bincount(inverse, weights=rollup[col] * rollup['count'],
+                                    minlength=nr) / combined['count']
+
+    return combined
+
+def _finish(stats):
+    '''
+        Add mean and standard deviation to the sums
+    '''
+    count = stats['count'].astype(float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        stats['mean'] = stats['sum'] / count
+        stats['std'] = np.sqrt(np.maximum(stats['sumsq'] / count - stats['mean'] ** 2, 0.) *
+                               count / (count - 1))
+    return stats
+
+def _raw_rollup(var, db, table, tstart, tend, period, group, svid=None, condition=None, periods=None,
+                log=logging):
+    '''
+        The rollup of var for tstart - tend computed from the raw rows, of
+        the rows in periods (start, end) only if given
+    '''
+    varlist = [var, 'SVID', 'timestamp']
+    restrict_crit = None if periods is None else [periods_criterion(periods)]
+    columns = rows_to_columns(get_sqlite_data(varlist, db, svid=svid, tstart=tstart, tend=tend,
+                                              restrict_crit=restrict_crit, table=table, log=log), varlist)
+    if condition:
+        keep = condition_mask(condition, columns['timestamp'])
+        columns = {col: coldata[keep] for col, coldata in columns.items()}
+    return compute_rollup(columns, var, period, group)
+
+def _in_periods(buckets, level, periods):
+    '''
+        Whether buckets of level s lie completely in one of the periods
+        (sorted start, end), and whether they overlap any of them
+    '''
+    if len(periods) == 0:
+        return np.zeros(len(buckets), dtype=bool), np.zeros(len(buckets), dtype=bool)
+    # the last period that starts at or before the bucket, and the next one
+    before = np.searchsorted(periods[:, 0], buckets, side='right') - 1
+    ends = np.where(before >= 0, periods[np.maximum(before, 0), 1], -np.inf)
+    after = np.minimum(before + 1, len(periods) - 1)
+    inside = ends >= buckets + level
+    overlap = (ends > buckets) | ((before + 1 < len(periods)) & (periods[after, 0] < buckets + level))
+    return inside, overlap
+
+def get_statistics(var, db, table, tstart, tend, period=3600, group='svid', svid=None,
+                   condition=None, log=logging):
+    '''
+        Statistics of var per bucket of period seconds and per group (svid or
+        constellation) for tstart - tend (datetimes or timestamps): a dict of arrays
+        with bucket, grp, count, sum, sumsq, mean, std, min, max and percentiles.
+        Answered from the rollup tables if the period is a multiple of a stored
+        rollup period, otherwise computed from the raw rows; the stored buckets
+        that are only partly in tstart - tend, and the hours that were never
+        rolled up, are computed from the raw rows too, so both give the same
+        result for any bounds. With a condition on
+        space-weather indices (see lib.spaceweather.condition_mask) only the
+        rows during which it holds are used: the stored buckets that lie
+        completely in such a period as they are, those partly in one from the
+        raw rows.
+    '''
+    if hasattr(tstart, 'timestamp'):
+        tstart, tend = tstart.timestamp(), tend.timestamp()
+
+    # the coarsest rollup that fits in the requested period (a selection of
+    # satellites can only be made from the rollups per SVID)
+    stored = sorted([level for level, grouping in ROLLUP_LEVELS
+                     if grouping == group and period % level == 0 and var in ROLLUP_VARS],
+                    reverse=True)
+    if svid is not None and group != 'svid':
+        stored = []
+    for level in stored:
+        # the buckets that lie completely in tstart - tend
+        first = np.ceil(tstart / level) * level
+        end = np.floor(tend / level) * level
+        if first >= end:
+            break
+        rollup, covered = _read_rollup(db, table, var, level, group, first, end - level, log=log)
+        if len(covered) == 0:
+            continue
+        log.debug('Statistics of {} from the {} s rollup'.format(var, level))
+        keep = np.isin(np.floor(rollup['bucket'] / ROLLUP_SPAN) * ROLLUP_SPAN, covered)
+        if svid is not None and group == 'svid':
+            keep &= np.isin(rollup['grp'], np.atleast_1d(svid))
+        rollup = {col: coldata[keep] for col, coldata in rollup.items()}
+        parts = []
+        # the hours without rollups from the raw rows
+        spans = np.arange(np.floor(first / ROLLUP_SPAN) * ROLLUP_SPAN, end, ROLLUP_SPAN)
+        missing = spans[~np.isin(spans, covered)]
+        if len(missing):
+            log.warning('No rollups for {} of {} hours of {}, read from the data (see run_rollups)'.format(
+                        len(missing), len(spans), table))
+            # runs of consecutive hours as one period
+            runstart = np.append(True, np.diff(missing) > ROLLUP_SPAN)
+            runend = np.append(runstart[1:], True)
+            parts.append(_raw_rollup(var, db, table, first, end - 1.e-3, level, group, svid=svid,
+                                     condition=condition,
+                                     periods=np.column_stack([missing[runstart], missing[runend] + ROLLUP_SPAN]),
+                                     log=log))
+        if condition:
+            inside, overlap = _in_periods(rollup['bucket'], level,
+                                          condition_periods(condition, tstart=first, tend=end))
+            partial = np.unique(rollup['bucket'][overlap & ~inside])
+            rollup = {col: coldata[inside] for col, coldata in rollup.items()}
+            if len(partial):
+                parts.append(_raw_rollup(var, db, table, first, end - 1.e-3, level, group, svid=svid,
+                                         condition=condition, periods=np.column_stack([partial, partial + level]),
+                                         log=log))
+        # the partial buckets at the edges from the raw rows
+        edges = [(tstart, first - 1.e-3)] if tstart < first else []
+        edges.append((end, tend))
+        parts = [rollup] + parts + [_raw_rollup(var, db, table, edge_start, edge_end, level, group, svid=svid,
+                                                condition=condition, log=log) for edge_start, edge_end in edges]
+        rollup = {col: np.concatenate([part[col] for part in parts]) for col in ROLLUP_COLUMNS}
+        stats = _combine(rollup, period) if period != level else rollup
+        return _finish(stats)
+
+    log.debug('Statistics of {} from the raw data'.format(var))
+    return _finish(_raw_rollup(var, db, table, tstart, tend, period, group, svid=svid,
+                               condition=condition, log=log))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("db", help="the database with the reduced data")
+    parser.add_argument("loc", help="the station, e.g. SABA")
+    parser.add_argument("startdate", nargs=6, type=int, help="start, e.g. 2020 10 30 0 0 0")
+    parser.add_argument("enddate", nargs=6, type=int, help="end")
+    parser.add_argument("--table", default='sep_data_{}', help="the data table")
+    parser.add_argument("--chunkdays", type=int, default=7, help="number of days per query")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    run_rollups(args.db, args.table.format(args.loc), read_confdate(args.startdate),
+                read_confdate(args.enddate), chunkdays=args.chunkdays)
@@ -0,0 +1,174 @@
+#! /usr/bin/env python
+'''
+    Rate of TEC (ROT, TECU/min) and its standard deviation over a sliding
+    window (ROTI), per satellite pass (see lib.arcs). The rates are the
+    phase-based TEC changes over the four 15 s sub-intervals of every row
+    (sig1_dTEC_*): the code-based TEC values are far too noisy to difference,
+    they only tell whether a row has a TEC at all. ROT and ROTI at the time
+    of every row with a TEC are stored in the data table at ingestion; for
+    the archive run
+
+        python -m lib.roti scint_reduced_SABA.db SABA 2018 1 1 0 0 0 2021 1 1 0 0 0
+'''
+
+import os
+import logging
+import sqlite3
+import argparse
+
+import numpy as np
+
+from lib.tools import get_sqlite_data, rows_to_columns, read_confdate
+from lib.arcs import segment_arcs, ARC_LOCKTIME
+from lib.shards import list_shards, shards_for_range
+
+# the phase-based TEC changes of a row and the end of their interval relative to the row (s)
+DTEC_SUBINTERVALS = [('sig1_dTEC_m60_m45', -45.), ('sig1_dTEC_m45_m30', -30.),
+                     ('sig1_dTEC_m30_m15', -15.), ('sig1_dTEC_m15_0', 0.)]
+# length of those intervals (s)
+DTEC_INTERVAL = 15.
+# the TEC of a row: no ROT and ROTI for rows without it
+TEC_NAME = 'sig1_TEC'
+# the derived columns
+ROTI_NAMES = ['sig1_ROT', 'sig1_ROTI']
+# length of the ROTI window (s)
+ROTI_WINDOW = 300.
+# the minimal number of rates in a window for a ROTI
+ROTI_MIN_SAMPLES = 5
+
+
+def init_roti_columns(cursor, table):
+    '''
+        Add the ROT and ROTI columns to table when it does not have them
+    '''
+    cursor.execute('PRAGMA table_info({})'.format(table))
+    existing = [col[1] for col in cursor.fetchall()]
+    for name in ROTI_NAMES:
+        if name not in existing:
+            cursor.execute('ALTER TABLE {} ADD COLUMN {} REAL'.format(table, name))
+
+    return cursor
+
+def compute_roti(columns, window=ROTI_WINDOW, min_samples=ROTI_MIN_SAMPLES):
+    '''
+        ROT (TECU/min) and ROTI over the window ending at the time of every
+        row of columns (timestamp, SVID, elevation, sig1_TEC, the
+        DTEC_SUBINTERVALS that are available and optionally the lock time).
+        Returns two arrays in the order of the rows, NaN where they cannot be
+        computed and for the rows without a TEC.
+    '''
+    nrows = len(columns['timestamp'])
+    rot_of_row, roti = np.full(nrows, np.nan), np.full(nrows, np.nan)
+    if nrows == 0 or not any(var in columns for var, _offset in DTEC_SUBINTERVALS):
+        return rot_of_row, roti
+
+    arc_of_row, _arcs = segment_arcs(columns)
+    timestamps = np.round(columns['timestamp']).astype(np.int64)
+    t0 = timestamps.min() - 60
+
+    # all rates (TECU/min) as one series per pass, at the end of their interval, sorted in time
+    offsets = np.array([offset for var, offset in DTEC_SUBINTERVALS if var in columns], dtype=np.int64)
+    rot = np.column_stack([columns[var] for var, _offset in DTEC_SUBINTERVALS if var in columns])
+    rot = rot.ravel() * 60. / DTEC_INTERVAL
+    times = (timestamps[:, np.newaxis] + offsets[np.newaxis, :]).ravel()
+    arcs = np.repeat(arc_of_row, len(offsets))
+    valid = np.isfinite(rot)
+    times, arcs, rot = times[valid], arcs[valid], rot[valid]
+    # a key that sorts on pass, then time (s since t0)
+    keys = (arcs << 32) + (times - t0)
+    order = np.argsort(keys, kind='stable')
+    keys, rot = keys[order], rot[order]
+    rowkeys = (arc_of_row << 32) + (timestamps - t0)
+
+    # ROT of a row: the rate that ends at its time
+    found = np.searchsorted(keys, rowkeys)
+    match = found < len(keys)
+    match[match] = keys[found[match]] == rowkeys[match]
+    rot_of_row[match] = rot[found[match]]
+
+    # ROTI: the standard deviation of the rates in (t - window, t]
+    first = np.searchsorted(keys, rowkeys - int(window), side='right')
+    last = np.searchsorted(keys, rowkeys, side='right')
+    cumsum = np.concatenate([[0.], np.cumsum(rot)])
+    cumsumsq = np.concatenate([[0.], np.cumsum(rot ** 2)])
+    count = last - first
+    enough = count >= min_samples
+    mean = (cumsum[last[enough]] - cumsum[first[enough]]) / count[enough]
+    meansq = (cumsumsq[last[enough]] - cumsumsq[first[enough]]) / count[enough]
+    roti[enough] = np.sqrt(np.maximum(meansq - mean ** 2, 0.))
+
+    # the rates only come with the TEC: none for the rows without it (data gaps)
+    notec = ~np.isfinite(columns[TEC_NAME]) if TEC_NAME in columns else np.ones(nrows, dtype=bool)
+    rot_of_row[notec], roti[notec] = np.nan, np.nan
+
+    return rot_of_row, roti
+
+def update_roti(db, table, tstart, tend, window=ROTI_WINDOW, log=logging):
+    '''
+        (Re)compute ROT and ROTI of the rows in tstart - tend (timestamps) of
+        db, and of the rows after it whose window reaches into it
+    '''
+    conn = sqlite3.connect(db)
+    c = conn.cursor()
+    init_roti_columns(c, table)
+    c.execute('PRAGMA table_info({})'.format(table))
+    existing = [col[1] for col in c.fetchall()]
+    conn.commit()
+
+    varlist = ['rowid', 'timestamp', 'SVID', 'elevation']
+    varlist += [var for var in [ARC_LOCKTIME, TEC_NAME] + [var for var, _offset in DTEC_SUBINTERVALS]
+                if var in existing]
+    # the rates of a row reach back 60 s
+    span = len(DTEC_SUBINTERVALS) * DTEC_INTERVAL
+    rows = get_sqlite_data(varlist, db, svid=None, tstart=float(tstart - window - span),
+                           tend=float(tend + window + span), table=table, log=log)
+    columns = rows_to_columns(rows, varlist)
+    rot, roti = compute_roti(columns, window=window)
+
+    update = (columns['timestamp'] >= tstart) & (columns['timestamp'] <= tend + window)
+    c.executemany('UPDATE {} SET sig1_ROT = ?, sig1_ROTI = ? WHERE rowid = ?'.format(table),
+                  zip(*[[None if np.isnan(val) else float(val) for val in arr[update]] for arr in (rot, roti)],
+                      columns['rowid'][update].astype(np.int64).tolist()))
+    conn.commit()
+    conn.close()
+    log.debug('ROTI of {} rows in {} - {}'.format(np.sum(update), tstart, tend))
+
+    return int(np.sum(update))
+
+def run_roti(db, table, tstart, tend, chunkdays=7, log=logging):
+    '''
+        Compute ROT and ROTI for tstart - tend (datetimes or timestamps) in
+        chunks of chunkdays days, over the monthly shards if db is sharded
+    '''
+    if hasattr(tstart, 'timestamp'):
+        tstart, tend = tstart.timestamp(), tend.timestamp()
+    dbs = [db]
+    if not os.path.isfile(db) and list_shards(db):
+        # the first window of every shard does not see the end of the previous one
+        dbs = shards_for_range(db, tstart, tend)
+
+    nrrows = 0
+    for dbfile in dbs:
+        for chunkstart in np.arange(tstart, tend, chunkdays * 86400.):
+            chunkend = min(chunkstart + chunkdays * 86400., tend)
+            nrrows += update_roti(dbfile, table, chunkstart, chunkend, log=log)
+        log.info('ROTI of {} done'.format(dbfile))
+
+    return nrrows
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("db", help="the database with the reduced data")
+    parser.add_argument("loc", help="the station, e.g. SABA")
+    parser.add_argument("startdate", nargs=6, type=int, help="start, e.g. 2020 10 30 0 0 0")
+    parser.add_argument("enddate", nargs=6, type=int, help="end")
+    parser.add_argument("--table", default='sep_data_{}', help="the data table")
+    parser.add_argument("--chunkdays", type=int, default=7, help="number of days per query")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    nrrows = run_roti(args.db, args.table.format(args.loc), read_confdate(args.startdate),
+                      read_confdate(args.enddate), chunkdays=args.chunkdays)
+    logging.info('ROT and ROTI of {} rows'.format(nrrows))
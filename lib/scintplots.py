@@ -9,6 +9,7 @@ import matplotlib.pyplot as plt
 from matplotlib.colors import LogNorm
 
 from lib import tools
+from lib.sketch import ExactQuantiles
 
 # make a dict that contains necessary tags to make the plotting work if none are given
 TAGDEF = {
@@ -58,9 +59,10 @@ def scatterplot(xdata, ydata, xname, yname, colorby=None, colorname=None, cmap='
     plt.close(fig)
 
 def hist2D_plot(xdata, xname, ydata, yname, xbins, ybins, xrange=None, yrange=None,
-                tagdict={}, outdir= './', log=logging):
+                tagdict={}, outdir= './', quantiles=None, log=logging):
     '''
-
+        Without a yrange the y axis follows the 2 and 98 percentiles of ydata,
+        from quantiles (lib.sketch, e.g. ISMRDataset.quantiles) if given
     '''
     x_is_time = False
     if tagdict == {}:
@@ -80,8 +82,10 @@ def hist2D_plot(xdata, xname, ydata, yname, xbins, ybins, xrange=None, yrange=No
         ymin, ymax = yrange
         ax.set_ylim(ymin, ymax)
     else:
-        ax.set_ylim(np.nanmin([0., 1.8 * np.nanpercentile(ydata, 2.)]),
-                    np.nanmax([1.8 * np.nanpercentile(ydata, 98.)]) )
+        if quantiles is None:
+            quantiles = ExactQuantiles.from_values(ydata)
+        low, high = quantiles.percentile([2., 98.])
+        ax.set_ylim(np.nanmin([0., 1.8 * low]), np.nanmax([1.8 * high]))
 
     # draw a red line where the zero should be:
     ax.axhline(y=0, color='red', linestyle='-', alpha=0.4)
@@ -109,3 +113,65 @@ def hist2D_plot(xdata, xname, ydata, yname, xbins, ybins, xrange=None, yrange=No
     plt.close(fig)
 
     return hdata, histbins
+
+def percentile_from_counts(counts, edges, pct):
+    '''
+        Percentile (0-100) of binned data: interpolated in the cumulative counts
+    '''
+    cumulative = np.concatenate([[0.], np.cumsum(counts, dtype=float)])
+    if cumulative[-1] == 0:
+        return np.nan
+    return np.interp(pct / 100. * cumulative[-1], cumulative, edges)
+
+def hist2D_counts_plot(counts, xedges, yedges, xname, yname, yrange=None,
+                       tagdict={}, outdir='./', log=logging):
+    '''
+        Plot a 2D histogram that has already been counted (e.g. by the streaming
+        consumers of lib.streaming), in the same way as hist2D_plot
+    '''
+    x_is_time = False
+    if tagdict == {}:
+        tagdict = TAGDEF
+
+    fig, ax = plt.subplots()
+
+    if 'time' in xname.lower():
+        x_is_time = True
+
+    plotcounts = np.ma.masked_equal(counts, 0)
+    ax.pcolormesh(xedges, yedges, plotcounts.T, norm=LogNorm())
+    ax.set_ylabel('{} (binned)'.format(yname))
+    if yrange is not None:
+        ymin, ymax = yrange
+        ax.set_ylim(ymin, ymax)
+    else:
+        ycounts = counts.sum(axis=0)
+        ax.set_ylim(np.nanmin([0., 1.8 * percentile_from_counts(ycounts, yedges, 2.)]),
+                    np.nanmax([1.8 * percentile_from_counts(ycounts, yedges, 98.)]) )
+
+    # draw a red line where the zero should be:
+    ax.axhline(y=0, color='red', linestyle='-', alpha=0.4)
+    ax.set_xlabel('{} (binned)'.format(xname))
+
+    if x_is_time:
+        xlocs = ax.get_xticks()
+        ax.set_xticks(xlocs) # unnecessary?
+        dtlabels = [dt.datetime.fromtimestamp(tlab) for tlab in xlocs]
+        ax.set_xticklabels([dtlab.strftime('%Y-%m-%d') for dtlab in dtlabels])
+        ax.set_xlabel('Time (binned)')
+
+        fig.autofmt_xdate()
+
+    ax.set_title('Histogram as a function of {} for {} at {}'.format(xname, yname, tagdict['location']))
+
+    plotfile = os.path.join(outdir,
+                            'hist2D_{}_{}_{}_{}-{}_sat_{}_{}.png'.format(xname, yname,
+                                    tagdict['location'],
+                                    tagdict['startdt'].strftime('%Y%m%d%H%M'),
+                                    tagdict['enddt'].strftime('%Y%m%d%H%M'),
+                                    tools._sats_for_figname(tagdict['satellites']), tagdict['tag']))
+    log.debug('Saving {}'.format(plotfile))
+    fig.savefig(plotfile)
+    plt.close(fig)
+
+    return counts, [xedges, yedges]
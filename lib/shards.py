@@ -0,0 +1,154 @@
+#! /usr/bin/env python
+'''
+    Monthly shard databases per station: scint_reduced_SABA.db becomes
+    scint_reduced_SABA_201805.db, scint_reduced_SABA_201806.db, ...
+    and a router that queries the shards a time range touches in parallel
+'''
+
+import os
+import glob
+import logging
+import sqlite3
+import datetime as dt
+from urllib.request import pathname2url
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import numpy as np
+
+import lib.tools
+
+
+def shard_name(db, month):
+    '''
+        Name of the shard of database db for month 'YYYYMM' (or (year, month))
+    '''
+    if isinstance(month, (tuple, list)):
+        month = '{:04d}{:02d}'.format(month[0], month[1])
+    base, ext = os.path.splitext(db)
+    return '{}_{}{}'.format(base, month, ext)
+
+def timestamp_to_month(timestamps):
+    '''
+        Give the month 'YYYYMM' (as strings in an array) for each timestamp
+    '''
+    months = np.asarray(timestamps, dtype=float).astype('datetime64[s]').astype('datetime64[M]')
+    return np.char.replace(months.astype(str), '-', '')
+
+def month_bounds(month):
+    '''
+        The start and end timestamps (UTC) of month 'YYYYMM'
+    '''
+    start = np.datetime64('{}-{}'.format(month[:4], month[4:6]), 'M')
+    return tuple(np.array([start, start + 1]).astype('datetime64[s]').astype(float))
+
+def list_shards(db):
+    '''
+        Find the monthly shards that exist for database db,
+        return a sorted list of (YYYYMM, filename)
+    '''
+    base, ext = os.path.splitext(db)
+    shards = []
+    for shardfile in glob.glob('{}_[0-9][0-9][0-9][0-9][0-9][0-9]{}'.format(base, ext)):
+        month = os.path.splitext(shardfile)[0][-6:]
+        shards.append((month, shardfile))
+
+    return sorted(shards)
+
+def shards_for_range(db, tstart=None, tend=None):
+    '''
+        The shards of database db that are touched by the time range tstart - tend
+        (datetimes or timestamps, None means open ended)
+    '''
+    if isinstance(tstart, dt.datetime):
+        tstart = tstart.timestamp()
+    if isinstance(tend, dt.datetime):
+        tend = tend.timestamp()
+
+    month_start = timestamp_to_month([tstart])[0] if tstart is not None else '000000'
+    month_end = timestamp_to_month([tend])[0] if tend is not None else '999999'
+
+    return [shardfile for month, shardfile in list_shards(db)
+            if month_start <= month <= month_end]
+
+def database_files(db, tstart=None, tend=None):
+    '''
+        The files to read for database db: db itself if it exists, otherwise
+        its shards that tstart - tend touch (none if there are no shards)
+    '''
+    if os.path.isfile(db):
+        return [db]
+    return shards_for_range(db, tstart, tend)
+
+def connect_readonly(db):
+    '''
+        Open an existing database read-only, so that reading a path that
+        does not exist fails instead of creating an empty database there
+    '''
+    return sqlite3.connect('file:{}?mode=ro'.format(pathname2url(os.path.abspath(db))), uri=True)
+
+def split_by_month(df):
+    '''
+        Split a dataframe with a timestamp column into the parts per month
+        return dict of YYYYMM: dataframe
+    '''
+    months = timestamp_to_month(df['timestamp'].values)
+    return {month: df[months == month] for month in np.unique(months)}
+
+def _query_shard(args):
+    '''
+        Query a single shard (top level, so it can be sent to a worker process)
+    '''
+    varlist, shardfile, svid, tstart, tend, restrict_crit, restrict_params, table, order_by = args
+    rows = lib.tools.get_sqlite_data(varlist, shardfile, svid=svid, tstart=tstart, tend=tend,
+                                     restrict_crit=restrict_crit, table=table,
+                                     restrict_params=restrict_params, order_by=order_by)
+
+    # make sure that the rows within the shard are in time order
+    if not order_by and 'timestamp' in varlist:
+        tidx = list(varlist).index('timestamp')
+        rows.sort(key=lambda row: row[tidx])
+
+    return rows
+
+def get_sharded_data(varlist, db, svid=12, tstart=None, tend=None,
+                     restrict_crit=None, table='sep_data', restrict_params=None,
+                     order_by=None, workers=4, processes=False, log=logging):
+    '''
+        Get data from the monthly shards of database db: same arguments and output
+        as lib.tools.get_sqlite_data, the shards are queried in parallel by
+        worker threads (or processes) and the rows are concatenated in time order
+        (or in order_by, which should start with timestamp)
+    '''
+    shardfiles = shards_for_range(db, tstart, tend)
+    log.debug('Query {} shards of {}: {}'.format(len(shardfiles), db, shardfiles))
+    if len(shardfiles) == 0:
+        return []
+
+    tasks = [(varlist, shardfile, svid, tstart, tend, restrict_crit, restrict_params, table, order_by)
+             for shardfile in shardfiles]
+    if len(tasks) == 1 or workers <= 1:
+        results = [_query_shard(task) for task in tasks]
+    else:
+        pool = ProcessPoolExecutor if processes else ThreadPoolExecutor
+        with pool(max_workers=min(workers, len(tasks))) as executor:
+            # map keeps the order of the shards, which is the order in time
+            results = list(executor.map(_query_shard, tasks))
+
+    data = []
+    for rows in results:
+        data.extend(rows)
+    log.debug('Shape of sharded data: {}'.format(len(data)))
+
+    return data
+
+def get_sharded_columns(varlist, db, svid=12, tstart=None, tend=None,
+                        restrict_crit=None, table='sep_data', restrict_params=None,
+                        order_by=None, workers=4, processes=False, log=logging):
+    '''
+        As get_sharded_data, but return a dict of numpy column arrays
+    '''
+    data = get_sharded_data(varlist, db, svid=svid, tstart=tstart, tend=tend,
+                            restrict_crit=restrict_crit, table=table,
+                            restrict_params=restrict_params, order_by=order_by, workers=workers,
+                            processes=processes, log=log)
+    return lib.tools.rows_to_columns(data, varlist)
@@ -0,0 +1,156 @@
+#! /usr/bin/env python
+'''
+    Mergeable quantile sketches (a merging t-digest): a variable is summarised
+    in a few hundred weighted centroids, from which any percentile follows
+    without sorting the data again. Sketches of batches, days or datasets can
+    be merged, so they suit data that is streamed (a sketch is a consumer of
+    lib.streaming):
+
+        sketch = QuantileSketch('sig1_TEC')
+        consume(iter_sqlite_data(['sig1_TEC'], db, ...), [sketch])
+        vmin, vmax = sketch.percentile([10., 95.])
+
+    For data that is in memory anyway ExactQuantiles sorts it once and gives
+    the exact percentiles, with the same percentile method.
+'''
+
+import numpy as np
+
+# more centroids is more accurate (the error in a quantile q is about q(1-q)/COMPRESSION)
+COMPRESSION = 200
+
+
+class ExactQuantiles():
+    '''
+        The (non-NaN) values of a variable sorted once: every percentile is an
+        interpolation between two ranks, the same as np.nanpercentile
+    '''
+    def __init__(self, values):
+        values = np.asarray(values, dtype=float).ravel()
+        self.values = np.sort(values[np.isfinite(values)])
+
+    @classmethod
+    def from_values(cls, values):
+        return cls(values)
+
+    @property
+    def count(self):
+        return len(self.values)
+
+    def quantile(self, q):
+        '''
+            The quantile(s) q (0 - 1), linear between the closest ranks
+        '''
+        if len(self.values) == 0:
+            return np.full(np.shape(q), np.nan) if np.ndim(q) else np.nan
+        position = np.asarray(q, dtype=float) * (len(self.values) - 1)
+        low = np.floor(position).astype(np.int64)
+        high = np.minimum(low + 1, len(self.values) - 1)
+        return self.values[low] + (position - low) * (self.values[high] - self.values[low])
+
+    def percentile(self, pct):
+        '''
+            The percentile(s) pct (0 - 100), like np.nanpercentile
+        '''
+        return self.quantile(np.asarray(pct, dtype=float) / 100.)
+
+
+class QuantileSketch():
+    '''
+        t-digest of the (non-NaN) values of a variable. Centroids are small at
+        the tails and large in the middle, so extreme percentiles stay accurate.
+        update(batch) takes a dict of columns (like the consumers of
+        lib.streaming), add(values) an array.
+    '''
+    def __init__(self, var=None, compression=COMPRESSION):
+        self.var = var
+        self.compression = compression
+        self.means = np.array([], dtype=float)
+        self.weights = np.array([], dtype=float)
+        self.min = np.inf
+        self.max = -np.inf
+
+    @classmethod
+    def from_values(cls, values, compression=COMPRESSION):
+        sketch = cls(compression=compression)
+        sketch.add(values)
+        return sketch
+
+    @property
+    def count(self):
+        return np.sum(self.weights)
+
+    def add(self, values):
+        values = np.asarray(values, dtype=float).ravel()
+        values = values[np.isfinite(values)]
+        if len(values) == 0:
+            return
+        self.min = min(self.min, np.min(values))
+        self.max = max(self.max, np.max(values))
+        self._compress(np.append(self.means, values),
+                       np.append(self.weights, np.ones(len(values))))
+
+    def update(self, batch):
+        self.add(batch[self.var])
+
+    def merge(self, other):
+        if len(other.means) == 0:
+            return
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._compress(np.append(self.means, other.means),
+                       np.append(self.weights, other.weights))
+
+    def _compress(self, means, weights):
+        '''
+            Merge sorted centroids into clusters that span at most one unit of
+            the scale function k(q) = compression / (2 pi) * arcsin(2q - 1)
+        '''
+        order = np.argsort(means, kind='mergesort')
+        means, weights = means[order], weights[order]
+        cumulative = np.cumsum(weights)
+        total = cumulative[-1]
+        # the scale at the middle of every centroid decides its cluster
+        qmid = (cumulative - weights / 2.) / total
+        kscale = self.compression / (2. * np.pi) * np.arcsin(2. * qmid - 1.)
+        cluster = np.floor(kscale - kscale[0]).astype(np.int64)
+        _clusters, cluster = np.unique(cluster, return_inverse=True)
+
+        newweights = np.bincount(cluster, weights=weights)
+        self.means = np.bincount(cluster, weights=means * weights) / newweights
+        self.weights = newweights
+
+    def quantile(self, q):
+        '''
+            The quantile(s) q (0 - 1), interpolated between the centroids
+        '''
+        if len(self.means) == 0:
+            return np.full(np.shape(q), np.nan) if np.ndim(q) else np.nan
+        cumulative = np.cumsum(self.weights)
+        centers = cumulative - self.weights / 2.
+        positions = np.concatenate([[0.], centers, [cumulative[-1]]])
+        values = np.concatenate([[self.min], self.means, [self.max]])
+
+        return np.interp(np.asarray(q, dtype=float) * cumulative[-1], positions, values)
+
+    def percentile(self, pct):
+        '''
+            The percentile(s) pct (0 - 100), like np.nanpercentile
+        '''
+        return self.quantile(np.asarray(pct, dtype=float) / 100.)
+
+    def to_blob(self):
+        '''
+            Serialise to bytes: min, max, then the means and the weights
+        '''
+        return np.concatenate([[self.min, self.max], self.means, self.weights]).astype('<f8').tobytes()
+
+    @classmethod
+    def from_blob(cls, blob, var=None, compression=COMPRESSION):
+        data = np.frombuffer(blob, dtype='<f8')
+        sketch = cls(var=var, compression=compression)
+        sketch.min, sketch.max = data[0], data[1]
+        nrcentroids = (len(data) - 2) // 2
+        sketch.means = data[2:2 + nrcentroids].copy()
+        sketch.weights = data[2 + nrcentroids:].copy()
+        return sketch
@@ -0,0 +1,307 @@
+#! /usr/bin/env python
+'''
+    Sky plots: the samples are binned on an azimuth x elevation grid with
+    count, mean, standard deviation and maximum per bin, and drawn as one
+    polar mesh. The grids of every (UTC) day, constellation and variable of
+    SKY_VARS are stored at ingestion, so a sky plot of a week or month only
+    merges a few stored grids:
+
+        grid = get_skygrid('sig1_S4', db, table, tstart, tend, constellation='gps')
+        fig, ax = plt.subplots(subplot_kw={'projection': 'polar'})
+        mesh = draw_skygrid(ax, grid, grid.mean)
+
+    The days of older data without stored grids are binned from the rows;
+    to store them
+
+        python -m lib.skyplot scint_reduced_SABA.db SABA 2018 1 1 0 0 0 2021 1 1 0 0 0
+'''
+
+import logging
+import sqlite3
+import argparse
+
+import numpy as np
+
+from lib.constants import CONSTELLATIONS, SATRANGE
+from lib.tools import get_sqlite_data, rows_to_columns, svid_to_constellation, read_confdate
+from lib.shards import database_files, connect_readonly
+
+# the variables of which the daily grids are stored
+SKY_VARS = ['sig1_TEC', 'sig1_S4', 'sig1_phi60']
+# size of the bins (degrees)
+SKY_AZ_STEP = 5.
+SKY_EL_STEP = 5.
+# what can be drawn per bin
+SKY_STATS = ['mean', 'std', 'max', 'count']
+
+
+def sky_bin_index(azimuth, elevation, az_step=SKY_AZ_STEP, el_step=SKY_EL_STEP):
+    '''
+        The flat index (elevation bin * number of azimuth bins + azimuth bin)
+        of every azimuth, elevation (degrees), -1 where either is NaN
+    '''
+    nel, naz = int(np.ceil(90. / el_step)), int(np.ceil(360. / az_step))
+    azimuth = np.asarray(azimuth, dtype=float)
+    elevation = np.asarray(elevation, dtype=float)
+    valid = np.isfinite(azimuth) & np.isfinite(elevation)
+    index = np.full(azimuth.shape, -1, dtype=np.int64)
+    el_bin = np.clip((elevation[valid] / el_step).astype(np.int64), 0, nel - 1)
+    az_bin = np.clip((azimuth[valid] / az_step).astype(np.int64), 0, naz - 1)
+    index[valid] = el_bin * naz + az_bin
+    return index
+
+
+class SkyGrid():
+    '''
+        Count, sum, sum of squares and maximum of a variable per bin of
+        azimuth x elevation; grids of the same steps can be merged
+    '''
+    def __init__(self, var=None, az_step=SKY_AZ_STEP, el_step=SKY_EL_STEP):
+        self.var = var
+        self.az_step = az_step
+        self.el_step = el_step
+        self.shape = (int(np.ceil(90. / el_step)), int(np.ceil(360. / az_step)))
+        self.count = np.zeros(self.shape)
+        self.sum = np.zeros(self.shape)
+        self.sumsq = np.zeros(self.shape)
+        self.max = np.full(self.shape, np.nan)
+
+    @classmethod
+    def from_values(cls, azimuth, elevation, values, var=None, az_step=SKY_AZ_STEP, el_step=SKY_EL_STEP):
+        grid = cls(var, az_step=az_step, el_step=el_step)
+        grid.add(azimuth, elevation, values)
+        return grid
+
+    def add(self, azimuth, elevation, values):
+        '''
+            Add samples (arrays); NaN values are left out
+        '''
+        values = np.asarray(values, dtype=float)
+        bins = sky_bin_index(azimuth, elevation, self.az_step, self.el_step)
+        keep = (bins >= 0) & np.isfinite(values)
+        bins, values = bins[keep], values[keep]
+        nbins = self.shape[0] * self.shape[1]
+        self.count += np.bincount(bins, minlength=nbins).reshape(self.shape)
+        self.sum += np.bincount(bins, weights=values, minlength=nbins).reshape(self.shape)
+        self.sumsq += np.bincount(bins, weights=values ** 2, minlength=nbins).reshape(self.shape)
+        if len(bins):
+            # maximum: sort on the bin, the maximum of every run of equal bins
+            order = np.argsort(bins, kind='mergesort')
+            sorted_bins = bins[order]
+            start = np.flatnonzero(np.r_[True, sorted_bins[1:] != sorted_bins[:-1]])
+            newmax = np.full(nbins, np.nan)
+            newmax[sorted_bins[start]] = np.maximum.reduceat(values[order], start)
+            self.max = np.fmax(self.max, newmax.reshape(self.shape))
+        return self
+
+    def merge(self, other):
+        if (other.az_step, other.el_step) != (self.az_step, self.el_step):
+            raise ValueError('Cannot merge sky grids of {} and {} degrees'.format(
+                             (self.az_step, self.el_step), (other.az_step, other.el_step)))
+        self.count += other.count
+        self.sum += other.sum
+        self.sumsq += other.sumsq
+        self.max = np.fmax(self.max, other.max)
+        return self
+
+    @property
+    def mean(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > 0, self.sum / self.count, np.nan)
+
+    @property
+    def std(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            variance = (self.sumsq - self.sum ** 2 / self.count) / (self.count - 1)
+        return np.where(self.count > 1, np.sqrt(np.maximum(variance, 0.)), np.nan)
+
+    def statistic(self, stat):
+        if stat not in SKY_STATS:
+            raise ValueError('Unknown statistic {}, use one of {}'.format(stat, SKY_STATS))
+        return getattr(self, stat)
+
+    def to_blob(self):
+        return np.stack([self.count, self.sum, self.sumsq, self.max]).astype(np.float64).tobytes()
+
+    @classmethod
+    def from_blob(cls, blob, var=None, az_step=SKY_AZ_STEP, el_step=SKY_EL_STEP):
+        grid = cls(var, az_step=az_step, el_step=el_step)
+        arrays = np.frombuffer(blob, dtype=np.float64).reshape((4,) + grid.shape)
+        grid.count, grid.sum, grid.sumsq, grid.max = [array.copy() for array in arrays]
+        return grid
+
+
+def draw_skygrid(ax, grid, field, vmin=None, vmax=None, cmap='jet', **kwargs):
+    '''
+        Draw a field of grid (elevation, azimuth) as one mesh on a polar ax:
+        north up, azimuth clockwise, zenith in the centre
+    '''
+    ax.set_theta_zero_location('N')
+    ax.set_theta_direction(-1)
+    theta = np.radians(grid.az_step * np.arange(grid.shape[1] + 1))
+    radius = 90. - grid.el_step * np.arange(grid.shape[0] + 1)
+    mesh = ax.pcolormesh(theta, radius, np.ma.masked_invalid(field), vmin=vmin, vmax=vmax,
+                         cmap=cmap, **kwargs)
+    ax.set_rlim(0., 90.)
+    ax.set_yticks([0., 30., 60., 90.])
+    ax.set_yticklabels(['90', '60', '30', '0'])
+    return mesh
+
+def skygrid_table(table):
+    return 'skygrid_{}'.format(table)
+
+def init_skygrid_table(cursor, table):
+    '''
+        Create the table of sky grids per (UTC) day, constellation and variable
+    '''
+    cursor.execute('''CREATE TABLE IF NOT EXISTS {} (
+        day INTEGER, grp INTEGER, var TEXT, grid BLOB,
+        PRIMARY KEY (var, day, grp)
+    )'''.format(skygrid_table(table)))
+
+    return cursor
+
+def update_skygrids(db, table, tstart, tend, log=logging):
+    '''
+        (Re)compute the stored sky grids of all days touched by tstart - tend
+        (timestamps) from the rows in the database: run after ingestion
+    '''
+    first = np.floor(tstart / 86400.) * 86400.
+    last = np.floor(tend / 86400.) * 86400. + 86400. - 1.e-3
+
+    varlist = SKY_VARS + ['azimuth', 'elevation', 'SVID', 'timestamp']
+    columns = rows_to_columns(get_sqlite_data(varlist, db, svid=None, tstart=float(first),
+                                              tend=float(last), table=table, log=log), varlist)
+    days = (np.floor(columns['timestamp'] / 86400.) * 86400.).astype(np.int64)
+    groups = svid_to_constellation(columns['SVID'])
+
+    records = []
+    for day in np.unique(days):
+        for grp in np.unique(groups[days == day]):
+            rows = (days == day) & (groups == grp)
+            for var in SKY_VARS:
+                grid = SkyGrid.from_values(columns['azimuth'][rows], columns['elevation'][rows],
+                                           columns[var][rows], var=var)
+                records.append((int(day), int(grp), var, grid.to_blob()))
+
+    conn = sqlite3.connect(db)
+    c = conn.cursor()
+    init_skygrid_table(c, table)
+    c.executemany('INSERT OR REPLACE INTO {} VALUES (?,?,?,?)'.format(skygrid_table(table)), records)
+    conn.commit()
+    conn.close()
+    log.debug('Updated {} sky grids of {} for {} - {}'.format(len(records), table, first, last))
+
+def whole_constellations(svid):
+    '''
+        The names of the constellations of which svid (list) holds all
+        satellites and no others, None if it is not such a set
+    '''
+    svids = set(int(sat) for sat in np.atleast_1d(svid))
+    names = [name for name in CONSTELLATIONS if set(range(*SATRANGE[name])) <= svids]
+    covered = set()
+    for name in names:
+        covered.update(range(*SATRANGE[name]))
+    return names if names and covered == svids else None
+
+def get_skygrid(var, db, table, tstart, tend, constellation=None, log=logging):
+    '''
+        Merge the stored sky grids of var for the (UTC) days that lie
+        completely in tstart - tend (datetimes or timestamps) and add the
+        rows of the partial days at the start and end, and of the days
+        without stored grids (older data, see build_skygrids), optionally for
+        some constellation(s) only; None if no whole day is stored
+    '''
+    if hasattr(tstart, 'timestamp'):
+        tstart, tend = tstart.timestamp(), tend.timestamp()
+    first = np.ceil(tstart / 86400.) * 86400.
+    end = np.floor(tend / 86400.) * 86400.
+    if first >= end:
+        return None
+
+    sql_stat = 'SELECT grid FROM {} WHERE var = ? AND day BETWEEN ? AND ?'.format(skygrid_table(table))
+    sql_params = [var, int(first), int(end - 86400.)]
+    svid = None
+    if constellation is not None:
+        names = [constellation] if isinstance(constellation, str) else constellation
+        grps = [CONSTELLATIONS.index(name.lower()) for name in names]
+        sql_stat += ' AND grp IN ({})'.format(','.join('?' * len(grps)))
+        sql_params.extend(grps)
+        svid = [sat for name in names for sat in range(*SATRANGE[name.lower()])]
+
+    grid = None
+    # the days of which grids are stored: the grids of a day are computed
+    # for all constellations at once, so a day without a grid of some
+    # constellation had no data of it
+    stored = []
+    for dbfile in database_files(db, tstart, tend):
+        conn = connect_readonly(dbfile)
+        c = conn.cursor()
+        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (skygrid_table(table),))
+        if c.fetchone() is None:
+            conn.close()
+            continue
+        c.execute('SELECT DISTINCT day FROM {} WHERE var = ? AND day BETWEEN ? AND ?'.format(
+                      skygrid_table(table)), sql_params[:3])
+        stored.extend(row[0] for row in c.fetchall())
+        c.execute(sql_stat, sql_params)
+        for (blob,) in c.fetchall():
+            daygrid = SkyGrid.from_blob(blob, var=var)
+            grid = daygrid if grid is None else grid.merge(daygrid)
+        conn.close()
+    log.debug('Sky grid of {} from {} stored days'.format(var, len(stored)))
+    if not stored:
+        return None
+    grid = SkyGrid(var) if grid is None else grid
+
+    # the partial days at the edges and the days without grids from the rows
+    varlist = [var, 'azimuth', 'elevation']
+    days = np.arange(first, end, 86400.)
+    missing = days[~np.isin(days, stored)]
+    periods = []
+    if len(missing):
+        log.warning('No sky grids for {} of {} days of {}, read from the data (see build_skygrids)'.format(
+                    len(missing), len(days), table))
+        # runs of consecutive days as one period
+        runstart = np.append(True, np.diff(missing) > 86400.)
+        runend = np.append(runstart[1:], True)
+        periods.extend(zip(missing[runstart], missing[runend] + 86400. - 1.e-3))
+    for edgestart, edgeend in [(tstart, first - 1.e-3), (end, tend)] + periods:
+        if edgeend < edgestart:
+            continue
+        columns = rows_to_columns(get_sqlite_data(varlist, db, svid=svid, tstart=float(edgestart),
+                                                  tend=float(edgeend), table=table, log=log), varlist)
+        grid = grid.merge(SkyGrid.from_values(columns['azimuth'], columns['elevation'], columns[var], var=var))
+
+    return grid
+
+def build_skygrids(db, table, tstart, tend, chunkdays=7, log=logging):
+    '''
+        Compute the sky grids of the days of tstart - tend (datetimes or
+        timestamps) from the rows already in the database, in chunks of
+        chunkdays days and over the monthly shards if db is sharded: for
+        databases that were made before the sky grids were stored
+    '''
+    if hasattr(tstart, 'timestamp'):
+        tstart, tend = tstart.timestamp(), tend.timestamp()
+
+    for dbfile in database_files(db, tstart, tend):
+        for chunkstart in np.arange(tstart, tend, chunkdays * 86400.):
+            update_skygrids(dbfile, table, chunkstart, min(chunkstart + chunkdays * 86400., tend), log=log)
+        log.info('Sky grids of {} done'.format(dbfile))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("db", help="the database with the reduced data")
+    parser.add_argument("loc", help="the station, e.g. SABA")
+    parser.add_argument("startdate", nargs=6, type=int, help="start, e.g. 2020 10 30 0 0 0")
+    parser.add_argument("enddate", nargs=6, type=int, help="end")
+    parser.add_argument("--table", default='sep_data_{}', help="the data table")
+    parser.add_argument("--chunkdays", type=int, default=7, help="number of days per query")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    build_skygrids(args.db, args.table.format(args.loc), read_confdate(args.startdate),
+                   read_confdate(args.enddate), chunkdays=args.chunkdays)
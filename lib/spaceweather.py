@@ -0,0 +1,213 @@
+#! /usr/bin/env python
+'''
+    Space-weather indices (Kp, Dst, F10.7, ...) from local CSV files, with a
+    column time (UTC, ISO or timestamp) and the value. An index is loaded
+    once into sorted arrays; values are attached to query results as of the
+    time of every row (the last index value at or before it, within a
+    tolerance), and queries and rollups can be conditioned on it:
+
+        columns = join_indices(columns, ['kp', 'f107'])
+        'restrictions': {'kp': {'min': 4.9}}        all rows while Kp > 4.9
+        get_statistics('sig1_S4', db, table, tstart, tend, condition={'kp': {'min': 4.9}})
+'''
+
+import os
+import logging
+import argparse
+
+import numpy as np
+import pandas as pd
+
+# where the index files are, by the name of the index
+INDEX_PATH = './spaceweather/{}.csv'
+# how long (s) an index value holds: its cadence
+INDEX_TOLERANCE = {'kp': 3 * 3600., 'dst': 3600., 'f107': 86400.}
+
+# the indices that were loaded, by path: (modification time, index)
+_INDICES = {}
+
+
+class IndexSeries():
+    '''
+        The values of an index at sorted times (timestamps)
+    '''
+    def __init__(self, name, times, values, tolerance=None):
+        self.name = name
+        self.times = times
+        self.values = values
+        self.tolerance = INDEX_TOLERANCE.get(name, 3600.) if tolerance is None else tolerance
+
+    @classmethod
+    def from_csv(cls, path, name=None):
+        '''
+            Read a CSV file with a column time and a column with the name of
+            the index (otherwise the first other column)
+        '''
+        name = name or os.path.splitext(os.path.basename(path))[0].lower()
+        frame = pd.read_csv(path, comment='#')
+        frame.columns = [col.strip().lower() for col in frame.columns]
+        valcol = name if name in frame.columns else [col for col in frame.columns if col != 'time'][0]
+        if pd.api.types.is_numeric_dtype(frame['time']):
+            times = frame['time'].values.astype(float)
+        else:
+            times = pd.to_datetime(frame['time'], utc=True).values.astype('datetime64[s]').astype(np.int64)
+        values = pd.to_numeric(frame[valcol], errors='coerce').values.astype(float)
+
+        # sorted on time, the last value of a time is kept
+        order = np.argsort(times, kind='mergesort')
+        times, values = np.asarray(times, dtype=float)[order], values[order]
+        last = np.append(times[1:] != times[:-1], True)
+        return cls(name, times[last], values[last])
+
+    def asof(self, timestamps, tolerance=None):
+        '''
+            The value at or before every timestamp, NaN when the last value
+            is more than tolerance s earlier (or there is none)
+        '''
+        tolerance = self.tolerance if tolerance is None else tolerance
+        timestamps = np.asarray(timestamps, dtype=float)
+        index = np.searchsorted(self.times, timestamps, side='right') - 1
+        found = index >= 0
+        found[found] = timestamps[found] - self.times[index[found]] <= tolerance
+        values = np.full(timestamps.shape, np.nan)
+        values[found] = self.values[index[found]]
+        return values
+
+    def periods(self, vmin=None, vmax=None):
+        '''
+            The periods (array of start, end: timestamps, end not included)
+            in which vmin < value < vmax, as the values hold from their time
+            until the next one, at most tolerance s
+        '''
+        inside = np.isfinite(self.values)
+        with np.errstate(invalid='ignore'):
+            if vmin is not None:
+                inside &= self.values > vmin
+            if vmax is not None:
+                inside &= self.values < vmax
+        start = self.times[inside]
+        following = np.append(self.times[1:], np.inf)[inside]
+        end = np.minimum(following, start + self.tolerance)
+        if len(start) == 0:
+            return np.zeros((0, 2))
+        # merge periods that join up
+        new = np.append(True, start[1:] != end[:-1])
+        first = np.flatnonzero(new)
+        last = np.append(first[1:], len(start)) - 1
+        return np.column_stack([start[first], end[last]])
+
+
+def load_index(spec):
+    '''
+        The index of a name (from INDEX_PATH) or in a .csv file; kept in
+        memory until the file changes
+    '''
+    path = spec if spec.endswith('.csv') else INDEX_PATH.format(spec)
+    if not os.path.isfile(path):
+        raise ValueError('No space-weather index {}'.format(path))
+    mtime = os.path.getmtime(path)
+    if path not in _INDICES or _INDICES[path][0] != mtime:
+        name = None if spec.endswith('.csv') else spec
+        _INDICES[path] = (mtime, IndexSeries.from_csv(path, name=name))
+    return _INDICES[path][1]
+
+def is_index(name):
+    '''
+        True for the indices with a tolerance here or a file in INDEX_PATH
+    '''
+    return name in INDEX_TOLERANCE or os.path.isfile(INDEX_PATH.format(name))
+
+def join_indices(columns, names, tolerance=None, log=logging):
+    '''
+        Add the values of the indices in names as of the timestamp of every
+        row to columns (a dict of arrays), as columns named by the index
+    '''
+    for name in names:
+        columns[name] = load_index(name).asof(columns['timestamp'], tolerance=tolerance)
+        log.debug('Joined {}: {} of {} rows matched'.format(name, np.sum(np.isfinite(columns[name])),
+                                                           len(columns[name])))
+    return columns
+
+def condition_mask(condition, timestamps):
+    '''
+        True at the timestamps where all indices of condition are in their
+        range: {'kp': {'min': 4.9}, 'dst': {'max': -50.}} (limits not included)
+    '''
+    mask = np.ones(np.shape(timestamps), dtype=bool)
+    for name, spec in condition.items():
+        values = load_index(name).asof(timestamps)
+        with np.errstate(invalid='ignore'):
+            if spec.get('min') not in (None, 'None'):
+                mask &= values > float(spec['min'])
+            if spec.get('max') not in (None, 'None'):
+                mask &= values < float(spec['max'])
+        mask &= np.isfinite(values)
+    return mask
+
+def _intersect(periods1, periods2):
+    '''
+        The periods in both of two sorted arrays of periods
+    '''
+    overlap = []
+    first, second = 0, 0
+    while first < len(periods1) and second < len(periods2):
+        start = max(periods1[first, 0], periods2[second, 0])
+        end = min(periods1[first, 1], periods2[second, 1])
+        if start < end:
+            overlap.append((start, end))
+        if periods1[first, 1] < periods2[second, 1]:
+            first += 1
+        else:
+            second += 1
+    return np.array(overlap, dtype=float).reshape(-1, 2)
+
+def condition_periods(condition, tstart=None, tend=None):
+    '''
+        The periods (array of start, end) in which all indices of condition
+        are in range (see condition_mask), those that overlap tstart - tend
+        (timestamps) if given
+    '''
+    periods = None
+    for name, spec in condition.items():
+        vmin = float(spec['min']) if spec.get('min') not in (None, 'None') else None
+        vmax = float(spec['max']) if spec.get('max') not in (None, 'None') else None
+        own = load_index(name).periods(vmin, vmax)
+        periods = own if periods is None else _intersect(periods, own)
+    if periods is None:
+        return np.zeros((0, 2))
+    if tstart is not None:
+        periods = periods[periods[:, 1] > tstart]
+    if tend is not None:
+        periods = periods[periods[:, 0] <= tend]
+    return periods
+
+def periods_criterion(periods, column='timestamp'):
+    '''
+        SQL criterion for the rows in the periods (start, end); the limits
+        are numbers made here, so they are put in the statement. The periods
+        are split in halves: SQLite limits the depth of an expression, and a
+        chain of ORs is as deep as it is long.
+    '''
+    if len(periods) == 0:
+        return '0'
+    if len(periods) == 1:
+        return '({0} >= {1!r} AND {0} < {2!r})'.format(column, float(periods[0][0]), float(periods[0][1]))
+    half = len(periods) // 2
+    return '({} OR {})'.format(periods_criterion(periods[:half], column=column),
+                               periods_criterion(periods[half:], column=column))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("index", help="the index (file {}) or a .csv file".format(INDEX_PATH))
+    parser.add_argument("--min", type=float, default=None, help="lower limit (not included)")
+    parser.add_argument("--max", type=float, default=None, help="upper limit (not included)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    series = load_index(args.index)
+    periods = series.periods(args.min, args.max)
+    for start, end in periods:
+        print('{} - {}'.format(pd.Timestamp(start, unit='s'), pd.Timestamp(end, unit='s')))
+    logging.info('{} periods, {:.1f} hours'.format(len(periods), np.sum(periods[:, 1] - periods[:, 0]) / 3600.))
@@ -0,0 +1,172 @@
+#! /usr/bin/env python
+'''
+    Read query results in batches (with fetchmany) instead of all at once, and
+    aggregate them with consumers that keep a fixed amount of memory:
+    count/mean/variance, minimum/maximum and 1D/2D histograms.
+
+        consumers = [RunningStats('sig1_TEC'), Histogram2D('timestamp', 'sig1_TEC', tbins, tecbins)]
+        consume(iter_sqlite_data(['sig1_TEC', 'timestamp'], db, ...), consumers)
+'''
+
+import os
+import logging
+import sqlite3
+
+import numpy as np
+
+from lib.tools import build_sqlite_query, rows_to_columns
+from lib.pierce import register_math_functions
+from lib.shards import list_shards, shards_for_range
+
+BATCHSIZE = 100000
+
+
+def iter_sqlite_data(varlist, db, svid=None, tstart=None, tend=None, restrict_crit=None,
+                     restrict_params=None, table='sep_data', order_by=None,
+                     batchsize=BATCHSIZE, log=logging):
+    '''
+        Same query as lib.tools.get_sqlite_data, but yield the result in batches
+        of at most batchsize rows, as a dict of column arrays
+    '''
+    if not os.path.isfile(db) and list_shards(db):
+        dbs = shards_for_range(db, tstart, tend)
+    else:
+        dbs = [db]
+
+    sql_stat, sql_params = build_sqlite_query(varlist, svid=svid, tstart=tstart, tend=tend,
+                                              restrict_crit=restrict_crit,
+                                              restrict_params=restrict_params,
+                                              table=table, order_by=order_by, log=log)
+    for dbfile in dbs:
+        log.debug('Stream from {}: {} with {}'.format(dbfile, sql_stat, sql_params))
+        conn = sqlite3.connect(dbfile)
+        register_math_functions(conn)
+        c = conn.cursor()
+        c.execute(sql_stat, sql_params)
+        while True:
+            rows = c.fetchmany(batchsize)
+            if not rows:
+                break
+            yield rows_to_columns(rows, varlist)
+        conn.close()
+
+def consume(batches, consumers, log=logging):
+    '''
+        Feed every batch to every consumer, return the consumers
+    '''
+    nrrows = 0
+    for batch in batches:
+        for consumer in consumers:
+            consumer.update(batch)
+        nrrows += len(next(iter(batch.values())))
+    log.debug('Consumed {} rows'.format(nrrows))
+
+    return consumers
+
+
+class RunningStats():
+    '''
+        Count, mean and variance of a variable (NaN is skipped), updated per batch
+        with the parallel algorithm of Chan et al., so two can be merged as well
+    '''
+    def __init__(self, var):
+        self.var = var
+        self.count = 0
+        self.mean = 0.
+        self.m2 = 0.
+
+    def update(self, batch):
+        values = batch[self.var]
+        values = values[np.isfinite(values)]
+        if len(values) == 0:
+            return
+        other = RunningStats(self.var)
+        other.count = len(values)
+        other.mean = np.mean(values)
+        other.m2 = np.sum((values - other.mean) ** 2)
+        self.merge(other)
+
+    def merge(self, other):
+        count = self.count + other.count
+        if count == 0:
+            return
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta ** 2 * self.count * other.count / count
+        self.count = count
+
+    @property
+    def variance(self):
+        return self.m2 / (self.count - 1) if self.count > 1 else np.nan
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+
+class MinMax():
+    '''
+        Minimum and maximum of a variable (NaN is skipped)
+    '''
+    def __init__(self, var):
+        self.var = var
+        self.min = np.inf
+        self.max = -np.inf
+
+    def update(self, batch):
+        values = batch[self.var]
+        values = values[np.isfinite(values)]
+        if len(values) == 0:
+            return
+        self.min = min(self.min, np.min(values))
+        self.max = max(self.max, np.max(values))
+
+    def merge(self, other):
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+
+class Histogram1D():
+    '''
+        Histogram of a variable with fixed bin edges
+    '''
+    def __init__(self, var, edges):
+        self.var = var
+        self.edges = np.asarray(edges, dtype=float)
+        self.counts = np.zeros(len(self.edges) - 1, dtype=np.int64)
+
+    def update(self, batch):
+        values = batch[self.var]
+        counts, _edges = np.histogram(values[np.isfinite(values)], bins=self.edges)
+        self.counts += counts
+
+    def merge(self, other):
+        self.counts += other.counts
+
+
+class Histogram2D():
+    '''
+        2D histogram of (xvar, yvar) with fixed bin edges, only rows where both are
+        available are counted; xvar or yvar may also be a function of the batch
+        (e.g. to bin in hour of the day)
+    '''
+    def __init__(self, xvar, yvar, xedges, yedges):
+        self.xvar = xvar
+        self.yvar = yvar
+        self.xedges = np.asarray(xedges, dtype=float)
+        self.yedges = np.asarray(yedges, dtype=float)
+        self.counts = np.zeros((len(self.xedges) - 1, len(self.yedges) - 1), dtype=np.int64)
+
+    def _values(self, var, batch):
+        return var(batch) if callable(var) else batch[var]
+
+    def update(self, batch):
+        xdata = self._values(self.xvar, batch)
+        ydata = self._values(self.yvar, batch)
+        valid = np.isfinite(xdata) & np.isfinite(ydata)
+        counts, _xedges, _yedges = np.histogram2d(xdata[valid], ydata[valid],
+                                                  bins=[self.xedges, self.yedges])
+        self.counts += counts.astype(np.int64)
+
+    def merge(self, other):
+        self.counts += other.counts
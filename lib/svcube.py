@@ -0,0 +1,182 @@
+#! /usr/bin/env python
+'''
+    Dense time x SVID cubes: every variable of a query as a 2D float32 array
+    with a row per time slot of a fixed cadence and a column per satellite,
+    NaN where there is no value. The columns are sorted on SVID, so the
+    satellites of a constellation are one block of columns; selections in
+    time, a range of SVID or a constellation are views on the same arrays,
+    and work per satellite is a single operation along the time axis:
+
+        cube = SatelliteCube.from_columns(columns, ['sig1_S4', 'sig1_TEC'])
+        gps = cube.constellation('gps')
+        rate = gps.diff('sig1_TEC') / cube.cadence
+        s4_per_constellation = cube.reduce_constellations('sig1_S4', np.nanmax)
+'''
+
+import logging
+import warnings
+
+import numpy as np
+
+from lib.constants import CONSTELLATIONS, SATRANGE
+
+# the cadence of the ISMR records (s)
+CUBE_CADENCE = 60.
+
+
+class SatelliteCube():
+    '''
+        Variables on a grid of time slots x satellites
+    '''
+    def __init__(self, times, svids, data, cadence=CUBE_CADENCE):
+        '''
+            times: start of every slot (timestamps), svids: the satellite of
+            every column (sorted), data: dict of var to arrays (times, svids)
+        '''
+        self.times = times
+        self.svids = svids
+        self.data = data
+        self.cadence = cadence
+
+    @classmethod
+    def from_columns(cls, columns, varlist, cadence=CUBE_CADENCE, tstart=None, tend=None, log=logging):
+        '''
+            Make the cube of varlist from long-form columns (a dict of arrays
+            with timestamp, SVID and the variables, as from
+            lib.tools.rows_to_columns). A row goes into the slot [t, t +
+            cadence) that holds its time; when a slot has more rows of a
+            satellite the last one is kept.
+        '''
+        timestamps = np.asarray(columns['timestamp'], dtype=float)
+        if tstart is None:
+            tstart = np.floor(np.min(timestamps) / cadence) * cadence if len(timestamps) else 0.
+        if tend is None:
+            tend = np.max(timestamps) if len(timestamps) else tstart
+        nslots = int(np.floor((tend - tstart) / cadence)) + 1
+
+        slots = np.floor((timestamps - tstart) / cadence).astype(np.int64)
+        inside = (slots >= 0) & (slots < nslots)
+        svids, satcol = np.unique(np.asarray(columns['SVID'])[inside].astype(np.int64), return_inverse=True)
+        slots = slots[inside]
+
+        data = {}
+        for var in varlist:
+            cube = np.full((nslots, len(svids)), np.nan, dtype=np.float32)
+            cube[slots, satcol] = np.asarray(columns[var], dtype=float)[inside]
+            data[var] = cube
+        log.debug('Cube of {} slots x {} satellites from {} rows'.format(nslots, len(svids), np.sum(inside)))
+
+        return cls(tstart + cadence * np.arange(nslots), svids, data, cadence=cadence)
+
+    @property
+    def shape(self):
+        return (len(self.times), len(self.svids))
+
+    def __getitem__(self, var):
+        return self.data[var]
+
+    def _select(self, rows, cols):
+        return SatelliteCube(self.times[rows], self.svids[cols],
+                             {var: cube[rows, cols] for var, cube in self.data.items()},
+                             cadence=self.cadence)
+
+    def sel(self, tstart=None, tend=None, svid_range=None):
+        '''
+            The slots in tstart - tend (timestamps) and the satellites in
+            svid_range (first, last + 1): a view, nothing is copied
+        '''
+        first = 0 if tstart is None else np.searchsorted(self.times, tstart, side='left')
+        last = len(self.times) if tend is None else np.searchsorted(self.times, tend, side='right')
+        cols = slice(None)
+        if svid_range is not None:
+            cols = slice(*np.searchsorted(self.svids, svid_range, side='left'))
+        return self._select(slice(first, last), cols)
+
+    def take(self, svid):
+        '''
+            The columns of the satellites in svid (list); this copies
+        '''
+        return self._select(slice(None), np.flatnonzero(np.isin(self.svids, svid)))
+
+    def constellation(self, name):
+        '''
+            The satellites of a constellation (lib.constants.SATRANGE), a view
+        '''
+        return self.sel(svid_range=SATRANGE[name.lower()])
+
+    def satellite(self, var, svid):
+        '''
+            The time series of var of one satellite (a view), None if the
+            cube does not have it
+        '''
+        col = np.searchsorted(self.svids, svid)
+        if col >= len(self.svids) or self.svids[col] != svid:
+            return None
+        return self.data[var][:, col]
+
+    def diff(self, var, lag=1):
+        '''
+            The difference of var with lag slots earlier, per satellite; NaN
+            for the first lag slots
+        '''
+        result = np.full(self.data[var].shape, np.nan, dtype=np.float32)
+        result[lag:] = self.data[var][lag:] - self.data[var][:-lag]
+        return result
+
+    def smooth(self, var, window, min_count=1):
+        '''
+            Running mean of var over window slots (centred), per satellite,
+            skipping NaN; NaN where fewer than min_count values are in the window
+        '''
+        values = self.data[var].astype(np.float64)
+        valid = np.isfinite(values)
+        # cumulative sums with a row of zeros in front: the sum over rows [a, b) is cumsum[b] - cumsum[a]
+        cumsum = np.zeros((values.shape[0] + 1, values.shape[1]))
+        np.cumsum(np.where(valid, values, 0.), axis=0, out=cumsum[1:])
+        cumcount = np.zeros(cumsum.shape)
+        np.cumsum(valid, axis=0, out=cumcount[1:])
+
+        idx = np.arange(values.shape[0])
+        first = np.clip(idx - window // 2, 0, values.shape[0])
+        last = np.clip(idx - window // 2 + window, 0, values.shape[0])
+        count = cumcount[last] - cumcount[first]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = (cumsum[last] - cumsum[first]) / count
+        mean[count < min_count] = np.nan
+        return mean.astype(np.float32)
+
+    def reduce_constellations(self, var, func=np.nanmean):
+        '''
+            Reduce var over the satellites of every constellation with func
+            (e.g. np.nanmean, np.nanmax, which take axis=1). Returns the
+            names of the constellations in the cube and an array (times,
+            constellations).
+        '''
+        names, reduced = [], []
+        for name in CONSTELLATIONS:
+            block = self.constellation(name)
+            if block.shape[1] == 0:
+                continue
+            with warnings.catch_warnings():
+                # slots without any value of the constellation are NaN
+                warnings.simplefilter('ignore', RuntimeWarning)
+                reduced.append(func(block[var], axis=1))
+            names.append(name)
+        if not reduced:
+            return names, np.zeros((len(self.times), 0), dtype=np.float32)
+        return names, np.column_stack(reduced)
+
+    def to_columns(self, varlist=None):
+        '''
+            Back to long form (dict of arrays timestamp, SVID and the
+            variables), for the slots where any of the variables has a value
+        '''
+        varlist = list(self.data) if varlist is None else varlist
+        filled = np.zeros(self.shape, dtype=bool)
+        for var in varlist:
+            filled |= np.isfinite(self.data[var])
+        rows, cols = np.nonzero(filled)
+        columns = {'timestamp': self.times[rows], 'SVID': self.svids[cols]}
+        for var in varlist:
+            columns[var] = self.data[var][rows, cols].astype(np.float64)
+        return columns
@@ -9,11 +9,13 @@ import sys
 import logging
 import yaml
 import sqlite3
+import time
 
 import datetime as dt
 import numpy as np
 
-from lib.constants import TOPO, R_earth
+from lib.constants import TOPO, R_earth, SATRANGE, CONSTELLATIONS
+from lib.pierce import pierce_points, vtec_column, register_math_functions
 
 def init_logger():
     '''
@@ -75,19 +77,11 @@ def interpret_svid(satellites):
     '''
         allow for easier selection of GNSS satellites
     '''
-    SATRANGE = {
-        'gps': np.arange(1,38),
-        'glonass': np.arange(38,62),
-        'galileo': np.arange(71, 103),
-        'sbas': np.arange(120,141),
-        'compass': np.arange(141, 173),
-        'qzss': np.arange(180,188)
-    }
 
     # log.debug('Interpreting: {}: {}'.format(config['satellites'], SATRANGE[config['satellites'].lower()]))
     if isinstance(satellites, str):
         if satellites.lower() in SATRANGE.keys():
-            return SATRANGE[satellites.lower()]
+            return np.arange(*SATRANGE[satellites.lower()])
     elif isinstance(satellites, (tuple, list, np.array)):
         return satellites
     elif '-' in satellites:
@@ -95,6 +89,19 @@ def interpret_svid(satellites):
         s1, sl = satellites.split('-')
         return np.arange(int(s1), int(sl))
 
+def svid_to_constellation(svid):
+    '''
+        Give for each SVID the index of its constellation in SATRANGE
+        (in the order of lib.constants.CONSTELLATIONS), -1 if unknown
+    '''
+    svid = np.asarray(svid)
+    constellation = np.full(svid.shape, -1, dtype=np.int64)
+    for idx, name in enumerate(CONSTELLATIONS):
+        first, last = SATRANGE[name]
+        constellation[(svid >= first) & (svid < last)] = idx
+
+    return constellation
+
 def add_hour_of_day(timedata):
     '''
         Get the time-of-day for each measurement
@@ -116,60 +123,119 @@ def add_second_of_day(timedata):
     print(sod)
     return sod
 
-def get_sqlite_data(varlist, db, svid=12, tstart=None, tend=None,
-                    restrict_crit=None, table='sep_data', log=logging):
+def build_sqlite_query(varlist, svid=12, tstart=None, tend=None, restrict_crit=None,
+                       restrict_params=None, table='sep_data', order_by=None, log=logging):
     '''
-        Get data from SQLite database
+        Make the SQL statement and its parameters to get data from the database,
+        restrict_crit is a list of extra criteria (with ? placeholders for the
+        values in restrict_params, see lib.restrictions), order_by a list of columns;
+        a vertical TEC for another shell height is projected in the query
+        (sig1_vTEC_450, see lib.pierce)
     '''
 
-    log.debug('Connect to SQLite db {}'.format(db))
-    conn = sqlite3.connect(db)
-    c = conn.cursor()
-
-    check_db = False
-    if check_db:
-        checksql = 'PRAGMA table_info({})'.format(table)
-        c.execute(checksql)
-        cols = c.fetchall()
-        log.debug('Columns: {}'.format(cols))
-
     if (isinstance(tstart, dt.datetime) and (isinstance(tend, dt.datetime))):
         timestart, timeend = tstart.timestamp(), tend.timestamp()
     elif (isinstance(tstart, (int, float)) and (isinstance(tend, (int, float)))):
         timestart, timeend = tstart, tend
 
-    sql_stat = 'SELECT {} FROM {}  WHERE ' # SVID = {}'
+    sql_stat = 'SELECT {} FROM {}'.format(','.join(vtec_column(var) for var in varlist), table)
     sql_crit = []
+    sql_params = []
 
     log.debug('Which satellites: {}'.format(svid))
     if svid is None:
-        print('Use all satellite ID (SVID)')
-    elif isinstance(svid, int):
-        sql_crit.append('SVID = {}'.format(svid))
+        log.debug('Use all satellite ID (SVID)')
+    elif isinstance(svid, (int, np.integer)):
+        sql_crit.append('SVID = ?')
+        sql_params.append(int(svid))
+    elif isinstance(svid, (list, tuple, np.ndarray)) and len(svid) == 0:
+        # no satellites: no rows
+        sql_crit.append('0')
     elif isinstance(svid, (list, tuple, np.ndarray)):
-        if len(svid) == 1:
-            sql_crit.append('SVID = {}'.format(svid[0]))
-        else:
-            sql_crit.append('SVID IN {}'.format(tuple(svid)))
+        sql_crit.append('SVID IN ({})'.format(','.join('?' * len(svid))))
+        sql_params.extend(int(sat) for sat in svid)
 
     if tstart is not None:
-        sqltime = 'timestamp BETWEEN {} and {}'.format(timestart, timeend)
-        sql_crit.append(sqltime)
+        sql_crit.append('timestamp BETWEEN ? AND ?')
+        sql_params.extend([timestart, timeend])
 
     if restrict_crit is not None:
         sql_crit.extend(restrict_crit)
+    if restrict_params is not None:
+        sql_params.extend(restrict_params)
 
     log.debug('Criteria: {}'.format(sql_crit))
-    sql_stat += ' AND '.join(sql_crit)
-    vars = ','.join(var for var in varlist)
-    log.debug('Start reading: {}'.format(sql_stat.format(vars, table, svid)))
-    c.execute(sql_stat.format(vars, table, svid))
+    if sql_crit:
+        sql_stat += ' WHERE ' + ' AND '.join(sql_crit)
+    if order_by:
+        sql_stat += ' ORDER BY ' + ', '.join(order_by)
+
+    return sql_stat, sql_params
+
+def second_of_day(timestamps):
+    '''
+        Vectorized second of the day for an array of timestamps, in local time
+        like datetime.fromtimestamp (the offset is looked up once per day)
+    '''
+    timestamps = np.asarray(timestamps, dtype=float)
+    days, day_idx = np.unique(np.floor(timestamps / 86400.), return_inverse=True)
+    offsets = np.array([time.localtime(day * 86400. + 43200.).tm_gmtoff for day in days], dtype=float)
+
+    return (timestamps + offsets[day_idx]) % 86400.
+
+def get_sqlite_data(varlist, db, svid=12, tstart=None, tend=None,
+                    restrict_crit=None, table='sep_data', restrict_params=None,
+                    order_by=None, log=logging):
+    '''
+        Get data from SQLite database
+        if the database itself does not exist, but monthly shards of it do,
+        the query is routed over the shards (see lib.shards)
+    '''
+
+    if not os.path.isfile(db):
+        # imported here: lib.shards uses this function for the separate shards
+        from lib.shards import list_shards, get_sharded_data
+        if list_shards(db):
+            return get_sharded_data(varlist, db, svid=svid, tstart=tstart, tend=tend,
+                                    restrict_crit=restrict_crit, table=table,
+                                    restrict_params=restrict_params, order_by=order_by,
+                                    log=log)
+
+    log.debug('Connect to SQLite db {}'.format(db))
+    conn = sqlite3.connect(db)
+    register_math_functions(conn)
+    c = conn.cursor()
+
+    check_db = False
+    if check_db:
+        checksql = 'PRAGMA table_info({})'.format(table)
+        c.execute(checksql)
+        cols = c.fetchall()
+        log.debug('Columns: {}'.format(cols))
+
+    sql_stat, sql_params = build_sqlite_query(varlist, svid=svid, tstart=tstart, tend=tend,
+                                              restrict_crit=restrict_crit,
+                                              restrict_params=restrict_params,
+                                              table=table, order_by=order_by, log=log)
+    log.debug('Start reading: {} with {}'.format(sql_stat, sql_params))
+    c.execute(sql_stat, sql_params)
     data = c.fetchall()
     log.debug('Shape of data; {}'.format(len(data))) # , data[0].shape))
     log.debug('Data: {}'.format(data[:20])) # , data[0].shape))
 
     return data
 
+def rows_to_columns(rows, varlist):
+    '''
+        Turn the rows from the database into a dict with a numpy array
+        per variable, missing values (None) become NaN
+    '''
+    if len(rows) == 0:
+        return {var: np.array([], dtype=float) for var in varlist}
+
+    data = np.ascontiguousarray(np.array(rows, dtype=float).T)
+    return {var: data[idx] for idx, var in enumerate(varlist)}
+
 def nice_data(plotdata, vars, nrvars=None, log=logging):
     '''
         Make sure that the data does not contain NaN or so
@@ -280,21 +346,15 @@ def azel_to_xy(azimuth, elevation, h=None):
 
     return x,y
 
-def azel_to_latlon(azimuth, elevation, point=TOPO['SABA'], height=300.e3):
+def azel_to_latlon(azimuth, elevation, point=TOPO['SABA'], height=350.):
     '''
-        Compute latitude longitude from azimuth and elevation angle
-        and height in km
-
-        First, distance north and east is computed using height, then from a
-        distance from a certain latlon-point lat and lon.
+        Compute longitude, latitude of the ionospheric pierce point from
+        azimuth and elevation angle and height of the shell in km
+        (spherical thin-shell model, see lib.pierce)
     '''
-    relx, rely = azel_to_xy(azimuth, elevation, h=height)
-    lat_angle = point[0] + (360./2*np.pi) * np.arctan2(rely, 1.e0 * R_earth)
-    lon_angle = point[1] + (360./2*np.pi) * np.arctan2(relx, 1.e0 * R_earth)
-    # result_df['lat'] = lat_angle
-    # result_df['lon'] = lon_angle
+    lat_angle, lon_angle, _obliquity = pierce_points(azimuth, elevation, point=point, height=height)
 
-    return deg_to_lon(lon_angle), lat_angle
+    return lon_angle, lat_angle
 
 def _sats_for_figname(sats, log=logging):
     '''
@@ -11,7 +11,15 @@ import pandas as pd
 import matplotlib.pyplot as plt
 from matplotlib.colors import LogNorm
 
-from lib.tools import get_sqlite_data
+from lib.tools import get_sqlite_data, rows_to_columns
+from lib.constants import CONSTELLATIONS
+from lib.histcube import CUBE_BINS, get_cube_counts
+from lib.pierce import pierce_points, IPP_HEIGHT
+from lib.arcs import segment_arcs
+from lib.scintplots import hist2D_counts_plot
+from lib.rollups import get_statistics
+from lib.sketch import ExactQuantiles
+from lib.skyplot import SKY_VARS, SkyGrid, draw_skygrid, get_skygrid, whole_constellations
 # import read_ismr
 
 
@@ -69,9 +77,12 @@ HEIGHT = 20200 # altitude of GPS satellites in km
 #
 #     return data
 
-def time_plot(var, db, loc=None, svid=None, tstart=None, tend=None, plotdata=None, out='./', log=logging):
+def time_plot(var, db, loc=None, svid=None, tstart=None, tend=None, plotdata=None, out='./',
+              table='sep_data', period=None, log=logging):
     '''
-        Make a plot as a function of time of a variable var in the ismr database db
+        Make a plot as a function of time of a variable var in the ismr database db,
+        of the mean per satellite per period seconds if a period is given (for
+        overviews of long ranges, see lib.rollups.get_statistics)
     '''
 
     try:
@@ -79,37 +90,53 @@ def time_plot(var, db, loc=None, svid=None, tstart=None, tend=None, plotdata=Non
     except OSError as errdir:
         log.warning('Output directory: {}'.format(errdir))
 
-    if plotdata is None:
-        plotdata = get_sqlite_data([var, 'SVID', 'timestamp'], db,
-                                   svid=svid, tstart=tstart, tend=tend, log=log)
-
-    allvardata = np.array([np.float(t[0]) for t in plotdata])
-    sviddata = np.array([np.float(t[1]) for t in plotdata])
-    svids = sorted(np.unique(sviddata))
-    log.debug('Shape of allvardata {}'.format(allvardata.shape))
-    # nanvar = np.array(['nan' in allvar for allvar in allvardata], dtype='bool')
-    nanvar = np.isnan(allvardata)
-    vardata = allvardata[~nanvar]
-    sviddata = sviddata[~nanvar]
-    log.debug('Shape of vardata {}'.format(vardata.shape))
-
-    # log.debug('Shape of plotdata without "nan": {}'.format(plotdata[~nanvar].shape))
-    timestampdata = np.array([np.int(t[2]) for t in plotdata])[~nanvar]
-    log.debug('Where are stupid time values: {}, {}'\
-            .format(timestampdata[timestampdata < 1.e6], np.argwhere(timestampdata < 1.e6)))
-
-    timedata = np.array([dt.datetime.fromtimestamp(t[2]) for t in plotdata])[~nanvar]
-    # timedata = timedata[~np.isnan(vardata)]
-
-    colors = ['b', 'g', 'r', 'c', 'lime', 'k', 'orange']
-    fig, ax = plt.subplots()
-    for idx, sat_id in enumerate(svids):
-        varsviddata = vardata[sviddata == sat_id]
-        timesviddata = timedata[sviddata == sat_id]
-        color = colors[idx % len(colors)]
-        # print('Vardata for SVID {}: \n{} \n{}'.format(svid, varsviddata[0:20], timesviddata[0:20]))
-        ax.plot(timesviddata, varsviddata, linestyle=':', color=color,
-                label=('Sat {}'.format(sat_id)))
+    if period is not None:
+        # statistics per bucket of period seconds, from the rollups where they exist
+        plotdata = get_statistics(var, db, table, tstart, tend, period=period, group='svid',
+                                  svid=svid, log=log)
+        fig, ax = plt.subplots()
+        for sat_id in np.unique(plotdata['grp']):
+            rows = plotdata['grp'] == sat_id
+            timedata = [dt.datetime.fromtimestamp(t) for t in plotdata['bucket'][rows]]
+            ax.plot(timedata, plotdata['mean'][rows], linestyle=':', label='Sat {:.0f}'.format(sat_id))
+    else:
+        if plotdata is None:
+            plotdata = get_sqlite_data([var, 'SVID', 'timestamp'], db,
+                                       svid=svid, tstart=tstart, tend=tend, table=table, log=log)
+
+        allvardata = np.array([np.float(t[0]) for t in plotdata])
+        sviddata = np.array([np.float(t[1]) for t in plotdata])
+        svids = sorted(np.unique(sviddata))
+        log.debug('Shape of allvardata {}'.format(allvardata.shape))
+        # nanvar = np.array(['nan' in allvar for allvar in allvardata], dtype='bool')
+        nanvar = np.isnan(allvardata)
+        vardata = allvardata[~nanvar]
+        sviddata = sviddata[~nanvar]
+        log.debug('Shape of vardata {}'.format(vardata.shape))
+
+        # log.debug('Shape of plotdata without "nan": {}'.format(plotdata[~nanvar].shape))
+        timestampdata = np.array([np.int(t[2]) for t in plotdata])[~nanvar]
+        log.debug('Where are stupid time values: {}, {}'\
+                .format(timestampdata[timestampdata < 1.e6], np.argwhere(timestampdata < 1.e6)))
+
+        timedata = np.array([dt.datetime.fromtimestamp(t[2]) for t in plotdata])[~nanvar]
+        # timedata = timedata[~np.isnan(vardata)]
+
+        # every satellite pass is a separate line
+        arc_of_row, arcs = segment_arcs({'timestamp': timestampdata.astype(float), 'SVID': sviddata,
+                                         'elevation': np.full(len(sviddata), np.nan)})
+        arc_order = np.lexsort((timestampdata, arc_of_row))
+        arc_bounds = np.searchsorted(arc_of_row[arc_order], np.arange(len(arcs['SVID']) + 1))
+
+        colors = ['b', 'g', 'r', 'c', 'lime', 'k', 'orange']
+        fig, ax = plt.subplots()
+        labelled = set()
+        for arc, sat_id in enumerate(arcs['SVID']):
+            rows = arc_order[arc_bounds[arc]:arc_bounds[arc + 1]]
+            color = colors[svids.index(sat_id) % len(colors)]
+            label = 'Sat {}'.format(sat_id) if sat_id not in labelled else None
+            labelled.add(sat_id)
+            ax.plot(timedata[rows], vardata[rows], linestyle=':', color=color, label=label)
     ax.set_title('{} at {}, {}-{}'.format(var, loc,
                                           tstart.strftime('%Y%m%d, %H:%M:%S'),
                                           tend.strftime('%Y%m%d, %H:%M:%S')))
@@ -129,6 +156,8 @@ def time_plot(var, db, loc=None, svid=None, tstart=None, tend=None, plotdata=Non
     if tstart is not None and isinstance(tstart, dt.datetime):
         tag += '_{}-{}'.format(tstart.strftime('%Y%m%d%H%M%S'), tend.strftime('%Y%m%d%H%M%S'))
 
+    if period is not None:
+        tag += '_{:.0f}s'.format(period)
     figname = os.path.join(out, 'sql_time_{}.png'.format(tag))
     log.debug('Saving {}'.format(figname))
     fig.savefig(figname)
@@ -256,6 +285,14 @@ def hist_plot(config, log=logging):
     else:
         svid = None
 
+    if config.get('use_cube', False) and var in CUBE_BINS:
+        cube = get_cube_counts(var, scint_db, tabname, tstart, tend, svid=svid,
+                               xaxis='day', log=log)
+        if cube is not None:
+            cube_hist_plot(config, cube, xaxis='day', log=log)
+            return None
+        log.warning('No histogram cube in {}, histogram from the data'.format(scint_db))
+
     if ('plotdata' not in config) or config['plotdata'] is None:
         query_start = time.time()
         plotdata = get_sqlite_data([var, 'timestamp'], scint_db, table=tabname,
@@ -350,6 +387,14 @@ def hist_plot_hourly(config, log):
     else:
         svid = None
 
+    if config.get('use_cube', False) and var in CUBE_BINS:
+        cube = get_cube_counts(var, scint_db, tabname, tstart, tend, svid=svid,
+                               xaxis='hour', log=log)
+        if cube is not None:
+            cube_hist_plot(config, cube, xaxis='hour', log=log)
+            return None
+        log.warning('No histogram cube in {}, histogram from the data'.format(scint_db))
+
     if ('plotdata' not in config) or config['plotdata'] is None:
         query_start = time.time()
         plotdata = get_sqlite_data([var, 'timestamp'], scint_db, table=tabname,
@@ -401,6 +446,36 @@ def hist_plot_hourly(config, log):
 
     return plotdata
     #####
+def cube_hist_plot(config, cube, xaxis='day', log=logging):
+    '''
+        Make the histogram plots of hist_plot (xaxis='day') or hist_plot_hourly
+        (xaxis='hour') from the counts of a histogram cube (lib.histcube)
+    '''
+    counts, xedges, yedges = cube
+    var = config['plot_var']
+    loc = config['location']
+    svid = config['satellites'] if 'satellites' in config else None
+
+    if xaxis == 'day':
+        # 1D histogram
+        fig, ax = plt.subplots()
+        ax.hist(yedges[:-1], bins=yedges, weights=counts.sum(axis=0), density=True,
+                facecolor='green', alpha=0.75)
+        ax.set_xlabel('{} (binned)'.format(var))
+        ax.set_title('Histogram of {} at {}'.format(var, loc))
+
+        figname = os.path.join(config['outputdir'], 'sql_hist_{}_{}.png'.format(var, loc))
+        log.debug('Saving {}'.format(figname))
+        fig.savefig(figname)
+        plt.close(fig)
+
+    tagdict = {'satellites': 'all' if svid is None else svid, 'location': loc,
+               'startdt': config['startdt'], 'enddt': config['enddt'], 'tag': 'cube'}
+    hist2D_counts_plot(counts, xedges, yedges, 'time' if xaxis == 'day' else 'hour_of_day', var,
+                       yrange=config.get('yrange'), tagdict=tagdict, outdir=config['outputdir'], log=log)
+
+    return counts
+
 def scatterplot(config, log):
     '''
         Plot two quantities in a scatterplot
@@ -413,20 +488,20 @@ def deg_to_lon(angle):
     '''
     return (angle + 180.) % 360 - 180
 
-def azel_to_latlon(result_df, point=topo['SABA'], id=None, height=300):
+def azel_to_latlon(result_df, point=topo['SABA'], id=None, height=IPP_HEIGHT):
     '''
-        Compute latitude longitude from azimuth and elevation angle
-
-        First distance north and east is computed using height, then from a
-        distance from a certain latlon-point lat and lon.
+        Compute latitude longitude of the pierce points at height (km) from
+        azimuth and elevation angle in a dataframe (see lib.pierce)
     '''
-    relx, rely = azel_to_xy(result_df, id=id, h=height)
-    lat_angle = point[0] + np.arctan2(rely, R_earth)
-    lon_angle = point[1] + np.arctan2(relx, R_earth)
+    if id is not None:
+        result_df = result_df[result_df.SVID == id].copy()
+    lat_angle, lon_angle, _obliquity = pierce_points(result_df['azimuth'].values,
+                                                     result_df['elevation'].values,
+                                                     point=point, height=height)
     result_df['lat'] = lat_angle
     result_df['lon'] = lon_angle
 
-    return deg_to_lon(lon_angle), lat_angle, result_df
+    return lon_angle, lat_angle, result_df
 
 def azel_to_xy(df, id=None, h=HEIGHT):
     '''
@@ -470,65 +545,37 @@ def plot_az_el(df, var, cmap='jet'):
     fig.savefig('azelplot_{}_sat{}.png'.format(var, str(id).zfill(2)))
     plt.close(fig)
 
-def plot_az_el_multisat(var, db, svid=None, tstart=None, tend=None, loc='SABA', out='./', cmap='jet', log=None):
+def plot_az_el_multisat(var, db, svid=None, tstart=None, tend=None, loc='SABA', out='./', cmap='jet',
+                        table='sep_data', stat='mean', log=logging):
     '''
-        Plot a variable as function of azimuth and elevation angle
-        following:
-        x = cos e * cos phi
-        y = sin e * sin phi
-
+        Plot a variable as function of azimuth and elevation angle: the stat
+        (mean, std, max, count) per bin of a polar grid, see lib.skyplot.
+        For whole constellations the grids stored per day are merged,
+        otherwise the samples are read and binned.
     '''
-
-    varlist = list([var])
-    varlist.extend(['azimuth', 'elevation', 'SVID'])
-    print(varlist)
-    dbdata = get_sqlite_data(varlist, db, svid=svid, tstart=tstart, tend=tend,
-                             table='sep_data', log=log)
-
-    tempdata = dbdata[0:5]
-    print('From database: {}'.format(dbdata[0:5]))
-    for t in tempdata:
-        print('{}'.format(t))
-    allvardata = np.array([np.float(t[0]) for t in dbdata])
-    azdata = np.array([np.float(t[1]) for t in dbdata])
-    eldata = np.array([np.float(t[2]) for t in dbdata])
-    sviddata = np.array([np.float(t[3]) for t in dbdata])
-
-    nanvar = np.isnan(allvardata)
-    vardata = allvardata[~nanvar]
-    azdata = azdata[~nanvar]
-    eldata = eldata[~nanvar]
-    sviddata = sviddata[~nanvar]
-    df = pd.DataFrame({var: vardata, 'azimuth':azdata, 'elevation':eldata, 'SVID': sviddata})
-    log.debug('Size vardata: {}'.format(vardata.shape))
-
-    fig, ax = plt.subplots()
-
-    # take the minimum and maximum value within the dataframe and use it to
-    # make sure that colors mean the same thing for different
-    # satellite tracks
-    # minval, maxval = np.nanmin(df[var]), np.nanmax(df[var])
-    minval = np.nanpercentile(df[var].astype('float'), 10.)
-    maxval = np.nanpercentile(df[var].astype('float'), 95.)
-    satellites = df['SVID'].unique()
-    # print('Looping over satellites {}\n{}'.format(satellites, df['SVID']))
-    for sat in satellites:
-        if 1: # sat < 37:
-            iddf = df[df.SVID == sat]
-            plotdata = iddf[var].astype(float).values
-            # x, y = azel_to_xy(iddf) # (df, id)
-            x, y, _ = azel_to_latlon(iddf) # (df, id)
-            # print('For sat {} we have {} - {} - {}'.format(sat, len(x), len(y), len(plotdata)))
-            # print('Scale: {} - {}, min, max here {} - {}'.format(minval, maxval, np.nanmin(plotdata), np.nanmax(plotdata)))
-            azel = ax.scatter(x, y, c=plotdata, vmin=minval, vmax=maxval,
-                            cmap=plt.cm.get_cmap(cmap), linewidths=0, edgecolors=None,
-                            # label='sat {}'.format(sat)
-                            )
-            print('Plotted sat {}'.format(sat))
-
-    ax.set_xlabel(u'$x = \cos \ \epsilon \quad \sin \ \phi$')
-    ax.set_ylabel(u'$y = \cos \ \epsilon \quad \cos \ \phi$')
-    ax.set_title('Tracks: {}'.format(var))
+    if tstart is not None and tend is None:
+        # open end: up to now
+        tend = dt.datetime.now() if isinstance(tstart, dt.datetime) else time.time()
+    grid = None
+    constellations = CONSTELLATIONS if svid is None else whole_constellations(svid)
+    if var in SKY_VARS and constellations is not None and tstart is not None:
+        grid = get_skygrid(var, db, table, tstart, tend, constellation=constellations, log=log)
+    if grid is None:
+        varlist = [var, 'azimuth', 'elevation']
+        columns = rows_to_columns(get_sqlite_data(varlist, db, svid=svid, tstart=tstart, tend=tend,
+                                                  table=table, log=log), varlist)
+        grid = SkyGrid.from_values(columns['azimuth'], columns['elevation'], columns[var], var=var)
+    log.debug('Sky grid of {} with {} samples'.format(var, np.sum(grid.count)))
+
+    field = grid.statistic(stat)
+    # make sure that colors mean the same thing for different days
+    minval, maxval = None, None
+    if stat != 'count' and np.any(np.isfinite(field)):
+        minval, maxval = ExactQuantiles.from_values(field).percentile([10., 95.])
+
+    fig, ax = plt.subplots(subplot_kw={'projection': 'polar'})
+    azel = draw_skygrid(ax, grid, field, vmin=minval, vmax=maxval, cmap=plt.cm.get_cmap(cmap))
+    ax.set_title('{} of {}'.format(stat, var))
     plt.colorbar(azel, ax=ax)
     outfig = os.path.join(out, 'azelplot_{}_multisat.png'.format(var))
     fig.savefig(outfig, dpi=400)
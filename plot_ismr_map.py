@@ -4,6 +4,7 @@
 '''
 
 import os
+import datetime as dt
 import numpy as np
 import pandas as pd
 # import cartopy
@@ -11,19 +12,22 @@ import pandas as pd
 import cartopy.crs as ccrs
 import matplotlib.pyplot as plt
 from plot_ismr import get_sqlite_data, azel_to_latlon
+from lib.sketch import ExactQuantiles
+from lib.gridding import LatLonGrid, GRID_STEP, grid_statistics, draw_grid
 
 topo = {
     'SABA': (17.62048, -63.24323),
     'SEUT': (17.47140, -62.97570)
 }
 
-def prepare_map_data(var, db, svid=12, tstart=None, tend=None, loc='SABA', out='./', cmap='jet', log=None):
+def prepare_map_data(var, db, svid=12, tstart=None, tend=None, loc='SABA', out='./', cmap='jet', window=None,
+                     log=None):
     '''
-        Get data to plot on a map
+        Get data to plot on a map, per window (s) if given
     '''
 
     varlist = list([var])
-    varlist.extend(['azimuth', 'elevation', 'SVID'])
+    varlist.extend(['azimuth', 'elevation', 'SVID', 'timestamp'])
     print(varlist)
     dbdata = get_sqlite_data(varlist, db, svid=svid, tstart=tstart, tend=tend, table='sep_data', log=log)
 
@@ -35,28 +39,25 @@ def prepare_map_data(var, db, svid=12, tstart=None, tend=None, loc='SABA', out='
     azdata = np.array([np.float(t[1]) for t in dbdata])
     eldata = np.array([np.float(t[2]) for t in dbdata])
     sviddata = np.array([np.float(t[3]) for t in dbdata])
+    timestampdata = np.array([np.float(t[4]) for t in dbdata])
 
     nanvar = np.isnan(allvardata)
     vardata = allvardata[~nanvar]
     azdata = azdata[~nanvar]
     eldata = eldata[~nanvar]
     sviddata = sviddata[~nanvar]
-    df = pd.DataFrame({var: vardata, 'azimuth':azdata, 'elevation':eldata, 'SVID': sviddata})
+    timestampdata = timestampdata[~nanvar]
+    df = pd.DataFrame({var: vardata, 'azimuth':azdata, 'elevation':eldata, 'SVID': sviddata,
+                       'timestamp': timestampdata})
     log.debug('Size vardata: {}'.format(vardata.shape))
 
     _, _, df_ll = azel_to_latlon(df, point=topo[loc])
-    plot_data_on_map(var, df_ll, topo[loc], outdir=out, cmap=cmap)
+    plot_data_on_map(var, df_ll, topo[loc], outdir=out, cmap=cmap, window=window)
 
-def plot_data_on_map(var, df, midpoint, outdir='./', cmap='jet'):
+def _map_axes(midpoint):
     '''
-        make a map around a midpoint and plot data on it
+        A figure with a map of 5 degrees around midpoint (lat, lon)
     '''
-
-    sphere = ccrs.PlateCarree(globe=ccrs.Globe(datum='WGS84',
-                                               ellipse='sphere'))
-
-
-    # fig, ax = plt.subplots(projection=ccrs.PlateCarree())
     fig = plt.figure()
     ax = plt.axes(projection=ccrs.PlateCarree())
 
@@ -70,35 +71,63 @@ def plot_data_on_map(var, df, midpoint, outdir='./', cmap='jet'):
     gl.xlabels_top = False
     gl.ylabels_right = False
 
-    minval = np.nanpercentile(df[var].astype('float'), 10.)
-    maxval = np.nanpercentile(df[var].astype('float'), 95.)
-    satellites = df['SVID'].unique()
-    # print('Looping over satellites {}\n{}'.format(satellites, df['SVID']))
-    for sat in satellites:
-        if 1: # sat < 37:
-            iddf = df[df.SVID == sat]
-            plotdata = iddf[var].astype(float).values
-            # x, y = azel_to_xy(iddf) # (df, id)
-            lats = iddf['lat']
-            lons = iddf['lon']
-            # x, y = azel_to_latlon(iddf) # (df, id)
-            # print('For sat {} we have {} - {} - {}'.format(sat, len(x), len(y), len(plotdata)))
-            # print('Scale: {} - {}, min, max here {} - {}'.format(minval, maxval, np.nanmin(plotdata), np.nanmax(plotdata)))
-            azel = ax.scatter(lons, lats, c=plotdata, vmin=minval, vmax=maxval,
-                            cmap=plt.cm.get_cmap(cmap), linewidths=0, edgecolors=None,
-                            # label='sat {}'.format(sat)
-                            )
-            # azel = ax.plot(lons, lats, 'b', marker='o')
-            # for i, pt in enumerate(plotdata):
-            #     ax.plot(lats[i], lons[i], 'b', marker='o')
-
-    ax.set_title('Tracks: {}'.format(var))
-    plt.colorbar(azel, ax=ax)
-    outfig = os.path.join(outdir, 'azel_map_{}_multisat.png'.format(var))
+    return fig, ax
+
+def _save_map(fig, ax, layer, outfig):
+    plt.colorbar(layer, ax=ax)
     fig.savefig(outfig, dpi=400)
     plt.close(fig)
     print('Plotted {}'.format(outfig))
 
+def plot_data_on_map(var, df, midpoint, outdir='./', cmap='jet', style='grid', step=GRID_STEP, stat='mean',
+                     quantiles=None, window=None):
+    '''
+        make a map around a midpoint and plot data on it: the stat (mean,
+        max, count) per cell of step degrees, or with style scatter every
+        sample; the colours span the 10 - 95 percentiles of var, from
+        quantiles (lib.sketch) if given. With a window (s) the grid style
+        makes a map per window of the timestamps of df, like the geo plot of
+        simple_plot.ISMRplot.
+    '''
+    plotdata = df[var].astype(float).values
+    if quantiles is None:
+        quantiles = ExactQuantiles.from_values(plotdata)
+    minval, maxval = quantiles.percentile([10., 95.])
+    if style == 'scatter':
+        # all satellites in one layer
+        fig, ax = _map_axes(midpoint)
+        azel = ax.scatter(df['lon'].values, df['lat'].values, c=plotdata, vmin=minval, vmax=maxval,
+                        cmap=plt.cm.get_cmap(cmap), linewidths=0, edgecolors=None,
+                        )
+        ax.set_title('Tracks: {}'.format(var))
+        _save_map(fig, ax, azel, os.path.join(outdir, 'azel_map_{}_multisat.png'.format(var)))
+        return
+
+    if stat == 'count':
+        minval = maxval = None
+    if window is not None and 'timestamp' not in df:
+        raise ValueError('A map per window of {} s needs the timestamps of the data'.format(window))
+    timestamps = df['timestamp'].astype(float).values if 'timestamp' in df else None
+    # midpoint is (lat, lon): the same area as the extent
+    grid = LatLonGrid(midpoint, step=step, half_width=(5., 5.))
+    stats = grid_statistics(grid, df['lat'].values, df['lon'].values, plotdata, timestamps=timestamps,
+                            window=window)
+    for idx, tstart in enumerate(stats['tstart']):
+        if not np.any(stats['count'][idx]):
+            continue
+        fig, ax = _map_axes(midpoint)
+        azel = draw_grid(ax, grid, stats[stat][idx], vmin=minval, vmax=maxval, cmap=plt.cm.get_cmap(cmap),
+                         mask_zero=(stat == 'count'), transform=ccrs.PlateCarree())
+        title = '{} of {} per {} deg'.format(stat, var, step)
+        figname = 'azel_map_{}_multisat.png'.format(var)
+        if window is not None:
+            tfirst = dt.datetime.fromtimestamp(tstart)
+            tlast = dt.datetime.fromtimestamp(tstart + window)
+            title += ', {} - {}'.format(tfirst.strftime('%Y%m%d%H%M'), tlast.strftime('%Y%m%d%H%M'))
+            figname = 'azel_map_{}_multisat_{}.png'.format(var, tfirst.strftime('%Y%m%d%H%M'))
+        ax.set_title(title)
+        _save_map(fig, ax, azel, os.path.join(outdir, figname))
+
 def saba_map(var='TEC', outdir = './'):
     '''
         Plot the surroundings of Saba on a map.
@@ -11,34 +11,16 @@ import numpy as np
 import pandas as pd
 import calendar
 
-HEADER_NAMES = ['weeknumber', 'timeofweek', 'SVID', 'fieldblockvalue']
-#NAMES = ['weeknumber', 'timeofweek', 'SVID', 'fieldblockvalue',
-NAMES = ['azimuth', 'elevation',
-         'sig1_CNO_avg_min', 'sig1_S4', 'sig1_S4_corr', 'sig1_phi01', 'sig1_phi03', 'sig1_phi10', 'sig1_phi30', 'sig1_phi60',
-         'sig1_avgccd', 'sig1_sigmaccd',
-         'sig1_TEC_m45', 'sig1_dTEC_m60_m45',
-         'sig1_TEC_m30', 'sig1_dTEC_m45_m30',
-         'sig1_TEC_m15', 'sig1_dTEC_m30_m15',
-         'sig1_TEC', 'sig1_dTEC_m15_0',
-         'sig1_locktime',
-         'sbf2ismr_version',
-         'sig1_f2_locktime', 'sig1_f2_avg',
-         'sig1_SI', 'sig1_SI_nom', 'p_sig1',
-         'sig2_CNO_avg_min', 'sig2_S4', 'sig2_S4_corr', 'sig2_phi01', 'sig2_phi03', 'sig2_phi10', 'sig2_phi30', 'sig2_phi60',
-         'sig2_avgccd', 'sig2_sigmaccd',
-         'sig2_locktime',
-         'sig2_SI', 'sig2_SI_nom', 'p_sig2',
-         'sig3_CNO_avg_min', 'sig3_S4', 'sig3_S4_corr', 'sig3_phi01', 'sig3_phi03', 'sig3_phi10', 'sig3_phi30', 'sig3_phi60',
-         'sig3_avgccd', 'sig3_sigmaccd',
-         'sig3_locktime',
-         'sig3_SI', 'sig3_SI_nom', 'p_sig3',
-         'sig1_T', 'sig2_T', 'sig3_T'
-         ]
-
-REDUCED_NAMES = ['azimuth', 'elevation', 'sig1_TEC',
-                 'sig1_S4', 'sig1_S4_corr',
-                 'sig2_S4', 'sig2_S4_corr',
-                 'sig3_S4', 'sig3_S4_corr',]
+from lib.constants import HEADER_NAMES, NAMES, REDUCED_NAMES, TOPO
+from lib.pierce import DERIVED_NAMES, add_pierce_points, pierce_height
+from lib.shards import shard_name, split_by_month
+from lib.rollups import update_rollups
+from lib.histcube import update_cube, CUBE_BINS
+from lib.skyplot import update_skygrids
+from lib.events import update_events
+from lib.arcs import update_arcs
+from lib.roti import update_roti
+from lib.quality import update_quality
 
 def dt2ts(dttime):
     """
@@ -74,14 +56,26 @@ def init_db(cursor, tabname='sep_data'):
 
     return cursor
 
-def init_reduced_db(cursor, tabname='sep_data'):
+def _ensure_columns(cursor, tabname, names):
     '''
-        Create table for a reduced set of the the SEPTENTRIO data
+        Add the columns in names that an existing table does not have yet
+        (a database made before they were part of the reduced set)
+    '''
+    cursor.execute('PRAGMA table_info({})'.format(tabname))
+    existing = [col[1] for col in cursor.fetchall()]
+    for name in names:
+        if name not in existing:
+            cursor.execute('ALTER TABLE {} ADD COLUMN {} REAL'.format(tabname, name))
+
+def init_reduced_db(cursor, tabname='sep_data', indexes=None):
+    '''
+        Create table for a reduced set of the the SEPTENTRIO data,
+        optionally with indexes on some columns (e.g. ['elevation', 'sig1_S4'])
     '''
 
     # namelist = 'index INTEGER, '
     namelist = ', '.join('{} INTEGER'.format(name) for name in HEADER_NAMES)
-    namelist += ', ' + ', '.join('{} REAL'.format(name) for name in REDUCED_NAMES)
+    namelist += ', ' + ', '.join('{} REAL'.format(name) for name in REDUCED_NAMES + DERIVED_NAMES)
     namelist += ', timestamp INTEGER'
     create_table_sql = '''CREATE TABLE IF NOT EXISTS {} (
         {},
@@ -94,6 +88,9 @@ def init_reduced_db(cursor, tabname='sep_data'):
         # print('Create table using: {}'.format(create_table_sql))
         cursor.execute(create_table_sql)
         cursor.execute(create_index)
+        _ensure_columns(cursor, tabname, REDUCED_NAMES + DERIVED_NAMES)
+        for column in (indexes or []):
+            cursor.execute('CREATE INDEX IF NOT EXISTS "idx_{}" ON {} ("{}")'.format(column, tabname, column))
     except Exception as e:
         print(e)
 
@@ -123,7 +120,7 @@ def write_to_sqlite(df, dbname='scint.db', tabname='sep_data_{}', loc='SABA'):
 
     return
 
-def write_to_reduced_sqlite(df, dbname='scint.db', tabname='sep_data_{}', loc='SABA'):
+def write_to_reduced_sqlite(df, dbname='scint.db', tabname='sep_data_{}', loc='SABA', indexes=None):
     '''
         Write the data (in dataframe) from a ISMR file to an SQLite database
     '''
@@ -132,13 +129,53 @@ def write_to_reduced_sqlite(df, dbname='scint.db', tabname='sep_data_{}', loc='S
     conn = sqlite3.connect(dbname) #, isolation_level=None)
     c = conn.cursor()
 
-    init_reduced_db(c, tabname=tabname.format(loc))
+    init_reduced_db(c, tabname=tabname.format(loc), indexes=indexes)
+    if 'ipp_lat' not in df and loc in TOPO:
+        # the geometry and vertical TEC are computed once, here, and read by the plots
+        df = add_pierce_points(df.copy(), loc=loc, height=pierce_height(c, tabname.format(loc)))
     success = False
     try:
         df.to_sql('sep_data_{}'.format(loc), conn, if_exists='append', index=False)
         success = True
     except sqlite3.IntegrityError as sqlerr:
         print('Already present in the database: {}, moving on'.format(sqlerr))
+    conn.close()
+
+    if success:
+        update_derived(df, dbname=dbname, tabname=tabname.format(loc), loc=loc)
+
+    return success
+
+def update_derived(df, dbname='scint.db', tabname='sep_data_SABA', loc='SABA'):
+    '''
+        Bring the tables that are derived from the data up to date with the
+        newly written data in df
+    '''
+    if df.shape[0] == 0:
+        return
+
+    tstart, tend = df['timestamp'].min(), df['timestamp'].max()
+    update_rollups(dbname, tabname, tstart, tend)
+    update_skygrids(dbname, tabname, tstart, tend)
+    update_events(dbname, tabname, loc, tstart, tend)
+    update_arcs(dbname, tabname, tstart, tend)
+    update_roti(dbname, tabname, tstart, tend)
+    update_quality(dbname, tabname, tstart, tend)
+    update_cube(dbname, tabname, {col: df[col].values.astype(float)
+                                  for col in ['timestamp', 'SVID'] + list(CUBE_BINS) if col in df})
+
+def write_to_sharded_sqlite(df, dbname='scint.db', tabname='sep_data_{}', loc='SABA', indexes=None):
+    '''
+        Write the data (in dataframe) from a ISMR file to the monthly shards
+        of an SQLite database: dbname scint.db is written to scint_YYYYMM.db
+    '''
+
+    success = True
+    for month, df_month in split_by_month(df).items():
+        shard_db = shard_name(dbname, month)
+        written = write_to_reduced_sqlite(df_month, dbname=shard_db, tabname=tabname, loc=loc,
+                                          indexes=indexes)
+        success = success and written
 
     return success
 
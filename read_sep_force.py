@@ -5,6 +5,7 @@
     a value that is already in the database.
 '''
 import os, sys
+import time
 import datetime as dt
 import argparse
 
@@ -16,9 +17,11 @@ data_location = '/data/storage/trop/users/plas/SW/IONO'
 scint_locations = ['SABA','SEUT']
 db_location = '/data/storage/trop/users/plas/SW/'
 
-def ingest_dir(readdir, instrument_location, target_db):
+def ingest_dir(readdir, instrument_location, target_db, sharded=False, monitor=None):
     '''
-        Ingest a directory of day-of-year directories with hourly ISMR data
+        Ingest a directory of day-of-year directories with hourly ISMR data,
+        in target_db or in its monthly shards if sharded is True;
+        the new rows are passed to the AlertMonitor monitor if given
     '''
 
     exclude = set(['CAL'])
@@ -30,12 +33,20 @@ def ingest_dir(readdir, instrument_location, target_db):
                 continue
             infile = os.path.join(dirname, file)
             if instrument_location in dirname:
+                ingest_time = time.time()
                 ismr_dataframe = read_ismr.read_reduced_ismr(infile)
                 if ismr_dataframe.shape[0] == 0:
                     continue
 
-                written = read_ismr.write_to_reduced_sqlite(ismr_dataframe, dbname=target_db,
-                                                            loc=instrument_location)
+                if sharded:
+                    written = read_ismr.write_to_sharded_sqlite(ismr_dataframe, dbname=target_db,
+                                                                loc=instrument_location)
+                else:
+                    written = read_ismr.write_to_reduced_sqlite(ismr_dataframe, dbname=target_db,
+                                                                loc=instrument_location)
+                if written and monitor is not None:
+                    # alert on the new rows (see lib.alerting)
+                    monitor.process(ismr_dataframe, ingest_time=ingest_time)
 
 
 def read_forced(indir, log, loc='all'):
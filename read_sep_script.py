@@ -8,10 +8,14 @@ import time
 
 # use read functionality:
 import read_ismr
+from lib.alerting import AlertMonitor
 
-def ingest_dir(data_dir, instrument_location, target_db):
+def ingest_dir(data_dir, instrument_location, target_db, sharded=False, monitor=None):
     '''
-
+        Ingest the ISMR files in data_dir in target_db,
+        or in its monthly shards if sharded is True;
+        the new rows are passed to the AlertMonitor monitor if given,
+        oldest file first (the files are read newest first)
     '''
     files_are_new = True
     latest_files_only = True # switch to stop reading if you reach files that you have already read
@@ -22,6 +26,8 @@ def ingest_dir(data_dir, instrument_location, target_db):
     # exclude a CAL directory if it is there: should be ingested separately!
     # https://stackoverflow.com/questions/19859840/excluding-directories-in-os-walk
     exclude = set(['CAL'])
+    # the new files for the monitor: (first time, ingest time, dataframe)
+    pending = []
 
     for (dirname, dirs, files) in os.walk(data_dir, topdown=True):
         dirs[:] = [d for d in dirs if d not in exclude]
@@ -35,12 +41,19 @@ def ingest_dir(data_dir, instrument_location, target_db):
 
             infile = os.path.join(dirname, ismrfile)
             if instrument_location in dirname:
+                ingest_time = time.time()
                 ismr_dataframe = read_ismr.read_reduced_ismr(infile)
                 if ismr_dataframe.shape[0] == 0:
                     continue
 
-                written = read_ismr.write_to_reduced_sqlite(ismr_dataframe, dbname=target_db,
-                                                            loc=instrument_location)
+                if sharded:
+                    written = read_ismr.write_to_sharded_sqlite(ismr_dataframe, dbname=target_db,
+                                                                loc=instrument_location)
+                else:
+                    written = read_ismr.write_to_reduced_sqlite(ismr_dataframe, dbname=target_db,
+                                                                loc=instrument_location)
+                if written and monitor is not None:
+                    pending.append((ismr_dataframe['timestamp'].min(), ingest_time, ismr_dataframe))
                 if written == False: # made distinction between output of routine and files_are_new
                     print('Reached end of new files: break')
                     files_are_new = False
@@ -52,6 +65,9 @@ def ingest_dir(data_dir, instrument_location, target_db):
         if latest_files_only and not files_are_new:
             break
 
+    # alert on the new rows (see lib.alerting) in time order: the windows skip older rows
+    for _first, ingest_time, ismr_dataframe in sorted(pending, key=lambda item: item[0]):
+        monitor.process(ismr_dataframe, ingest_time=ingest_time)
 
 
 def main():
@@ -87,7 +103,10 @@ def main():
         # files_are_new = True
         # latest_files_only = True # switch to stop reading if you reach files that you have already read
         if os.path.isdir(data_dir):
-            ingest_dir(data_dir, instrument_location, ismr_red_db)
+            monitor = AlertMonitor(station=instrument_location,
+                                   logfile=os.path.join(db_location, 'alerts_{}.jsonl'.format(instrument_location)))
+            ingest_dir(data_dir, instrument_location, ismr_red_db, monitor=monitor)
+            monitor.latency_report()
 
         caldir = os.path.join(data_dir, 'CAL')
         if os.path.isdir(caldir):
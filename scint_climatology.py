@@ -9,7 +9,24 @@ import numpy as np
 # local imports
 import lib.tools as tools
 import lib.scintplots
+import lib.streaming as streaming
 import lib.constants as constants
+from lib.climatology import Climatology, update_climatology, get_anomalies
+
+# default bins for TEC: [first edge, last edge, number of edges]
+TECBINS = [-50., 250., 201]
+
+def hour_of_day(batch):
+    '''
+        Hour of the day of the rows in a batch
+    '''
+    return tools.second_of_day(batch['timestamp']) / 3600.
+
+def second_of_day(batch):
+    '''
+        Second of the day of the rows in a batch
+    '''
+    return tools.second_of_day(batch['timestamp'])
 
 
 def main(configfile):
@@ -20,6 +37,7 @@ def main(configfile):
         - create a baseline
         -- read baseline data
         -- determine histogram
+        -- add new days to the stored baseline (lib.climatology)
         - see how other data relates
         -- read other data
         -- subtract baseline signal
@@ -39,27 +57,35 @@ def main(configfile):
 
     config['startdt'] = tools.read_confdate(config['startdate'])
     config['enddt'] = tools.read_confdate(config['enddate'])
-    config['clim']['startdt'] = tools.read_confdate(config['startdate'])
-    config['clim']['enddt'] = tools.read_confdate(config['enddate'])
+    config['clim']['startdt'] = tools.read_confdate(config['clim']['startdate'])
+    config['clim']['enddt'] = tools.read_confdate(config['clim']['enddate'])
     svid = tools.interpret_svid(config['satellites'])
 
     log.debug('Read config: {}'.format(config))
 
-    # Here, take the header, the S4 and TEC and the timestamp:
-    req_list = constants.HEADER_NAMES + ['sig1_S4', 'sig1_TEC', 'timestamp']
+    # Here, take the TEC and the timestamp, and read the (possibly very long)
+    # period in batches, that are binned as they come in:
+    req_list = ['sig1_TEC', 'timestamp']
+    tecbins = np.linspace(*config['clim'].get('tecbins', TECBINS))
+    timebins = np.linspace(config['clim']['startdt'].timestamp(),
+                           config['clim']['enddt'].timestamp(), 301)
+    hist_time = streaming.Histogram2D('timestamp', 'sig1_TEC', timebins, tecbins)
+    hist_hour = streaming.Histogram2D(hour_of_day, 'sig1_TEC', np.linspace(0., 24., 25), tecbins)
+    hist_second = streaming.Histogram2D(second_of_day, 'sig1_TEC', np.linspace(0., 86400., 97), tecbins)
+    tecstats = streaming.RunningStats('sig1_TEC')
+    tecrange = streaming.MinMax('sig1_TEC')
+
     query_start = time.time()
-    rawdata = tools.get_sqlite_data(req_list, config['ismrdb'], table=tabname,
-                               svid=svid, tstart=config['clim']['startdt'],
-                               tend=config['clim']['enddt'],
-                               restrict_crit=None, log=log)
+    batches = streaming.iter_sqlite_data(req_list, config['ismrdb'], table=tabname,
+                                         svid=svid, tstart=config['clim']['startdt'],
+                                         tend=config['clim']['enddt'],
+                                         batchsize=config['clim'].get('batchsize', streaming.BATCHSIZE),
+                                         log=log)
+    streaming.consume(batches, [hist_time, hist_hour, hist_second, tecstats, tecrange], log=log)
     query_end = time.time()
-    log.debug('Query took {:.3f} seconds'.format(query_end - query_start))
-    log.debug('Got {}, {}'.format(len(rawdata), np.asarray(rawdata).shape, rawdata))
-    nonandata = tools.nice_data(rawdata, req_list, log=log)
-    fulldata = tools.add_timedata(nonandata)
-    log.debug('first 20 times {}'.format(fulldata['time'][:20]))
-    log.debug('first 20 hours {} ({})'.format(fulldata['timeofday'][:20], [t.hour for t in fulldata['time'][:20]]))
-    # sys.exit(0)
+    log.debug('Query and binning took {:.3f} seconds'.format(query_end - query_start))
+    log.debug('TEC: {} values, mean {:.2f}, std {:.2f}, range {} - {}'.format(tecstats.count,
+                tecstats.mean, tecstats.std, tecrange.min, tecrange.max))
 
     log.info('Create a mean signal and its excursions')
     pdict = {
@@ -71,20 +97,39 @@ def main(configfile):
     }
 
     # pdict['histbins'] =
-    lib.scintplots.hist2D_plot(fulldata['timestamp'], 'time', fulldata['sig1_TEC'], 'TEC',
-                               300, 150, xrange=None, yrange=None,
-                               tagdict=pdict, outdir= './plots/clim', log=log)
-
-    # houroftheday = np.array([t.hour for t in fulldata['time']])
-    # secondoftheday = np.array([tools.second_of_day(t) for t in fulldata['time']])
-    # print(fulldata['time'])
-    # print(secondoftheday)
-    lib.scintplots.hist2D_plot(fulldata['timeofday'], 'hour_of_day', fulldata['sig1_TEC'], 'TEC',
-                               24, 200, xrange=None, yrange=None,
-                               tagdict=pdict, outdir= './plots/clim', log=log)
-    lib.scintplots.hist2D_plot(fulldata['secondofday'], 'second_of_day', fulldata['sig1_TEC'], 'TEC',
-                               96, 200, xrange=None, yrange=None,
-                               tagdict=pdict, outdir= './plots/clim', log=log)
+    lib.scintplots.hist2D_counts_plot(hist_time.counts, hist_time.xedges, hist_time.yedges,
+                                      'time', 'TEC', yrange=None,
+                                      tagdict=pdict, outdir= './plots/clim', log=log)
+    lib.scintplots.hist2D_counts_plot(hist_hour.counts, hist_hour.xedges, hist_hour.yedges,
+                                      'hour_of_day', 'TEC', yrange=None,
+                                      tagdict=pdict, outdir= './plots/clim', log=log)
+    lib.scintplots.hist2D_counts_plot(hist_second.counts, hist_second.xedges, hist_second.yedges,
+                                      'second_of_day', 'TEC', yrange=None,
+                                      tagdict=pdict, outdir= './plots/clim', log=log)
+
+    # the baseline per satellite, season and hour of the day: only the days
+    # that are not in the stored baseline yet are read
+    group = config['clim'].get('group', 'svid')
+    climfile = config['clim'].get('baseline_file',
+                                  './clim/baseline_{}_sig1_TEC_{}.npz'.format(loc, group))
+    clim = Climatology.load_or_create(climfile, 'sig1_TEC', group=group, log=log)
+    if update_climatology(clim, config['ismrdb'], tabname, config['clim']['startdt'],
+                          config['clim']['enddt'], log=log):
+        clim.save(climfile)
+        log.info('Saved baseline {} (revision {})'.format(climfile, clim.revision))
+
+    log.info('Subtract the baseline signal')
+    anom = get_anomalies(clim, config['ismrdb'], tabname, config['startdt'], config['enddt'],
+                         svid=svid, log=log)
+    valid = np.isfinite(anom['anomaly'])
+    log.debug('Anomaly of {} values: mean {:.2f}, std {:.2f}'.format(np.sum(valid),
+                np.nanmean(anom['anomaly']), np.nanstd(anom['anomaly'])))
+    if np.any(valid):
+        pdict['tag'] = 'anomaly'
+        anombins = np.linspace(*config['clim'].get('anombins', [-100., 100., 201]))
+        lib.scintplots.hist2D_plot(anom['timestamp'][valid], 'time', anom['anomaly'][valid],
+                                   'TEC_anomaly', 150, anombins, yrange=None,
+                                   tagdict=pdict, outdir='./plots/clim', log=log)
 
 
 if __name__ == '__main__':
@@ -7,6 +7,7 @@
 import os, sys
 import time
 import argparse
+import sqlite3
 
 import numpy as np
 import datetime as dt
@@ -16,8 +17,13 @@ from matplotlib.colors import LogNorm
 import cartopy.crs as ccrs
 
 import lib.tools
-from lib.tools import get_sqlite_data, init_logger, read_yaml, read_confdate
+from lib.tools import init_logger, read_yaml, read_confdate
 import lib.constants as constants
+from lib.dataset import ISMRDataset
+from lib.histcube import CUBE_BINS, get_cube_counts
+from lib.scintplots import hist2D_counts_plot
+from lib.pierce import IPP_HEIGHT, pierce_points, stored_pierce_height
+from lib.gridding import LatLonGrid, GRID_STEP, GRID_STATS, grid_statistics, draw_grid
 
 
 class ISMRplot():
@@ -35,6 +41,8 @@ class ISMRplot():
         self.location = None
         self._complete_config(configfile)
 
+        self.dataset = None
+        self.plotset = None
         self.vardata = None
         self.nanvar = None
         self.timedata = np.array([], dtype=np.float)
@@ -117,19 +125,11 @@ class ISMRplot():
         '''
             allow for easier selection of GNSS satellites
         '''
-        SATRANGE = {
-            'gps': np.arange(1,38),
-            'glonass': np.arange(38,62),
-            'galileo': np.arange(71, 103),
-            'sbas': np.arange(120,141),
-            'compass': np.arange(141, 173),
-            'qzss': np.arange(180,188)
-        }
 
         # self.log.debug('Interpreting: {}: {}'.format(self.config['satellites'], SATRANGE[self.config['satellites'].lower()]))
         if isinstance(self.config['satellites'], str):
-            if self.config['satellites'].lower() in SATRANGE.keys():
-                return SATRANGE[self.config['satellites'].lower()]
+            if self.config['satellites'].lower() in constants.SATRANGE.keys():
+                return np.arange(*constants.SATRANGE[self.config['satellites'].lower()])
         elif isinstance(self.config['satellites'], (tuple, list, np.array)):
             return self.config['satellites']
         elif '-' in self.config['satellites']:
@@ -137,159 +137,77 @@ class ISMRplot():
             s1, sl = self.config['satellites'].split('-')
             return np.arange(int(s1), int(sl))
 
-    def _prepare_data(self):
+    def _get_dataset(self):
         '''
-            Look in config which data to retrieve from the database
-            and put in a numpy array.
+            The (lazy) dataset of this configuration: shared by all the plots
+            that are made, columns are only read from the database once
         '''
-        total_vars = constants.HEADER_NAMES + constants.NAMES
-
-        tstart = self.config['startdt'] # the interpreted starttime in datetime format
-        tend = self.config['enddt'] # the interpreted endtime in datetime format
-        loc = self.config['location']
-        # scint_db = os.path.join(self.config['ismrdb_path'], self.config['ismrdb_name'].format(loc))
-        tabname = self.config['tabname'].format(loc)
-        if 'satellites' in self.config:
-            svid = self._interpret_svid() # self.config['satellites']
-        else:
-            svid = None
-
-        # make a list of the possible data you might need:
-        if ('plotdata' not in self.config) or self.config['plotdata'] is None:
-            query_start = time.time()
-            vars = self.config['plot_var']
-
-            if isinstance(vars, (list, tuple)):
-                nrvars = len(vars)
-                req_list = list(vars) + ['timestamp']
+        if self.dataset is None:
+            loc = self.config['location']
+            if 'satellites' in self.config:
+                svid = self._interpret_svid() # self.config['satellites']
             else:
-                req_list = [vars, 'timestamp']
-
-            # if the variable by which you want to color the data is not
-            # already in the list, add it
-            if 'colorby' in self.config and self.config['colorby'] in total_vars \
-                    and self.config['colorby'] not in vars:
-
-                # we use the fact that time comes last:
-                req_list.insert(-1, self.config['colorby'])
-                vars.insert(-1, self.config['colorby'])
-                nrvars += 1
-
-            for geovar in ('azimuth', 'elevation'):
-                if 'map' in self.config['plot_type'] and geovar not in vars:
-                    # we use the fact that time comes last:
-                    req_list.insert(-1, geovar)
-                    vars.insert(-1, geovar)
-                    nrvars += 1
+                svid = None
 
             # see if the query should be restricted somehow:
-            # idea is that a variable can be given with a min and a max
-            # more advanced queries: maybe later:
-            restrict_list = []
-            if 'restrictions' in self.config:
-                for rvar in self.config['restrictions']:
-                    if rvar in total_vars:
-                        if 'min' in self.config['restrictions'][rvar]:
-                            rmin = self.config['restrictions'][rvar]['min']
-                            if rmin == 'None':
-                                pass
-                            else:
-                                restrict_list.append('{} > {}'.format(rvar, rmin))
-                        else:
-                            rmin = None
-                        if 'max' in self.config['restrictions'][rvar]:
-                            rmax = self.config['restrictions'][rvar]['max']
-                            if rmax == 'None':
-                                pass
-                            else:
-                                restrict_list.append('{} < {}'.format(rvar, rmax))
-                        else:
-                            rmax = None
-            if restrict_list == []:
-                restrict_list = None
-
-            plotdata = get_sqlite_data(req_list, self.ismrdb, table=tabname,
-                                       svid=svid, tstart=tstart, tend=tend,
-                                       restrict_crit=restrict_list, log=log)
-            query_end = time.time()
-            self.log.debug('Query took {:.3f} seconds'.format(query_end - query_start))
-
-        else:
-            plotdata = config['plotdata']
+            # a variable can be given with a min and a max, a set of values,
+            # or constellation names for the SVID (see lib.restrictions)
+            self.dataset = ISMRDataset(self.ismrdb, self.config['tabname'].format(loc), svid=svid,
+                                       tstart=self.config['startdt'], tend=self.config['enddt'],
+                                       restrictions=self.config.get('restrictions'), log=self.log)
 
-        if nrvars == 1:
-            allvardata = np.array([np.float(t[0]) for t in plotdata])
-            nanvar = np.isnan(allvardata)
-            vardata = allvardata[~nanvar]
-            log.debug('Size vardata: {}'.format(vardata.shape))
-        else:
-            vardata = {}
-            timestampdata = np.array([t[-1] for t in plotdata])
-
-            # make two rounds:
-            # first to get all the nan-values, second to get the data:
-            nanvar = np.zeros_like(timestampdata, dtype=bool)
-            for idx_var, multivar in enumerate(vars):
-                allvardata = np.ones(len(plotdata), dtype=np.float)
-                try:
-                    # allvardata = np.array([np.float(t[idx_var]) for t in plotdata if not None in t else None])
-                    for idx_t, t in enumerate(plotdata):
-                        if None in t or str(t[idx_var]).isalpha():
-                            allvardata[idx_t] = None
-                        else:
-                            allvardata[idx_t] = np.float(t[idx_var])
-                except TypeError as terr:
-                    for t in plotdata:
-                        if t[idx_var] is None:
-                            print('{}, idx {}: {} allvars = {}'.format(t, idx_var, multivar, vars))
-                    self.log.error('what went wrong? var {} in {} or {}?: {}'.format(multivar, vars, req_list, t))
-                    self.log.error('up to now: {}'.format(allvardata))
-                self.log.debug('Round {}: # of nans: {}, total {}'.format(idx_var,
-                            np.sum(np.isnan(allvardata)), np.sum(nanvar)))
-                nanvar = np.logical_or(np.isnan(allvardata), nanvar)
-
-            # remember where the NaN's are:
-            self.nanvar = nanvar
-            self.log.debug('How many nan? {}'.format(np.sum(self.nanvar)))
-
-            # second round:
-            # self.log.debug('Loop over vars: {}, but index over req_list: {}'.format(vars, req_list))
-            for idx_var, multivar in enumerate(req_list):
-
-                # allvardata = np.array([np.float(t[idx_var]) for t in plotdata])
-                for idx_t, t in enumerate(plotdata):
-                    if None in t or str(t[idx_var]).isalpha():
-                        allvardata[idx_t] = None
-                    else:
-                        allvardata[idx_t] = np.float(t[idx_var])
+        return self.dataset
 
-                vardata[multivar] = allvardata[~nanvar]
-                self.log.debug('Size vardata {}: {}'.format(multivar, vardata[multivar].shape))
+    def _prepare_data(self):
+        '''
+            Look in config which data to retrieve from the database
+            and put in a numpy array.
+        '''
+        total_vars = constants.HEADER_NAMES + constants.NAMES
 
-        # gamble that the not available data is the same for all vars in the list...
-        timestampdata = np.array([t[-1] for t in plotdata])[~nanvar]
-        self.timedata = np.array([dt.datetime.fromtimestamp(t[-1]) for t in plotdata])[~nanvar]
-        self._add_hour_of_day()
+        # make a list of the possible data you might need:
+        vars = self.config['plot_var']
+        vars = list(vars) if isinstance(vars, (list, tuple)) else [vars]
+
+        # if the variable by which you want to color the data is not
+        # already in the list, add it
+        if 'colorby' in self.config and self.config['colorby'] in total_vars \
+                and self.config['colorby'] not in vars:
+            vars.append(self.config['colorby'])
+
+        for geovar in ('azimuth', 'elevation'):
+            if 'map' in self.config['plot_type'] and geovar not in vars:
+                vars.append(geovar)
+        req_list = list(vars) + ['timestamp']
+
+        query_start = time.time()
+        dataset = self._get_dataset()
+        dataset.load(req_list)
+        query_end = time.time()
+        self.log.debug('Query took {:.3f} seconds'.format(query_end - query_start))
+
+        # remember where the NaN's are:
+        self.nanvar = ~dataset.valid(vars)
+        self.log.debug('How many nan? {}'.format(np.sum(self.nanvar)))
+        plotset = dataset.select(mask=~self.nanvar)
+        self.plotset = plotset
+
+        vardata = {var: plotset[var] for var in req_list}
+        # 'detrend': plot the variables minus their rolling median over this many seconds of the pass
+        if self.config.get('detrend'):
+            plotvars = self.config['plot_var']
+            for var in (list(plotvars) if isinstance(plotvars, (list, tuple)) else [plotvars]):
+                vardata[var] = vardata[var] - plotset.rolling(var, self.config['detrend'], stats=['median'])['median']
+        self.timedata = plotset.timedata
+        self.timeofday = plotset.timeofday
         vardata['timeofday'] = self.timeofday
 
         # for a next plot(?)
         self.vardata = vardata
         self.log.debug('Vars: {}, vardata: {}'.format(vars, vardata.keys()))
-        for var in vars:
-            self.log.debug('Var {}: {}'.format(var, np.sum(np.isnan(vardata[var]))))
 
-        # sys.exit(0)
         return vardata
 
-    def _add_hour_of_day(self):
-        '''
-            Get the time-of-day for each measurement
-        '''
-        tod = np.zeros_like(self.timedata)
-        for mt_idx, mtime in enumerate(self.timedata):
-            tod[mt_idx] = (mtime - dt.datetime(mtime.year, mtime.month, mtime.day, 0,0,0,0)).seconds/3600.
-        self.timeofday = tod
-
     def _sats_for_figname(self):
         '''
             Decide how to indicate for which sats the figure was made
@@ -383,10 +301,9 @@ class ISMRplot():
                 histbins = [histbins_conf, histbins_conf]
         else:
             if self.vardata:
-                min_var = np.nanmin([-0.2 * np.nanpercentile(self.vardata[var], 2.),
-                                     0.8 * np.nanpercentile(self.vardata[var], 2.),
-                                     1.2 * np.nanpercentile(self.vardata[var], 2.)])
-                max_var = 1.3 * np.nanpercentile(self.vardata[var], 98.)
+                low, high = self.plotset.percentile(var, [2., 98.])
+                min_var = np.nanmin([-0.2 * low, 0.8 * low, 1.2 * low])
+                max_var = 1.3 * high
                 histbins = [200, np.linspace(min_var, max_var, 300)]
             else: # if all else fails: try useful TEC bins:
                 histbins = [150, 50]
@@ -431,6 +348,12 @@ class ISMRplot():
             Make a histogram plot of a variable var in the ismr database db
         '''
 
+        # the histogram cube holds counts for all rows, so only without restrictions
+        if (self.config.get('use_cube', False) and var in CUBE_BINS
+                and not self.config.get('restrictions')):
+            if self._cube_hist_plot(var):
+                return
+
         if self.vardata is None:
             vardata = self._prepare_data()
 
@@ -472,8 +395,8 @@ class ISMRplot():
             ymin, ymax = self.config['yrange']
             ax.set_ylim(ymin, ymax)
         else:
-            ax.set_ylim(np.nanmin([0., np.nanpercentile(self.vardata[var], 2.)]),
-                        np.nanmax([1.3 * np.nanpercentile(self.vardata[var], 98.)]) )
+            low, high = self.plotset.percentile(var, [2., 98.])
+            ax.set_ylim(np.nanmin([0., low]), np.nanmax([1.3 * high]))
 
         # draw a red line where the zero should be:
         ax.axhline(y=0, color='red', linestyle='-', alpha=0.4)
@@ -510,8 +433,8 @@ class ISMRplot():
             ymin, ymax = self.config['yrange']
             ax.set_ylim(ymin, ymax)
         else:
-            ax.set_ylim(np.nanmin([0., np.nanpercentile(self.vardata[var], 2.)]),
-                        np.nanmax([1.3 * np.nanpercentile(self.vardata[var], 98.)]) )
+            low, high = self.plotset.percentile(var, [2., 98.])
+            ax.set_ylim(np.nanmin([0., low]), np.nanmax([1.3 * high]))
 
         # draw a red line where the zero should be:
         ax.axhline(y=0, color='red', linestyle='-', alpha=0.4)
@@ -532,17 +455,57 @@ class ISMRplot():
 
         return
 
-    def geo_plot(self, var):
+    def _cube_hist_plot(self, var):
         '''
-            Plot the GNSS data on a map
+            Make the 2D histograms of hist_plot from the histogram cube in the
+            database (lib.histcube), whole days only; False if there is no cube
+        '''
+        svid = self._get_dataset().svid
+        tagdict = {'satellites': self._sats_for_figname(), 'location': self.config['location'],
+                   'startdt': self.config['startdt'], 'enddt': self.config['enddt'], 'tag': self.tag}
+        for xaxis, xname in (('day', 'time'), ('hour', 'hour_of_day')):
+            cube = get_cube_counts(var, self.ismrdb, self.config['tabname'].format(self.config['location']),
+                                   self.config['startdt'], self.config['enddt'], svid=svid, xaxis=xaxis,
+                                   log=self.log)
+            if cube is None:
+                self.log.warning('No histogram cube in {}, histogram from the data'.format(self.ismrdb))
+                return False
+            counts, xedges, yedges = cube
+            hist2D_counts_plot(counts, xedges, yedges, xname, var, yrange=self.config.get('yrange'),
+                               tagdict=tagdict, outdir=self.config['outputdir'], log=self.log)
+
+        return True
+
+    def _pierce_points(self, point, height):
+        '''
+            Latitude, longitude of the pierce points of the plotted rows: the
+            ones stored at ingestion when they are for the same shell height,
+            computed for the rows (or databases) without them
+        '''
+        lats = lons = None
+        if height == stored_pierce_height(self.plotset.db, self.plotset.table):
+            try:
+                self.plotset.load(['ipp_lat', 'ipp_lon'])
+                lats = np.array(self.plotset['ipp_lat'], dtype=float)
+                lons = np.array(self.plotset['ipp_lon'], dtype=float)
+            except sqlite3.OperationalError:
+                self.log.debug('No stored pierce points in {}'.format(self.plotset.table))
+        if lats is None:
+            lats, lons, _obliquity = pierce_points(self.vardata['azimuth'], self.vardata['elevation'],
+                                                   point=point, height=height)
+            return lats, lons
+
+        missing = np.isnan(lats) | np.isnan(lons)
+        if np.any(missing):
+            lats[missing], lons[missing], _obliquity = pierce_points(self.vardata['azimuth'][missing],
+                                                                     self.vardata['elevation'][missing],
+                                                                     point=point, height=height)
+        return lats, lons
+
+    def _map_axes(self, midpoint):
+        '''
+            A figure with a map around midpoint (lat, lon)
         '''
-        if self.vardata is None:
-            vardata = self._prepare_data()
-
-        sphere = ccrs.PlateCarree(globe=ccrs.Globe(datum='WGS84',
-                                                   ellipse='sphere'))
-
-        midpoint = constants.TOPO[self.config['location']] # (17.62048, -63.24323),
         fig = plt.figure()
 
         # choose a projection
@@ -559,38 +522,84 @@ class ISMRplot():
         gl.xlabels_top = False
         gl.ylabels_right = False
 
+        # indicate the receiver station
+        ax.scatter(lon0, lat0, s=130, c='r', marker='*', zorder=3)
+
+        return fig, ax
+
+    def geo_plot(self, var):
+        '''
+            Plot the GNSS data on a map: by default the mean (or 'grid_stat':
+            max, count) per cell of a lat/lon grid, per 'grid_window' seconds
+            if given; with 'map_style': scatter every sample
+        '''
+        if self.vardata is None:
+            vardata = self._prepare_data()
+
+        midpoint = constants.TOPO[self.config['location']] # (17.62048, -63.24323),
+
         # the plotheight is a measure of where one would estimate the scintillation to
         # occur. The signal is measured at the earth's surface, the satellites are at
         # approximately 20.000 km height (Medium Earth Orbit, MEO).
-        plotheight = 200. # km
-        lons, lats = lib.tools.azel_to_latlon(self.vardata['azimuth'], self.vardata['elevation'],
-                                              point=midpoint, height=plotheight)
+        plotheight = self.config.get('ipp_height', IPP_HEIGHT) # km
+        lats, lons = self._pierce_points(midpoint, plotheight)
         self.log.debug('Lats: {}-{}, \nLons: {}-{}'.format(np.nanmin(lats), np.nanmax(lats),
                                                             np.nanmin(lons), np.nanmax(lons)))
         plotdata = self.vardata[var]
-        minval = np.nanpercentile(plotdata, 10.)
-        maxval = np.nanpercentile(plotdata, 95.)
+        minval, maxval = self.plotset.percentile(var, [10., 95.])
         self.log.debug('Plotdata {}: plot {} to {} \n{}'.format(var, minval, maxval, plotdata[:30]))
 
-        # indicate the receiver station
-        ax.scatter(lon0, lat0, s=130, c='r', marker='*')
-
-        # the actual plotting:
-        azel = ax.scatter(lons, lats, s=30, c=plotdata, vmin=minval, vmax=maxval,
-                        cmap=plt.cm.get_cmap(self.cmap), alpha=0.7, linewidths=0, edgecolors=None,
-                        )
+        style = self.config.get('map_style', 'grid')
+        if style == 'scatter':
+            fig, ax = self._map_axes(midpoint)
+            azel = ax.scatter(lons, lats, s=30, c=plotdata, vmin=minval, vmax=maxval,
+                            cmap=plt.cm.get_cmap(self.cmap), alpha=0.7, linewidths=0, edgecolors=None,
+                            )
+            self._save_geo_plot(fig, ax, azel, var, plotheight, self.timedata[0], self.timedata[-1])
+            return
+
+        stat = self.config.get('grid_stat', 'mean')
+        if stat not in GRID_STATS:
+            self.log.error('Unknown grid_stat {}, use one of {}'.format(stat, GRID_STATS))
+            return
+        if stat == 'count':
+            minval = maxval = None
+        window = self.config.get('grid_window', None)
+        grid = LatLonGrid(midpoint, step=self.config.get('grid_step', GRID_STEP))
+        stats = grid_statistics(grid, lats, lons, plotdata, timestamps=self.vardata['timestamp'],
+                                window=window)
+        for idx, tstart in enumerate(stats['tstart']):
+            if not np.any(stats['count'][idx]):
+                continue
+            fig, ax = self._map_axes(midpoint)
+            mesh = draw_grid(ax, grid, stats[stat][idx], vmin=minval, vmax=maxval,
+                             cmap=plt.cm.get_cmap(self.cmap), mask_zero=(stat == 'count'),
+                             alpha=0.8, transform=ccrs.PlateCarree())
+            if window is None:
+                tfirst, tlast = self.timedata[0], self.timedata[-1]
+            else:
+                tfirst = dt.datetime.fromtimestamp(tstart)
+                tlast = dt.datetime.fromtimestamp(tstart + window)
+            self._save_geo_plot(fig, ax, mesh, var, plotheight, tfirst, tlast,
+                                what='{} of {} per {} deg'.format(stat, var, grid.step))
 
+    def _save_geo_plot(self, fig, ax, layer, var, plotheight, tfirst, tlast, what=None):
+        '''
+            Add labels and colorbar to a map of geo_plot and save it
+        '''
+        if what is None:
+            what = 'Tracks: {}'.format(var)
         ax.set_xlabel('Longitude [deg]')
         ax.set_ylabel('Latitude [deg]')
-        ax.set_title('Tracks: {} for satellites {} at {:.1f} km, \nperiod {} - {}'.format(var, self._sats_for_figname(),
-                                plotheight, self.timedata[0].strftime('%Y%m%d%H%M'), self.timedata[-1].strftime('%Y%m%d%H%M')))
-        cb = fig.colorbar(azel, ax=ax)
+        ax.set_title('{} for satellites {} at {:.1f} km, \nperiod {} - {}'.format(what, self._sats_for_figname(),
+                                plotheight, tfirst.strftime('%Y%m%d%H%M'), tlast.strftime('%Y%m%d%H%M')))
+        cb = fig.colorbar(layer, ax=ax)
         cb.set_label('{} [units]'.format(var))
         outfig = os.path.join(self.config['outputdir'],
                 'azel_map_{}_{}_{}-{}_sat_{}_{}.png'.format(var,
                                 self.config['location'],
-                                self.timedata[0].strftime('%Y%m%d%H%M'),
-                                self.timedata[-1].strftime('%Y%m%d%H%M'),
+                                tfirst.strftime('%Y%m%d%H%M'),
+                                tlast.strftime('%Y%m%d%H%M'),
                                 self._sats_for_figname(), self.tag))
         fig.savefig(outfig, dpi=100)
         plt.close(fig)
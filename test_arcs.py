@@ -0,0 +1,72 @@
+#! /usr/bin/env python
+'''
+    Incremental segmentation of the passes (lib.arcs): run from the top
+    directory with python -m pytest test_arcs.py
+'''
+
+import sqlite3
+
+import numpy as np
+
+from lib.arcs import segment_arcs, update_arcs, get_arcs
+
+TABLE = 'sep_data_TEST'
+T0 = 1600000000.
+# every satellite is tracked for 6 hours and lost for 6, the next one 90 minutes later:
+# there is always a satellite in view
+NR_SATS = 8
+CADENCE = 60.
+
+
+def _rows(tstart, tend):
+    '''
+        The (timestamp, SVID, elevation) rows in [tstart, tend)
+    '''
+    rows = []
+    for svid in range(1, NR_SATS + 1):
+        for tstamp in np.arange(tstart, tend, CADENCE):
+            phase = (tstamp - T0 - svid * 5400.) % 43200.
+            if phase < 21600.:
+                rows.append((float(tstamp), svid, 90. * np.sin(np.pi * phase / 21600.)))
+    return rows
+
+def _ingest_hourly(db, hours):
+    conn = sqlite3.connect(db)
+    conn.execute('CREATE TABLE {} (timestamp REAL, SVID INTEGER, elevation REAL, '
+                 'PRIMARY KEY (timestamp, SVID))'.format(TABLE))
+    conn.commit()
+    nrpasses = []
+    for hour in range(hours):
+        tstart = T0 + hour * 3600.
+        conn.executemany('INSERT INTO {} (timestamp, SVID, elevation) VALUES (?, ?, ?)'.format(TABLE), _rows(tstart, tstart + 3600.))
+        conn.commit()
+        nrpasses.append(update_arcs(db, TABLE, tstart, tstart + 3600. - 1.))
+    conn.close()
+    return nrpasses
+
+def test_window_stays_bounded(tmp_path):
+    db = str(tmp_path / 'arcs.db')
+    nrpasses = _ingest_hourly(db, 72)
+    # at most the pass of every satellite next to the new rows is segmented again
+    assert max(nrpasses) <= NR_SATS
+    assert len(get_arcs(db, TABLE)['arc_id']) > 3 * NR_SATS
+
+def test_same_as_full_segmentation(tmp_path):
+    db = str(tmp_path / 'arcs.db')
+    _ingest_hourly(db, 36)
+    conn = sqlite3.connect(db)
+    rows = conn.execute('SELECT timestamp, SVID, elevation, arc_id FROM {}'.format(TABLE)).fetchall()
+    conn.close()
+    columns = {var: np.array([row[idx] for row in rows], dtype=float)
+               for idx, var in enumerate(['timestamp', 'SVID', 'elevation', 'arc_id'])}
+    arc_of_row, arcs = segment_arcs(columns)
+
+    stored = get_arcs(db, TABLE)
+    assert len(stored['arc_id']) == len(arcs['SVID'])
+    order = np.lexsort((stored['tstart'], stored['SVID']))
+    np.testing.assert_array_equal(stored['SVID'][order], arcs['SVID'])
+    np.testing.assert_array_equal(stored['tstart'][order], arcs['tstart'])
+    np.testing.assert_array_equal(stored['tend'][order], arcs['tend'])
+    np.testing.assert_array_equal(stored['nr_rows'][order], arcs['nr_rows'])
+    # the rows of a pass have its arc_id
+    np.testing.assert_array_equal(columns['arc_id'], stored['arc_id'][order][arc_of_row])
@@ -0,0 +1,72 @@
+#! /usr/bin/env python
+'''
+    The restrictions of a plot configuration (lib.restrictions): the SQL
+    criteria select the same rows as the mask on the column arrays. Run from
+    the top directory with python -m pytest test_restrictions.py
+'''
+
+import sqlite3
+
+import numpy as np
+import pytest
+
+from lib.tools import get_sqlite_data, rows_to_columns
+from lib.restrictions import compile_restrictions, restriction_mask, table_columns
+
+TABLE = 'sep_data_TEST'
+COLUMNS = ['timestamp', 'SVID', 'elevation', 'sig1_S4', 'qflag']
+RESTRICTIONS = [
+    {'elevation': {'min': 25.}},
+    {'sig1_S4': {'min': 0.2, 'max': 0.6}},
+    {'sig1_S4': {'max': 0.3}, 'elevation': {'min': 10., 'max': 60.}},
+    {'SVID': {'in': [3, 40, 75]}},
+    {'SVID': {'not_in': [5, 120]}},
+    {'SVID': [3, 12]},
+    {'SVID': 'gps'},
+    {'constellation': ['galileo', 'glonass']},
+    {'qflag': 'any'},
+    {'qflag': ['tec_slip', 'tec_outlier']},
+    {'SVID': 'gps', 'sig1_S4': {'min': None, 'max': 0.5}, 'qflag': ['locktime']},
+]
+
+
+def _columns(db):
+    '''
+        A table with random rows, missing S4 values and quality flags, and its columns
+    '''
+    rng = np.random.default_rng(31)
+    nrows = 2000
+    svids = rng.choice([3, 5, 12, 40, 55, 75, 120], nrows)
+    s4 = rng.random(nrows)
+    qflag = rng.integers(0, 16, nrows)
+    rows = [(1600000000. + 60. * idx, int(svids[idx]), float(90. * rng.random()),
+             None if idx % 13 == 0 else float(s4[idx]), None if idx % 7 == 0 else int(qflag[idx]))
+            for idx in range(nrows)]
+    conn = sqlite3.connect(db)
+    conn.execute('CREATE TABLE {} (timestamp REAL, SVID INTEGER, elevation REAL, sig1_S4 REAL, qflag INTEGER, '
+                 'PRIMARY KEY (timestamp, SVID))'.format(TABLE))
+    conn.executemany('INSERT INTO {} VALUES (?,?,?,?,?)'.format(TABLE), rows)
+    conn.commit()
+    conn.close()
+    return rows_to_columns(rows, COLUMNS)
+
+@pytest.mark.parametrize('restrictions', RESTRICTIONS)
+def test_sql_and_mask_agree(tmp_path, restrictions):
+    db = str(tmp_path / 'restrict.db')
+    columns = _columns(db)
+    crit, params = compile_restrictions(restrictions, columns=table_columns(db, TABLE))
+    rows = get_sqlite_data(['timestamp'], db, svid=None, restrict_crit=crit, restrict_params=params,
+                           table=TABLE)
+    selected = np.sort([row[0] for row in rows])
+
+    mask = restriction_mask(restrictions, columns)
+    assert 0 < np.sum(mask) < len(mask)
+    np.testing.assert_array_equal(selected, np.sort(columns['timestamp'][mask]))
+
+def test_unknown_column(tmp_path):
+    db = str(tmp_path / 'restrict.db')
+    columns = _columns(db)
+    with pytest.raises(ValueError):
+        compile_restrictions({'sig2_S4': {'min': 0.3}}, columns=table_columns(db, TABLE))
+    with pytest.raises(ValueError):
+        restriction_mask({'no_such_column': 1}, columns)
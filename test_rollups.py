@@ -0,0 +1,102 @@
+#! /usr/bin/env python
+'''
+    The rollups of the statistics (lib.rollups): the statistics from the
+    rollup tables equal those computed from the raw rows, also for bounds that
+    split a bucket and for hours that were never rolled up. Run from the top
+    directory with python -m pytest test_rollups.py
+'''
+
+import shutil
+import sqlite3
+
+import numpy as np
+import pytest
+
+from lib.rollups import update_rollups, get_statistics, coverage_table
+
+TABLE = 'sep_data_TEST'
+T0 = 1600041600.
+NR_DAYS = 2
+CADENCE = 60.
+SVIDS = [3, 5, 12, 40, 75, 120]
+COLUMNS = ['timestamp', 'SVID', 'sig1_TEC', 'sig1_S4', 'sig2_S4', 'sig3_S4']
+# requested (period, group, svid, tstart, tend) relative to T0
+REQUESTS = [
+    (3600, 'svid', None, 0., NR_DAYS * 86400.),
+    (3600, 'svid', [5, 40], 1234., 1.5 * 86400. + 77.),
+    (7200, 'svid', None, 1800., 86400. + 5400.),
+    (86400, 'svid', 12, 0., NR_DAYS * 86400.),
+    (60, 'constellation', None, 30000.5, 40000.),
+    (600, 'constellation', None, 0., 86400.),
+    (3600, 'constellation', None, 600., NR_DAYS * 86400. - 600.),
+]
+STATS = ['count', 'min', 'max', 'mean', 'std']
+
+
+def _write(db):
+    '''
+        Rows of all satellites every minute, with some missing values and
+        some gaps
+    '''
+    rng = np.random.default_rng(48)
+    rows = []
+    for svid in SVIDS:
+        for tstamp in np.arange(T0, T0 + NR_DAYS * 86400., CADENCE):
+            if rng.random() < 0.1:
+                continue
+            values = [20. + 10. * np.sin(2. * np.pi * tstamp / 86400.) + rng.normal()] + \
+                list(0.05 + 0.3 * rng.random(3) ** 4)
+            rows.append((float(tstamp), svid) + tuple(None if rng.random() < 0.05 else float(val)
+                                                      for val in values))
+    conn = sqlite3.connect(db)
+    conn.execute('CREATE TABLE {} ({}, PRIMARY KEY (timestamp, SVID))'.format(TABLE, ', '.join(
+                 '{} {}'.format(col, 'INTEGER' if col == 'SVID' else 'REAL') for col in COLUMNS)))
+    conn.executemany('INSERT INTO {} VALUES ({})'.format(TABLE, ','.join('?' * len(COLUMNS))), rows)
+    conn.commit()
+    conn.close()
+
+def _databases(tmp_path):
+    '''
+        raw.db without rollups and rolled.db with rollups of the first day
+        only, hour by hour as at ingestion
+    '''
+    raw = str(tmp_path / 'raw.db')
+    _write(raw)
+    rolled = str(tmp_path / 'rolled.db')
+    shutil.copyfile(raw, rolled)
+    for hour in np.arange(T0, T0 + 86400., 3600.):
+        update_rollups(rolled, TABLE, hour, hour + 3600. - 1.)
+    return raw, rolled
+
+def _assert_equal(stats, expected):
+    order = np.lexsort((stats['grp'], stats['bucket']))
+    expected_order = np.lexsort((expected['grp'], expected['bucket']))
+    np.testing.assert_array_equal(stats['bucket'][order], expected['bucket'][expected_order])
+    np.testing.assert_array_equal(stats['grp'][order], expected['grp'][expected_order])
+    for col in STATS:
+        np.testing.assert_allclose(stats[col][order], expected[col][expected_order], rtol=1.e-9, atol=1.e-12)
+
+@pytest.mark.parametrize('period, group, svid, tstart, tend', REQUESTS)
+def test_rollup_equals_raw(tmp_path, period, group, svid, tstart, tend):
+    raw, rolled = _databases(tmp_path)
+    for var in ['sig1_TEC', 'sig1_S4']:
+        expected = get_statistics(var, raw, TABLE, T0 + tstart, T0 + tend, period=period, group=group,
+                                  svid=svid)
+        stats = get_statistics(var, rolled, TABLE, T0 + tstart, T0 + tend, period=period, group=group,
+                               svid=svid)
+        assert len(expected['bucket']) > 0
+        _assert_equal(stats, expected)
+
+def test_rollups_are_used(tmp_path):
+    raw, rolled = _databases(tmp_path)
+    conn = sqlite3.connect(rolled)
+    covered = conn.execute('SELECT COUNT(*) FROM {}'.format(coverage_table(TABLE))).fetchone()[0]
+    # change the raw rows of the rolled up day: the statistics still come from the rollups
+    conn.execute('UPDATE {} SET sig1_S4 = 1. WHERE timestamp < ?'.format(TABLE), (T0 + 86400.,))
+    conn.commit()
+    conn.close()
+    assert covered == 24
+
+    expected = get_statistics('sig1_S4', raw, TABLE, T0, T0 + 86400., period=3600, group='svid')
+    stats = get_statistics('sig1_S4', rolled, TABLE, T0, T0 + 86400., period=3600, group='svid')
+    _assert_equal(stats, expected)
@@ -0,0 +1,153 @@
+#! /usr/bin/env python
+'''
+    Monthly shards (lib.shards): the same data in one database and in monthly
+    shards gives the same rows and the same derived tables, and reading never
+    creates the database itself. Run from the top directory with
+    python -m pytest test_shards.py
+'''
+
+import os
+import sqlite3
+
+import numpy as np
+
+from lib.shards import shard_name, list_shards, shards_for_range, month_bounds, timestamp_to_month
+from lib.tools import get_sqlite_data, rows_to_columns
+from lib.arcs import update_arcs, get_arcs
+from lib.events import update_events, get_events
+from lib.restrictions import create_column_indexes, table_columns
+from lib.rollups import update_rollups, get_statistics
+from lib.skyplot import update_skygrids, get_skygrid
+
+TABLE = 'sep_data_TEST'
+STATION = 'SABA'
+# two days around the start of June 2018 (UTC)
+T0 = 1527724800.
+NR_DAYS = 2
+CADENCE = 60.
+SVIDS = [3, 5, 12, 40, 75]
+COLUMNS = ['timestamp', 'SVID', 'azimuth', 'elevation', 'sig1_TEC', 'sig1_S4', 'sig2_S4', 'sig3_S4',
+           'sig1_phi60', 'sig2_phi60', 'sig3_phi60']
+# no data in the hour around midnight, so no pass or event is split by the shards
+GAP = (T0 + 86400. - 1800., T0 + 86400. + 1800.)
+
+
+def _rows():
+    '''
+        Rows of satellites that are in view for 6 of every 12 hours, with a
+        scintillation burst now and then and some missing values
+    '''
+    rng = np.random.default_rng(26)
+    rows = []
+    for svid in SVIDS:
+        for tstamp in np.arange(T0, T0 + NR_DAYS * 86400., CADENCE):
+            phase = (tstamp - T0 - svid * 3000.) % 43200.
+            if phase >= 21600. or GAP[0] <= tstamp < GAP[1]:
+                continue
+            elevation = 90. * np.sin(np.pi * phase / 21600.)
+            s4 = 0.05 + 0.05 * rng.random(3)
+            if rng.random() < 0.02:
+                s4[0] += 0.5
+            tec = 20. + 10. * np.sin(2. * np.pi * tstamp / 86400.) + rng.normal()
+            s4 = [None if rng.random() < 0.05 else float(val) for val in s4]
+            rows.append((float(tstamp), svid, float((svid * 40. + phase / 120.) % 360.), float(elevation),
+                         float(tec)) + tuple(s4) + tuple(float(val) for val in 0.1 * rng.random(3)))
+    return rows
+
+def _derive(db, tstart, tend):
+    update_rollups(db, TABLE, tstart, tend)
+    update_skygrids(db, TABLE, tstart, tend)
+    update_events(db, TABLE, STATION, tstart, tend)
+    update_arcs(db, TABLE, tstart, tend)
+
+def _write(db, rows):
+    conn = sqlite3.connect(db)
+    conn.execute('CREATE TABLE {} ({}, PRIMARY KEY (timestamp, SVID))'.format(TABLE, ', '.join(
+                 '{} {}'.format(col, 'INTEGER' if col == 'SVID' else 'REAL') for col in COLUMNS)))
+    conn.executemany('INSERT INTO {} VALUES ({})'.format(TABLE, ','.join('?' * len(COLUMNS))), rows)
+    conn.commit()
+    conn.close()
+
+def _databases(tmp_path):
+    '''
+        The rows in single.db and in the monthly shards of sharded.db, with
+        their derived tables: the shards as at ingestion, each for its month
+    '''
+    rows = _rows()
+    single = str(tmp_path / 'single.db')
+    _write(single, rows)
+    _derive(single, T0, T0 + NR_DAYS * 86400. - 1.)
+
+    sharded = str(tmp_path / 'sharded.db')
+    months = timestamp_to_month([row[0] for row in rows])
+    for month in np.unique(months):
+        shardfile = shard_name(sharded, month)
+        _write(shardfile, [row for row, rowmonth in zip(rows, months) if rowmonth == month])
+        month_start, month_end = month_bounds(month)
+        _derive(shardfile, max(T0, month_start), min(T0 + NR_DAYS * 86400., month_end) - 1.)
+    return single, sharded
+
+def test_router(tmp_path):
+    single, sharded = _databases(tmp_path)
+    assert [month for month, _shardfile in list_shards(sharded)] == ['201805', '201806']
+    assert len(shards_for_range(sharded, T0, T0 + 3600.)) == 1
+    assert len(shards_for_range(sharded, T0, T0 + NR_DAYS * 86400.)) == 2
+
+    varlist = ['timestamp', 'SVID', 'sig1_TEC', 'sig1_S4']
+    for tstart, tend in [(None, None), (T0 + 3600., T0 + 1.5 * 86400.), (T0 + 86400., T0 + 2 * 86400.)]:
+        expected = get_sqlite_data(varlist, single, svid=None, tstart=tstart, tend=tend, table=TABLE,
+                                   order_by=['timestamp', 'SVID'])
+        rows = get_sqlite_data(varlist, sharded, svid=None, tstart=tstart, tend=tend, table=TABLE,
+                               order_by=['timestamp', 'SVID'])
+        assert len(rows) > 0
+        assert rows == expected
+    # in time order over the shards
+    columns = rows_to_columns(get_sqlite_data(varlist, sharded, svid=None, table=TABLE), varlist)
+    assert np.all(np.diff(columns['timestamp']) >= 0.)
+    assert not os.path.exists(sharded)
+
+def test_derived_tables(tmp_path):
+    single, sharded = _databases(tmp_path)
+
+    events, expected = get_events(sharded, station=STATION), get_events(single, station=STATION)
+    assert len(events['SVID']) > 0
+    for col in ['SVID', 'tstart', 'tend', 'peak_S4', 'nr_samples']:
+        np.testing.assert_array_equal(events[col], expected[col])
+    window = get_events(sharded, T0 + 86400., T0 + 2 * 86400.)
+    assert np.all(window['tend'] >= T0 + 86400.)
+
+    arcs, expected = get_arcs(sharded, TABLE), get_arcs(single, TABLE)
+    assert len(arcs['SVID']) > 0
+    order = np.lexsort((arcs['tstart'], arcs['SVID']))
+    expected_order = np.lexsort((expected['tstart'], expected['SVID']))
+    for col in ['SVID', 'tstart', 'tend', 'nr_rows']:
+        np.testing.assert_array_equal(arcs[col][order], expected[col][expected_order])
+
+    grid, expected = (get_skygrid('sig1_S4', db, TABLE, T0, T0 + NR_DAYS * 86400.) for db in (sharded, single))
+    np.testing.assert_array_equal(grid.count, expected.count)
+    np.testing.assert_allclose(grid.sum, expected.sum)
+
+    for period, group in [(3600, 'svid'), (86400, 'constellation')]:
+        stats, expected = (get_statistics('sig1_S4', db, TABLE, T0 + 1800., T0 + NR_DAYS * 86400. - 600.,
+                                          period=period, group=group) for db in (sharded, single))
+        order = np.lexsort((stats['grp'], stats['bucket']))
+        expected_order = np.lexsort((expected['grp'], expected['bucket']))
+        for col in ['bucket', 'grp', 'count', 'min', 'max']:
+            np.testing.assert_array_equal(stats[col][order], expected[col][expected_order])
+        np.testing.assert_allclose(stats['mean'][order], expected['mean'][expected_order])
+
+    # reading never creates the database itself
+    assert not os.path.exists(sharded)
+
+def test_column_indexes(tmp_path):
+    _single, sharded = _databases(tmp_path)
+    assert 'sig1_S4' in table_columns(sharded, TABLE)
+    create_column_indexes(sharded, TABLE)
+    for _month, shardfile in list_shards(sharded):
+        conn = sqlite3.connect(shardfile)
+        indexes = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='index'")]
+        conn.close()
+        assert 'idx_elevation' in indexes and 'idx_sig1_S4' in indexes
+    assert not os.path.exists(sharded)
+    assert table_columns(str(tmp_path / 'missing.db'), TABLE) is None
+    assert not os.path.exists(str(tmp_path / 'missing.db'))